@@ -0,0 +1,108 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+from benchmarks.run import default_variants, quick_variants, measure, request_parameters, metadata
+from benchmarks.synthetic import write_synthetic_repo, variant_name
+
+import logging
+logger = logging.getLogger("nb2workflow.benchmarks")
+
+engines = ["papermill", "compiled", "forkserver"]
+
+
+def bench_engine(fn, variant, engine, repeat):
+    from nb2workflow import compiled
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    compiled.default_engine = {"compiled": "auto"}.get(engine, engine)
+
+    nba = NotebookAdapter(fn)
+    if nba.execution_engine != engine:
+        return dict(error="notebook runs with %s"%nba.execution_engine)
+
+    parameters = nba.interpret_parameters(request_parameters(variant))['request_parameters']
+
+    def run():
+        job_nba = NotebookAdapter(fn)
+        exceptions = job_nba.execute(parameters, progress_bar=False, log_output=False)
+        if len(exceptions) > 0:
+            raise Exception("synthetic notebook failed: %s" % repr(exceptions))
+        return job_nba
+
+    stats, _ = measure(run, repeat, teardown=lambda state, job_nba: shutil.rmtree(job_nba.tmpdir, ignore_errors=True))
+    return dict(seconds=stats)
+
+
+def compare_engines(variants, repeat=3, selected=engines):
+    """
+    execution time of the synthetic notebooks with each engine; the forkserver is started before, as the service does
+    """
+    from nb2workflow import compiled, forkserver
+
+    workdir = tempfile.mkdtemp(prefix="nb2workflow-benchmark-")
+    default_engine = compiled.default_engine
+
+    try:
+        notebooks = write_synthetic_repo(os.path.join(workdir, "repo"), variants)
+
+        report = dict(meta=metadata(), preload=forkserver.preload, benchmarks=[])
+
+        if "forkserver" in selected:
+            report['forkserver_start_seconds'] = forkserver.start().started_seconds
+
+        for variant in variants:
+            name = variant_name(variant)
+
+            results = {}
+            for engine in selected:
+                logger.info("benchmarking %s with %s", name, engine)
+                try:
+                    results[engine] = bench_engine(notebooks[name], variant, engine, repeat)
+                except Exception as e:
+                    logger.exception("engine %s failed", engine)
+                    results[engine] = dict(error=repr(e))
+
+            report['benchmarks'].append(dict(variant=variant, name=name, engines=results))
+
+        return report
+    finally:
+        compiled.default_engine = default_engine
+        forkserver.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare nb2workflow execution engines on synthetic notebooks.')
+    parser.add_argument('--output', metavar='file', type=str, default=None, help="write JSON report here instead of stdout")
+    parser.add_argument('--quick', action='store_true', help="only the smallest notebook variant")
+    parser.add_argument('--repeat', metavar='N', type=int, default=3)
+    parser.add_argument('--engines', metavar='engine', type=str, nargs='*', default=engines, choices=engines)
+    parser.add_argument('--preload', metavar='module,...', type=str, default=None, help="modules preloaded by the forkserver")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if args.preload is not None:
+        from nb2workflow import forkserver
+        forkserver.preload = forkserver.parse_modules(args.preload)
+
+    report = compare_engines(quick_variants if args.quick else default_variants, args.repeat, args.engines)
+
+    report_json = json.dumps(report, indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import datetime
+import subprocess
+import statistics
+
+from concurrent.futures import ThreadPoolExecutor
+
+import nbformat
+
+from benchmarks.synthetic import write_synthetic_repo, variant_name
+
+import logging
+logger = logging.getLogger("nb2workflow.benchmarks")
+
+default_variants = [
+    dict(n_cells=5, n_parameters=2, n_outputs=1, output_file_kb=0),
+    dict(n_cells=5, n_parameters=32, n_outputs=1, output_file_kb=0),
+    dict(n_cells=5, n_parameters=2, n_outputs=32, output_file_kb=0),
+    dict(n_cells=200, n_parameters=4, n_outputs=4, output_file_kb=0),
+    dict(n_cells=5, n_parameters=2, n_outputs=1, output_file_kb=1024),
+]
+
+quick_variants = default_variants[:1]
+
+stages = [
+    "parse_notebook",
+    "extract_parameters",
+    "interpret_parameters",
+    "provision_workdir",
+    "kernel_startup",
+    "execute",
+    "extract_output",
+    "serialize_output",
+    "end_to_end",
+]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return dict(
+                n=len(samples),
+                mean=statistics.mean(samples),
+                median=statistics.median(samples),
+                min=samples[0],
+                max=samples[-1],
+                p95=samples[min(len(samples)-1, int(round(0.95*(len(samples)-1))))],
+                stdev=statistics.stdev(samples) if len(samples) > 1 else 0.,
+            )
+
+
+def measure(func, repeat, setup=None, teardown=None):
+    samples = []
+    result = None
+    for i in range(repeat):
+        state = setup() if setup else None
+
+        t0 = time.perf_counter()
+        result = func(state) if setup else func()
+        samples.append(time.perf_counter() - t0)
+
+        if teardown:
+            teardown(state, result)
+
+    return summarize(samples), result
+
+
+def request_parameters(variant, i=0):
+    return dict([("p%i" % j, str(float(i + j))) for j in range(variant['n_parameters'])])
+
+
+def bench_notebook(fn, variant, repeat, execute_repeat, selected):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    results = {}
+
+    def record(stage, func):
+        if stage not in selected:
+            return None
+
+        try:
+            stats, result = func()
+            results[stage] = dict(seconds=stats)
+            return result
+        except Exception as e:
+            logger.exception("stage %s failed", stage)
+            results[stage] = dict(error=repr(e))
+
+    record("parse_notebook", lambda: measure(lambda: nbformat.reads(open(fn).read(), as_version=4), repeat))
+
+    nba = NotebookAdapter(fn)
+
+    record("extract_parameters", lambda: measure(nba.extract_parameters, repeat))
+
+    raw_parameters = request_parameters(variant)
+    record("interpret_parameters", lambda: measure(lambda: nba.interpret_parameters(raw_parameters), repeat))
+
+    parameters = nba.interpret_parameters(raw_parameters)['request_parameters']
+
+    record("provision_workdir", lambda: measure(
+                nba.provision_workdir,
+                execute_repeat,
+                teardown=lambda state, tmpdir: shutil.rmtree(tmpdir, ignore_errors=True)))
+
+    def kernel_startup():
+        from jupyter_client.manager import start_new_kernel
+
+        def start_kernel():
+            km, kc = start_new_kernel(kernel_name='python3')
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+
+        return measure(start_kernel, execute_repeat)
+
+    record("kernel_startup", kernel_startup)
+
+    executed = []
+    def execute():
+        def run():
+            job_nba = NotebookAdapter(fn)
+            exceptions = job_nba.execute(parameters, progress_bar=False, log_output=False)
+            if len(exceptions) > 0:
+                raise Exception("synthetic notebook failed: %s" % repr(exceptions))
+            return job_nba
+
+        def cleanup(state, job_nba):
+            if len(executed) > 0:
+                shutil.rmtree(executed.pop().tmpdir, ignore_errors=True)
+            executed.append(job_nba)
+
+        return measure(run, execute_repeat, teardown=cleanup)
+
+    job_nba = record("execute", execute)
+
+    output_stages = [stage for stage in ("extract_output", "serialize_output") if stage in selected]
+
+    if job_nba is None and len(output_stages) > 0:
+        try:
+            job_nba = NotebookAdapter(fn)
+            job_nba.execute(parameters, progress_bar=False, log_output=False)
+            executed.append(job_nba)
+        except Exception as e:
+            for stage in output_stages:
+                results[stage] = dict(error="unable to execute notebook: " + repr(e))
+            output_stages = []
+
+    def extract_output():
+        return measure(job_nba.extract_output, repeat)
+
+    def serialize_output():
+        from nb2workflow.service import ResultJSONEncoder
+
+        job_output = output if output is not None else job_nba.extract_output()
+
+        stats, r = measure(lambda: json.dumps(dict(output=job_output, exceptions=[], jobdir=job_nba.tmpdir), cls=ResultJSONEncoder), repeat)
+        results['serialize_output_bytes'] = len(r)
+        return stats, r
+
+    output = None
+    if "extract_output" in output_stages:
+        output = record("extract_output", extract_output)
+
+    if "serialize_output" in output_stages:
+        record("serialize_output", serialize_output)
+
+    for job_nba in executed:
+        shutil.rmtree(job_nba.tmpdir, ignore_errors=True)
+
+    return results
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_service(repo, port, timeout=120, args=()):
+    import requests
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + ":" + env.get('PYTHONPATH', "")
+
+    p = subprocess.Popen(
+        [sys.executable, "-m", "nb2workflow.service", repo, '--port', str(port), '--prewarm-top', '0'] + list(args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    )
+
+    url = "http://127.0.0.1:%i" % port
+
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if p.poll() is not None:
+            raise Exception("service exited with code %s" % p.returncode)
+
+        try:
+            if requests.get(url + "/", timeout=1).status_code == 200:
+                return p, url, time.perf_counter() - t0
+        except requests.ConnectionError:
+            pass
+
+        time.sleep(0.1)
+
+    stop_service(p)
+    raise Exception("service did not start in %i seconds" % timeout)
+
+
+def stop_service(p):
+    import psutil
+
+    try:
+        for child in psutil.Process(p.pid).children(recursive=True):
+            child.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+    p.kill()
+    p.wait()
+
+
+def bench_end_to_end(repo, notebooks, variants, concurrency_levels, n_requests):
+    import requests
+
+    p, url, startup_seconds = start_service(repo, free_port())
+
+    results = dict(service_startup_seconds=startup_seconds, load=[])
+
+    try:
+        for variant in variants:
+            name = variant_name(variant)
+
+            for concurrency in concurrency_levels:
+                def call(i):
+                    t0 = time.perf_counter()
+                    # distinct parameters per request, so that the result cache is not hit
+                    r = requests.get(url + "/api/v1.0/get/" + name, params=request_parameters(variant, i + concurrency * n_requests))
+                    return time.perf_counter() - t0, r.status_code, len(r.content)
+
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    responses = list(pool.map(call, range(n_requests)))
+                wall = time.perf_counter() - t0
+
+                results['load'].append(dict(
+                            variant=variant,
+                            concurrency=concurrency,
+                            requests=n_requests,
+                            errors=len([r for r in responses if r[1] != 200]),
+                            response_bytes=summarize([r[2] for r in responses]),
+                            latency_seconds=summarize([r[0] for r in responses]),
+                            throughput_rps=n_requests / wall,
+                        ))
+    finally:
+        stop_service(p)
+
+    return results
+
+
+def metadata():
+    try:
+        revision = subprocess.check_output(["git", "describe", "--always", "--tags", "--dirty"],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        revision = "unknown"
+
+    return dict(
+                revision=revision,
+                timestamp=datetime.datetime.utcnow().isoformat(),
+                python=sys.version,
+                platform=platform.platform(),
+                cpu_count=os.cpu_count(),
+            )
+
+
+def run(variants, repeat=20, execute_repeat=3, selected=stages, concurrency_levels=(1, 4), n_requests=8):
+    workdir = tempfile.mkdtemp(prefix="nb2workflow-benchmark-")
+
+    try:
+        repo = os.path.join(workdir, "repo")
+        notebooks = write_synthetic_repo(repo, variants)
+
+        report = dict(meta=metadata(), benchmarks=[])
+
+        for variant in variants:
+            name = variant_name(variant)
+            logger.info("benchmarking %s", name)
+
+            report['benchmarks'].append(dict(
+                        variant=variant,
+                        name=name,
+                        stages=bench_notebook(notebooks[name], variant, repeat, execute_repeat, selected),
+                    ))
+
+        if "end_to_end" in selected:
+            try:
+                report['end_to_end'] = bench_end_to_end(repo, notebooks, variants, concurrency_levels, n_requests)
+            except Exception as e:
+                logger.exception("end to end benchmark failed")
+                report['end_to_end'] = dict(error=repr(e))
+
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def failures(report):
+    """
+    stages which failed, and end to end loads with failed requests: their timings do not measure the service
+    """
+    failed = []
+
+    for benchmark in report['benchmarks']:
+        for stage, result in sorted(benchmark['stages'].items()):
+            if isinstance(result, dict) and 'error' in result:
+                failed.append("%s %s: %s" % (benchmark['name'], stage, result['error']))
+
+    end_to_end = report.get('end_to_end', {})
+    if 'error' in end_to_end:
+        failed.append("end_to_end: %s" % end_to_end['error'])
+
+    for load in end_to_end.get('load', []):
+        if load['errors'] > 0:
+            failed.append("end_to_end %s at concurrency %i: errors=%i/%i" % (variant_name(load['variant']), load['concurrency'], load['errors'], load['requests']))
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nb2workflow request path and execution pipeline.')
+    parser.add_argument('--output', metavar='file', type=str, default=None, help="write JSON report here instead of stdout")
+    parser.add_argument('--quick', action='store_true', help="only the smallest notebook variant, few repetitions")
+    parser.add_argument('--repeat', metavar='N', type=int, default=20, help="repetitions of in-process stages")
+    parser.add_argument('--execute-repeat', metavar='N', type=int, default=3, help="repetitions of stages which start kernels or processes")
+    parser.add_argument('--stages', metavar='stage', type=str, nargs='*', default=stages, choices=stages)
+    parser.add_argument('--concurrency', metavar='N', type=int, nargs='*', default=[1, 4])
+    parser.add_argument('--requests', metavar='N', type=int, default=8, help="requests per variant and concurrency level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if args.quick:
+        report = run(quick_variants, repeat=3, execute_repeat=1, selected=args.stages, concurrency_levels=args.concurrency[:1], n_requests=2)
+    else:
+        report = run(default_variants, repeat=args.repeat, execute_repeat=args.execute_repeat, selected=args.stages,
+                     concurrency_levels=args.concurrency, n_requests=args.requests)
+
+    report_json = json.dumps(report, indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+    failed = failures(report)
+    if len(failed) > 0:
+        for failure in failed:
+            logger.error("benchmark failed: %s", failure)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+from benchmarks.run import quick_variants, summarize, free_port, start_service, stop_service, metadata
+from benchmarks.synthetic import write_synthetic_repo
+
+import logging
+logger = logging.getLogger("nb2workflow.benchmarks")
+
+
+def measure_startup(repeat=3):
+    """
+    cold start of the service, from process start to the first served request, with the startup profile of the last start
+    """
+    import requests
+
+    workdir = tempfile.mkdtemp(prefix="nb2workflow-benchmark-")
+
+    try:
+        repo = os.path.join(workdir, "repo")
+        write_synthetic_repo(repo, quick_variants)
+
+        samples = []
+        profile = None
+        for i in range(repeat):
+            p, url, seconds = start_service(repo, free_port(), args=['--profile-startup'])
+            try:
+                samples.append(seconds)
+                try:
+                    profile = requests.get(url + "/status").json().get('startup', None)
+                except ValueError as e:
+                    logger.warning("no startup profile in the service status: %s", repr(e))
+            finally:
+                stop_service(p)
+
+        return dict(meta=metadata(), cold_start_seconds=summarize(samples), startup=profile)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regressions(report, baseline=None, tolerance=0.25, max_seconds=None):
+    median = report['cold_start_seconds']['median']
+
+    issues = []
+
+    if max_seconds is not None and median > max_seconds:
+        issues.append("cold start took %.3f s, more than %.3f s"%(median, max_seconds))
+
+    if baseline is not None:
+        baseline_median = baseline['cold_start_seconds']['median']
+        if median > baseline_median * (1 + tolerance):
+            issues.append("cold start took %.3f s, more than %.0f%% over the baseline %.3f s"%(median, tolerance * 100, baseline_median))
+
+    return issues
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nb2workflow service cold start, failing if it regressed.')
+    parser.add_argument('--output', metavar='file', type=str, default=None, help="write JSON report here instead of stdout")
+    parser.add_argument('--repeat', metavar='N', type=int, default=3)
+    parser.add_argument('--baseline', metavar='file', type=str, default=None, help="JSON report of an earlier run to compare with")
+    parser.add_argument('--tolerance', metavar='fraction', type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    parser.add_argument('--max-seconds', metavar='seconds', type=float, default=None, help="allowed cold start time")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    report = measure_startup(args.repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report['regressions'] = regressions(report, baseline, args.tolerance, args.max_seconds)
+
+    report_json = json.dumps(report, indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+    for issue in report['regressions']:
+        logger.error(issue)
+
+    if len(report['regressions']) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+import nbformat
+
+
+def tagged_cell(source, tag):
+    cell = nbformat.v4.new_code_cell(source=source)
+    cell.metadata['tags'] = [tag]
+    return cell
+
+
+def synthetic_notebook(n_cells=10, n_parameters=4, n_outputs=2, output_file_kb=0):
+    parameters = "\n".join(["p%i = %i." % (i, i) for i in range(n_parameters)])
+
+    cells = [tagged_cell(parameters, 'parameters')]
+
+    for i in range(n_cells):
+        cells.append(nbformat.v4.new_code_cell(source="\n".join([
+                    "x%i = sum(p*p for p in [%s])" % (i, ", ".join(["p%i" % j for j in range(n_parameters)]) or "0"),
+                    "print(x%i)" % i,
+                ])))
+
+    outputs = ["out%i = %i * 1." % (i, i) if n_cells == 0 else "out%i = x%i" % (i, i % n_cells) for i in range(n_outputs)]
+
+    if output_file_kb > 0:
+        cells.append(nbformat.v4.new_code_cell(source="\n".join([
+                    "import os",
+                    "with open('output_file.bin', 'wb') as f:",
+                    "    f.write(os.urandom(%i))" % (output_file_kb * 1024),
+                ])))
+        outputs.append("output_file = 'output_file.bin'")
+
+    cells.append(tagged_cell("\n".join(outputs), 'outputs'))
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = cells
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+
+    return nb
+
+
+def variant_name(variant):
+    return "cells{n_cells}-pars{n_parameters}-outs{n_outputs}-file{output_file_kb}kb".format(**variant)
+
+
+def write_synthetic_repo(location, variants):
+    """
+    writes one synthetic notebook per variant into a git repository, as the notebook adapter clones the notebook directory for every job
+    """
+
+    if not os.path.exists(location):
+        os.makedirs(location)
+
+    notebooks = {}
+    for variant in variants:
+        name = variant_name(variant)
+        fn = os.path.join(location, name + ".ipynb")
+        nbformat.write(synthetic_notebook(**variant), fn)
+        notebooks[name] = fn
+
+    subprocess.check_call(["git", "init", "-q", location])
+    subprocess.check_call(["git", "-C", location, "add", "."])
+    subprocess.check_call(["git", "-C", location,
+                           "-c", "user.name=nb2workflow-benchmark", "-c", "user.email=benchmark@localhost",
+                           "commit", "-q", "-m", "synthetic notebooks"])
+
+    return notebooks
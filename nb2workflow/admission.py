@@ -0,0 +1,188 @@
+import os
+import math
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+        super(Overloaded, self).__init__("%s, retry after %i s"%(reason, retry_after))
+
+
+class TargetCost(object):
+    """
+    moving averages of the peak memory and duration of the jobs of a target
+    """
+
+    def __init__(self, memory_mb, seconds, alpha=0.3):
+        self.memory_mb = memory_mb
+        self.seconds = seconds
+        self.alpha = alpha
+        self.n = 0
+
+    def record(self, memory_mb, seconds):
+        # jobs shorter than the monitor poll interval have no memory sample
+        if memory_mb > 0:
+            if self.n == 0:
+                self.memory_mb = memory_mb
+            else:
+                self.memory_mb += self.alpha * (memory_mb - self.memory_mb)
+
+        if self.n == 0:
+            self.seconds = seconds
+        else:
+            self.seconds += self.alpha * (seconds - self.seconds)
+        self.n += 1
+
+    def as_dict(self):
+        return dict(memory_mb=self.memory_mb, seconds=self.seconds, n=self.n)
+
+
+class AdmissionController(object):
+    """
+    rejects new executions, or defers background ones, before the node saturates: when the executor queue is long,
+    or when the memory left after the estimated needs of admitted jobs, the load average, or the disk space are short.
+    Limits set to 0 are not checked.
+    """
+
+    def __init__(self, executor, max_queue_per_worker=2., min_available_mb=500, max_load_per_cpu=2., min_disk_mb=300,
+                 default_memory_mb=200, default_seconds=10, sample_interval=1., max_defer_seconds=600):
+        self.executor = executor
+        self.max_queue_per_worker = max_queue_per_worker
+        self.min_available_mb = min_available_mb
+        self.max_load_per_cpu = max_load_per_cpu
+        self.min_disk_mb = min_disk_mb
+        self.default_memory_mb = default_memory_mb
+        self.default_seconds = default_seconds
+        self.sample_interval = sample_interval
+        self.max_defer_seconds = max_defer_seconds
+
+        self.lock = threading.RLock()
+        self.costs = {}
+        self.reserved = {}
+        self.rejected = {}
+        self._signals = None
+        self._sampled_at = 0
+
+    def sample(self):
+        signals = dict(load_per_cpu=os.getloadavg()[0] / (os.cpu_count() or 1))
+
+        statvfs = os.statvfs(".")
+        signals['disk_avail_mb'] = statvfs.f_frsize * statvfs.f_bavail / 1024. / 1024.
+
+        try:
+            import psutil
+            signals['memory_avail_mb'] = psutil.virtual_memory().available / 1024. / 1024.
+        except ImportError:
+            signals['memory_avail_mb'] = None
+
+        return signals
+
+    def signals(self):
+        now = time.time()
+        if self._signals is None or now - self._sampled_at > self.sample_interval:
+            self._signals = self.sample()
+            self._sampled_at = now
+        return self._signals
+
+    def estimate(self, target):
+        cost = self.costs.get(target, None)
+        if cost is None:
+            return TargetCost(self.default_memory_mb, self.default_seconds)
+        return cost
+
+    def record(self, target, resource_usage):
+        if resource_usage is None:
+            return
+
+        with self.lock:
+            self.costs.setdefault(target, TargetCost(self.default_memory_mb, self.default_seconds)).record(
+                        resource_usage['peak_rss_mb'], resource_usage['wall_seconds'])
+
+    def queue_wait(self, target):
+        status = self.executor.status()
+        return (status['running'] + status['queued']) * self.estimate(target).seconds / status['max_workers']
+
+    def check_queue(self, target):
+        status = self.executor.status()
+        if self.max_queue_per_worker > 0 and status['queued'] >= self.max_queue_per_worker * status['max_workers']:
+            return "%i jobs queued for %i workers"%(status['queued'], status['max_workers']), self.queue_wait(target)
+
+    def check_disk(self, target):
+        signals = self.signals()
+        if self.min_disk_mb > 0 and signals['disk_avail_mb'] < self.min_disk_mb:
+            return "only %.0f MB of disk space left"%signals['disk_avail_mb'], 60
+
+    def check_pressure(self, target):
+        signals = self.signals()
+        estimate = self.estimate(target)
+
+        if self.min_available_mb > 0 and signals['memory_avail_mb'] is not None:
+            left = signals['memory_avail_mb'] - sum(self.reserved.values()) - estimate.memory_mb
+            if left < self.min_available_mb:
+                return "%.0f MB of memory would be left, below %.0f MB"%(left, self.min_available_mb), max(estimate.seconds, self.queue_wait(target))
+
+        if self.max_load_per_cpu > 0 and signals['load_per_cpu'] > self.max_load_per_cpu:
+            return "load average of %.2f per cpu"%signals['load_per_cpu'], max(estimate.seconds, 5)
+
+    def refuse(self, target, reason, retry_after):
+        with self.lock:
+            self.rejected[target] = self.rejected.get(target, 0) + 1
+        logger.warning("not admitting %s: %s", target, reason)
+        raise Overloaded(reason, int(math.ceil(retry_after)))
+
+    def admit(self, target, background=False):
+        """
+        raises Overloaded if a job of the target should not be started now; background jobs may be queued under memory and load pressure.
+        Jobs to start now get a reservation of their expected memory, to be released when they finish
+        """
+        checks = [self.check_queue, self.check_disk]
+        if not background:
+            checks.append(self.check_pressure)
+
+        with self.lock:
+            for check in checks:
+                refusal = check(target)
+                if refusal is not None:
+                    self.refuse(target, *refusal)
+
+            if not background:
+                return self.reserve(target)
+
+    def reserve_when_ready(self, target, token, deferred_since):
+        """
+        reserves memory for a background job under token, unless the node is under pressure and the job was deferred for less than max_defer_seconds.
+        Used as the executor gate of background jobs: deferred ones wait in their lane, without taking a worker
+        """
+        with self.lock:
+            refusal = self.check_pressure(target)
+            if refusal is not None and time.time() - deferred_since < self.max_defer_seconds:
+                logger.info("deferring a job of %s: %s", target, refusal[0])
+                return False
+
+            self.reserve(target, token)
+            return True
+
+    def reserve(self, target, token=None):
+        if token is None:
+            token = object()
+        with self.lock:
+            self.reserved[token] = self.estimate(target).memory_mb
+        return token
+
+    def release(self, token):
+        with self.lock:
+            self.reserved.pop(token, None)
+
+    def status(self):
+        return dict(
+                    signals=self.signals(),
+                    reserved_mb=sum(self.reserved.values()),
+                    costs=dict((target, cost.as_dict()) for target, cost in self.costs.items()),
+                    rejected=dict(self.rejected),
+                )
@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# parameters with values like blob:sha256:<hex> refer to uploaded input files
+reference_pattern = re.compile(r"^blob:sha256:([0-9a-f]{64})$")
+
+inputs_directory = "inputs"
+
+default_root = os.environ.get('NB2WORKFLOW_BLOB_STORE', os.path.join(tempfile.gettempdir(), "nb2workflow-blobs"))
+
+
+class BlobError(Exception):
+    pass
+
+
+class UnknownBlob(BlobError):
+    pass
+
+
+class UploadOffsetMismatch(BlobError):
+    def __init__(self, offset):
+        self.offset = offset
+        super(UploadOffsetMismatch, self).__init__("upload is at offset %i"%offset)
+
+
+class UploadTooLarge(BlobError):
+    pass
+
+
+def reference(digest):
+    return "blob:sha256:" + digest
+
+
+def parse_reference(value):
+    """
+    digest of the blob a parameter value refers to, None if it is not a reference
+    """
+    if isinstance(value, str):
+        r = reference_pattern.match(value)
+        if r:
+            return r.groups()[0]
+
+
+class BlobStore(object):
+    """
+    input files stored by the sha256 of their content, each once. Uploads are written to a partial file,
+    possibly in several chunks, and moved into the store when their digest is verified.
+    Stored blobs are read-only: they are hard-linked into job directories.
+    """
+
+    def __init__(self, root, max_size_mb=1024, upload_ttl=24*3600):
+        self.root = root
+        self.max_size_mb = max_size_mb
+        self.upload_ttl = upload_ttl
+        self.lock = threading.Lock()
+
+        for directory in ("objects", "uploads"):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        return os.stat(self.path(digest)).st_size
+
+    def upload_path(self, upload_id):
+        if not re.match(r"^[0-9a-f]{32}$", upload_id):
+            raise UnknownBlob("no upload %s"%upload_id)
+        return os.path.join(self.root, "uploads", upload_id)
+
+    def begin(self):
+        self.expire_uploads()
+
+        upload_id = uuid.uuid4().hex
+        open(self.upload_path(upload_id), "wb").close()
+        return upload_id
+
+    def offset(self, upload_id):
+        try:
+            return os.stat(self.upload_path(upload_id)).st_size
+        except OSError:
+            raise UnknownBlob("no upload %s"%upload_id)
+
+    def append(self, upload_id, offset, stream, chunk_size=1024*1024):
+        """
+        appends a chunk at offset, which must be the size uploaded so far; returns the new offset
+        """
+        with self.lock:
+            current = self.offset(upload_id)
+            if offset != current:
+                raise UploadOffsetMismatch(current)
+
+            with open(self.upload_path(upload_id), "ab") as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    current += len(chunk)
+                    if current > self.max_size_mb * 1024 * 1024:
+                        raise UploadTooLarge("uploads are limited to %.0f MB"%self.max_size_mb)
+                    f.write(chunk)
+
+            return current
+
+    def finish(self, upload_id, digest=None):
+        """
+        moves a complete upload into the store, unless the same content is there already; returns its digest
+        """
+        fn = self.upload_path(upload_id)
+
+        h = hashlib.sha256()
+        try:
+            with open(fn, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    h.update(chunk)
+        except IOError:
+            raise UnknownBlob("no upload %s"%upload_id)
+
+        actual = h.hexdigest()
+        if digest is not None and digest != actual:
+            os.remove(fn)
+            raise BlobError("uploaded content has sha256 %s, not %s"%(actual, digest))
+
+        if self.exists(actual):
+            logger.info("blob %s was uploaded before", actual)
+            os.remove(fn)
+        else:
+            os.makedirs(os.path.dirname(self.path(actual)), exist_ok=True)
+            os.chmod(fn, 0o444)
+            os.rename(fn, self.path(actual))
+            logger.info("stored blob %s of %i bytes", actual, self.size(actual))
+
+        return actual
+
+    def put(self, stream, digest=None):
+        upload_id = self.begin()
+        try:
+            self.append(upload_id, 0, stream)
+        except BlobError:
+            os.remove(self.upload_path(upload_id))
+            raise
+        return self.finish(upload_id, digest)
+
+    def expire_uploads(self):
+        now = time.time()
+        directory = os.path.join(self.root, "uploads")
+        for fn in os.listdir(directory):
+            try:
+                if now - os.stat(os.path.join(directory, fn)).st_mtime > self.upload_ttl:
+                    logger.info("removing abandoned upload %s", fn)
+                    os.remove(os.path.join(directory, fn))
+            except OSError:
+                pass
+
+    def link(self, digest, workdir):
+        """
+        hard-links a blob into a job directory, copying it if the store is on another filesystem; returns the path relative to the job directory
+        """
+        if not self.exists(digest):
+            raise UnknownBlob("no blob %s"%digest)
+
+        relative = os.path.join(inputs_directory, digest)
+        fn = os.path.join(workdir, relative)
+
+        if not os.path.exists(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            try:
+                os.link(self.path(digest), fn)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copyfile(self.path(digest), fn)
+
+        return relative
+
+    def link_inputs(self, parameters, workdir):
+        """
+        parameters with blob references replaced by the paths of the blobs linked into the job directory
+        """
+        linked = dict(parameters)
+        for name, value in parameters.items():
+            digest = parse_reference(value)
+            if digest is not None:
+                linked[name] = self.link(digest, workdir)
+        return linked
+
+    def status(self):
+        n, size = 0, 0
+        for directory, _, filenames in os.walk(os.path.join(self.root, "objects")):
+            for fn in filenames:
+                n += 1
+                size += os.stat(os.path.join(directory, fn)).st_size
+        return dict(root=self.root, blobs=n, size_mb=size / 1024. / 1024., uploads=len(os.listdir(os.path.join(self.root, "uploads"))))
+
+
+_store = None
+
+def get_store():
+    global _store
+
+    if _store is None:
+        _store = BlobStore(default_root)
+    return _store
+
+
+def set_store(store):
+    global _store
+    _store = store
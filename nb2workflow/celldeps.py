@@ -0,0 +1,197 @@
+import ast
+import logging
+
+from nb2workflow.nbadapter import parse_nbline
+
+logger = logging.getLogger(__name__)
+
+# builtins which do not change anything outside of their return value: a cell calling them does not have to be kept for that
+pure_builtins = set([
+    'abs', 'all', 'any', 'bool', 'dict', 'enumerate', 'float', 'format', 'int', 'isinstance', 'len', 'list',
+    'max', 'min', 'print', 'range', 'repr', 'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'type', 'zip',
+])
+
+# calls which write nothing, when made as statements; other calls may write files, which outputs can refer to
+effect_free_calls = pure_builtins | set(['display', 'time.sleep', 'warnings.warn'])
+effect_free_prefixes = ('logger.', 'logging.')
+
+definition_nodes = (ast.Assign, ast.AnnAssign, ast.AugAssign, ast.Import, ast.ImportFrom,
+                    ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Pass)
+
+
+class OpaqueCell(Exception):
+    pass
+
+
+def strip_magics(source):
+    """
+    replaces IPython line magics and shell escapes by empty lines, keeping line numbers; returns python source and the magic lines
+    """
+
+    if source.lstrip().startswith("%%"):
+        raise OpaqueCell("cell magic")
+
+    lines = []
+    magics = []
+    for line in source.split("\n"):
+        if line.lstrip().startswith(("%", "!")):
+            if line != line.lstrip():
+                raise OpaqueCell("indented magic: %s"%line)
+            magics.append(line)
+            lines.append("")
+        else:
+            lines.append(line)
+
+    return "\n".join(lines), magics
+
+
+def mutated_name(target):
+    while isinstance(target, (ast.Subscript, ast.Attribute)):
+        target = target.value
+
+    if isinstance(target, ast.Name):
+        return target.id
+
+
+def cell_names(source):
+    """
+    names read and written anywhere in the cell; item and attribute assignments count as writes of the object
+    """
+    tree = ast.parse(strip_magics(source)[0])
+
+    reads = set()
+    writes = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                reads.add(node.id)
+            else:
+                writes.add(node.id)
+        elif isinstance(node, (ast.Subscript, ast.Attribute)) and not isinstance(node.ctx, ast.Load):
+            name = mutated_name(node)
+            if name is not None:
+                writes.add(name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                writes.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            writes.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            writes.update(node.names)
+
+    return reads, writes
+
+
+def has_side_effects(source):
+    """
+    whether the cell has top level statements other than assignments and definitions, which may change objects or files they touch
+    """
+    return any(not isinstance(node, definition_nodes) for node in ast.parse(strip_magics(source)[0]).body)
+
+
+def call_name(func):
+    parts = []
+    while isinstance(func, ast.Attribute):
+        parts.insert(0, func.attr)
+        func = func.value
+
+    if isinstance(func, ast.Name):
+        return ".".join([func.id] + parts)
+
+
+def writes_outside(source):
+    """
+    whether the cell may write files, or anything else besides its names: it makes calls as statements, other than known effect-free ones,
+    or has shell escapes and magics. Such cells are kept whatever outputs are requested
+    """
+    python, magics = strip_magics(source)
+    if len(magics) > 0:
+        return True
+
+    for node in ast.walk(ast.parse(python)):
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            name = call_name(node.value.func)
+            if name is None or not (name in effect_free_calls or name.startswith(effect_free_prefixes)):
+                return True
+
+    return False
+
+
+def select_output_lines(source, outputs):
+    """
+    outputs cell source restricted to the requested outputs
+    """
+    lines = []
+    for line in source.split("\n"):
+        p = parse_nbline(line)
+        if p is None or p['name'] in outputs:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def required_cells(cells, outputs):
+    """
+    indices of the cells needed to compute the requested outputs: a backward slice over the names the cells read and write.
+
+    cells are tuples (cell_type, source, tags). Parameters cells are always kept, and so are cells which may write files, with what they read:
+    file outputs are not tied by name to the cells writing them. An opaque cell is kept together with everything before it.
+    """
+    needed = set(outputs)
+    keep = set()
+
+    for i in reversed(range(len(cells))):
+        cell_type, source, tags = cells[i]
+
+        if cell_type != 'code' or 'system-parameters' in tags:
+            continue
+
+        if 'parameters' in tags:
+            keep.add(i)
+            continue
+
+        if 'outputs' in tags:
+            source = select_output_lines(source, outputs)
+
+        try:
+            reads, writes = cell_names(source)
+            side_effects = has_side_effects(source)
+            writer = writes_outside(source)
+        except (SyntaxError, OpaqueCell) as e:
+            logger.debug("cell %i is opaque for dependency analysis, keeping all cells up to it: %s", i, e)
+            keep.update(j for j in range(i + 1) if cells[j][0] == 'code' and 'system-parameters' not in cells[j][2])
+            break
+
+        if writes & needed or writer or (side_effects and reads & (needed - pure_builtins)):
+            keep.add(i)
+            needed |= reads
+
+    return keep
+
+
+def slice_cells(cells, outputs, keep, start=0):
+    """
+    nbformat cells, numbered from start, restricted to the kept ones, and with the outputs cell restricted to the requested outputs
+    """
+    sliced = []
+    for i, cell in enumerate(cells, start):
+        if i not in keep:
+            continue
+
+        if 'outputs' in cell.metadata.get('tags', []):
+            cell = cell.copy()
+            cell.source = select_output_lines(cell.source, outputs)
+
+        sliced.append(cell)
+    return sliced
+
+
+def output_ready_after(cells, outputs):
+    """
+    for each output, the index of the last cell it depends on: once it is executed, the output has its final value
+    """
+    ready = {}
+    for name in outputs:
+        before = [i for i in required_cells(cells, [name]) if 'outputs' not in cells[i][2]]
+        ready[name] = max(before) if len(before) > 0 else -1
+    return ready
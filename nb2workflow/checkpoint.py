@@ -0,0 +1,301 @@
+import os
+import ast
+import hmac
+import stat
+import time
+import types
+import pickle
+import hashlib
+import tempfile
+import importlib
+import logging
+
+from nb2workflow.celldeps import OpaqueCell, strip_magics, cell_names
+
+logger = logging.getLogger(__name__)
+
+# checkpoints are unpickled: the directory is private to the user running the service
+checkpoint_dir = os.environ.get('NB2WORKFLOW_CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), "nb2workflow-checkpoints-%i"%os.getuid()))
+
+ipython_names = set(['In', 'Out', 'get_ipython', 'exit', 'quit'])
+
+
+class NotCheckpointable(Exception):
+    pass
+
+
+class UntrustedCheckpoint(Exception):
+    pass
+
+
+def definitions_source(source):
+    """
+    top level imports, function and class definitions of a cell
+    """
+    source = strip_magics(source)[0]
+    lines = source.split("\n")
+
+    body = ast.parse(source).body
+
+    starts = []
+    for node in body:
+        start = node.lineno
+        for decorator in getattr(node, 'decorator_list', []):
+            start = min(start, decorator.lineno)
+        starts.append(start)
+
+    segments = []
+    for i, node in enumerate(body):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            end = starts[i+1] - 1 if i+1 < len(body) else len(lines)
+            segments.append("\n".join(lines[starts[i]-1:end]))
+
+    return "\n".join(segments)
+
+
+def independent_prefix(cells, parameter_names):
+    """
+    number of leading cells which neither read nor overwrite request parameters, and so produce the same state for any request.
+
+    cells are tuples (cell_type, source, tags)
+    """
+    parameter_names = set(parameter_names)
+
+    n = 0
+    for cell_type, source, tags in cells:
+        if cell_type == 'code':
+            if 'outputs' in tags:
+                break
+
+            if 'parameters' not in tags:
+                try:
+                    reads, writes = cell_names(source)
+                except (SyntaxError, OpaqueCell) as e:
+                    logger.debug("cell %i is opaque for dependency analysis: %s", n, e)
+                    break
+
+                if reads & parameter_names or writes & parameter_names:
+                    break
+        n += 1
+
+    while n > 0 and (cells[n-1][0] != 'code' or 'parameters' in cells[n-1][2]):
+        n -= 1
+
+    return n
+
+
+def notebook_hash(notebook_fn):
+    return hashlib.sha256(open(notebook_fn, "rb").read()).hexdigest()
+
+
+def checkpoint_path(nbhash, prefix):
+    return os.path.join(checkpoint_dir, "%s-%i.pickle"%(nbhash, prefix))
+
+
+def list_files(workdir):
+    files = {}
+    for root, dirs, filenames in os.walk(workdir):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for fn in filenames:
+            path = os.path.join(root, fn)
+            st = os.stat(path)
+            files[os.path.relpath(path, workdir)] = (st.st_mtime, st.st_size)
+    return files
+
+
+def capture_state(namespace, exclude, workdir, files_before):
+    values = {}
+    modules = {}
+
+    for k, v in namespace.items():
+        if k.startswith("_") or k in exclude or k in ipython_names:
+            continue
+
+        if isinstance(v, types.ModuleType):
+            modules[k] = v.__name__
+            continue
+
+        if isinstance(v, (types.FunctionType, type)) and getattr(v, '__module__', None) in ('__main__', None):
+            # re-created by re-running the definitions of the prefix
+            continue
+
+        try:
+            values[k] = pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise NotCheckpointable("%s can not be stored: %s"%(k, repr(e)))
+
+    files = {}
+    for fn, stat in list_files(workdir).items():
+        if files_before.get(fn, None) != stat:
+            files[fn] = open(os.path.join(workdir, fn), "rb").read()
+
+    return dict(values=values, modules=modules, files=files)
+
+
+def restore_state(namespace, state, workdir):
+    for fn, content in state['files'].items():
+        path = os.path.join(workdir, fn)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(content)
+
+    for k, name in state['modules'].items():
+        namespace[k] = importlib.import_module(name)
+
+    for k, v in state['values'].items():
+        namespace[k] = pickle.loads(v)
+
+
+def private_dir(path):
+    """
+    creates the directory accessible only to this user, or checks that an existing one is
+    """
+    os.makedirs(path, 0o700, exist_ok=True)
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise UntrustedCheckpoint("%s is not a directory private to uid %i"%(path, os.getuid()))
+
+    return path
+
+
+_keys = {}
+
+def signing_key(directory):
+    """
+    key authenticating the checkpoints in the directory, created with it; shared by the kernels of the same user
+    """
+    if directory not in _keys:
+        key_fn = os.path.join(private_dir(directory), "key")
+
+        if not os.path.exists(key_fn):
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32))
+            try:
+                # the first process to link its key wins
+                os.link(tmp_path, key_fn)
+            except FileExistsError:
+                pass
+            os.unlink(tmp_path)
+
+        _keys[directory] = open(key_fn, "rb").read()
+
+    return _keys[directory]
+
+
+def signature(directory, payload):
+    return hmac.new(signing_key(directory), payload, hashlib.sha256).digest()
+
+
+def write_checkpoint(path, checkpoint):
+    payload = pickle.dumps(checkpoint, pickle.HIGHEST_PROTOCOL)
+    digest = signature(os.path.dirname(path), payload)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(digest + payload)
+    os.rename(tmp_path, path)
+
+
+def load_signed(path):
+    """
+    unpickles the checkpoint, if it was written with the key of its directory
+    """
+    data = open(path, "rb").read()
+    digest, payload = data[:hashlib.sha256().digest_size], data[hashlib.sha256().digest_size:]
+
+    if not hmac.compare_digest(digest, signature(os.path.dirname(path), payload)):
+        raise UntrustedCheckpoint("%s is not signed with the checkpoint key"%path)
+
+    return pickle.loads(payload)
+
+
+def read_checkpoint(path, timeout):
+    """
+    returns stored state, None if there is no valid checkpoint, or False if the prefix state can not be stored
+    """
+    try:
+        if time.time() - os.stat(path).st_mtime > timeout:
+            return None
+
+        checkpoint = load_signed(path)
+    except UntrustedCheckpoint as e:
+        logger.warning("ignoring checkpoint: %s", e)
+        return None
+    except (OSError, IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if checkpoint.get('error', None) is not None:
+        return False
+
+    return checkpoint['state']
+
+
+def save_checkpoint(namespace, path, exclude, workdir, files_before):
+    try:
+        checkpoint = dict(state=capture_state(namespace, exclude, workdir, files_before))
+    except NotCheckpointable as e:
+        logger.info("prefix state can not be checkpointed: %s", e)
+        checkpoint = dict(error=str(e))
+
+    try:
+        write_checkpoint(path, checkpoint)
+        logger.info("stored checkpoint %s", path)
+    except UntrustedCheckpoint as e:
+        logger.warning("not storing checkpoint: %s", e)
+
+
+def load_checkpoint(namespace, path, workdir):
+    restore_state(namespace, load_signed(path)['state'], workdir)
+
+
+class CheckpointPlan:
+    """
+    how a notebook is split into a checkpointed prefix and the request-dependent rest
+    """
+
+    def __init__(self, notebook_fn, cells, parameter_names, timeout):
+        self.prefix = independent_prefix(cells, parameter_names)
+        self.parameter_names = list(parameter_names)
+        self.timeout = timeout
+        self.path = checkpoint_path(notebook_hash(notebook_fn), self.prefix)
+
+        self.parameters_in_prefix = any('parameters' in tags for cell_type, source, tags in cells[:self.prefix])
+
+        self.magics = []
+        definitions = []
+        for cell_type, source, tags in cells[:self.prefix]:
+            if cell_type == 'code' and 'parameters' not in tags:
+                self.magics += strip_magics(source)[1]
+                definitions.append(definitions_source(source))
+        self.definitions = "\n".join(definitions)
+
+    @property
+    def useful(self):
+        return self.prefix > 0
+
+    def state(self):
+        return read_checkpoint(self.path, self.timeout)
+
+    def save_source(self):
+        return "\n".join([
+                "import nb2workflow.checkpoint as _nb2w_checkpoint",
+                "_nb2w_checkpoint.save_checkpoint(globals(), %s, %s, __import__('os').getcwd(), _nb2w_files)"%(repr(self.path), repr(self.parameter_names)),
+            ])
+
+    def files_source(self):
+        return "\n".join([
+                "import nb2workflow.checkpoint as _nb2w_checkpoint",
+                "_nb2w_files = _nb2w_checkpoint.list_files(__import__('os').getcwd())",
+            ])
+
+    def restore_source(self, parameters_source):
+        return "\n".join(self.magics + [
+                parameters_source if self.parameters_in_prefix else "",
+                self.definitions,
+                "import nb2workflow.checkpoint as _nb2w_checkpoint",
+                "_nb2w_checkpoint.load_checkpoint(globals(), %s, __import__('os').getcwd())"%repr(self.path),
+            ])
@@ -0,0 +1,333 @@
+import os
+import sys
+import ast
+import json
+import base64
+import inspect
+import traceback
+import multiprocessing
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import nbformat
+
+from nb2workflow.nbadapter import notebook_signature
+from nb2workflow import checkpoint, celldeps, logs, partial
+
+logger = logging.getLogger(__name__)
+
+# "auto" runs eligible notebooks in-process, "forkserver" runs them in children forked from a zygote with preloaded modules,
+# "papermill" always uses a kernel
+default_engine = "auto"
+max_workers = None
+
+ipython_names = set(['get_ipython', 'display', 'In', 'Out', 'exit', 'quit'])
+
+
+class NotEligible(Exception):
+    pass
+
+
+def jsonable(value):
+    def default(obj):
+        if isinstance(obj, bytes):
+            return base64.b64encode(obj).decode('ascii')
+        raise TypeError("%s is not JSON serializable"%repr(obj))
+
+    return json.loads(json.dumps(value, default=default))
+
+
+class CompiledNotebook:
+    """
+    notebook compiled into code objects, callable with the parameters cell as signature and returning the declared outputs
+    """
+
+    def __init__(self, notebook_fn, output_names):
+        self.notebook_fn = notebook_fn
+        self.output_names = list(output_names)
+
+        nb = nbformat.reads(open(notebook_fn).read(), as_version=4)
+
+        language = nb.metadata.get('kernelspec', {}).get('language', 'python')
+        if language != 'python':
+            raise NotEligible("notebook kernel language is %s"%language)
+
+        self.cells = []
+        self.recordings = None
+        self.cell_tuples = [(cell.cell_type, cell.source, cell.metadata.get('tags', [])) for cell in nb.cells]
+        self.slices = {}
+        parameters = []
+
+        for i, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code':
+                continue
+
+            try:
+                tree = ast.parse(cell.source)
+            except SyntaxError as e:
+                raise NotEligible("cell %i is not plain python (magics or shell escapes?): %s"%(i, e))
+
+            ipython_references = set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)) & ipython_names
+            if len(ipython_references) > 0:
+                raise NotEligible("cell %i uses IPython names: %s"%(i, ", ".join(sorted(ipython_references))))
+
+            tags = cell.metadata.get('tags', [])
+            is_parameters = 'parameters' in tags
+            if is_parameters:
+                parameters += self.parameters_from_tree(tree)
+
+            self.cells.append(dict(
+                    index=i,
+                    source=cell.source,
+                    is_parameters=is_parameters,
+                    is_outputs='outputs' in tags,
+                    code=compile(tree, "%s:cell-%i"%(notebook_fn, i), 'exec'),
+                ))
+
+        self.signature = inspect.Signature(parameters)
+
+    @staticmethod
+    def parameters_from_tree(tree):
+        parameters = []
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                try:
+                    default = ast.literal_eval(node.value)
+                except (ValueError, TypeError, SyntaxError):
+                    default = inspect.Parameter.empty
+
+                parameters.append(inspect.Parameter(node.targets[0].id, inspect.Parameter.KEYWORD_ONLY, default=default))
+        return parameters
+
+    def error(self, e, exec_count, source):
+        return dict(
+                    exec_count=exec_count,
+                    source=source,
+                    ename=type(e).__name__,
+                    evalue=str(e),
+                    traceback=traceback.format_exception(type(e), e, e.__traceback__),
+                )
+
+    def __call__(self, **parameters):
+        return self.run(parameters)
+
+    def slice(self, outputs):
+        """
+        indices of cells needed for the selected outputs, and the outputs cell code restricted to them
+        """
+        key = tuple(sorted(outputs))
+
+        if key not in self.slices:
+            keep = celldeps.required_cells(self.cell_tuples, outputs)
+
+            outputs_code = {}
+            for cell in self.cells:
+                if cell['is_outputs'] and cell['index'] in keep:
+                    source = celldeps.select_output_lines(cell['source'], outputs)
+                    outputs_code[cell['index']] = compile(source, "%s:cell-%i"%(self.notebook_fn, cell['index']), 'exec')
+
+            self.slices[key] = keep, outputs_code
+
+        return self.slices[key]
+
+    def recording_plan(self):
+        """
+        index of the cell after which each output is final, and the code of its line in the outputs cell
+        """
+        if self.recordings is None:
+            ready = celldeps.output_ready_after(self.cell_tuples, self.output_names)
+
+            self.recordings = []
+            for name in self.output_names:
+                source = "\n".join(celldeps.select_output_lines(cell['source'], [name]) for cell in self.cells if cell['is_outputs'])
+                self.recordings.append((ready[name], name, compile(source, "%s:output-%s"%(self.notebook_fn, name), 'exec')))
+
+        return self.recordings
+
+    def record_ready_outputs(self, pending, index, namespace):
+        for recording in list(pending):
+            ready, name, code = recording
+            if ready > index:
+                continue
+
+            pending.remove(recording)
+            try:
+                exec(code, namespace)
+                partial.record_output(name, jsonable(namespace[name]))
+            except Exception as e:
+                logger.warning("unable to record output %s during execution: %s", name, repr(e))
+
+    def run(self, parameters, checkpoint_plan=None, workdir=".", selected=None, record_partial=False):
+        try:
+            self.signature.bind_partial(**parameters)
+        except TypeError as e:
+            return dict(), self.error(e, 0, "<parameters>")
+
+        if selected is None:
+            output_names = self.output_names
+            keep, outputs_code = None, {}
+        else:
+            output_names = [name for name in self.output_names if name in selected]
+            keep, outputs_code = self.slice(output_names)
+
+        namespace = dict(__name__='__main__')
+        outputs = dict()
+
+        pending = []
+        if record_partial:
+            pending = [recording for recording in self.recording_plan() if recording[1] in output_names]
+
+        start = 0
+        save_before = None
+
+        if checkpoint_plan is not None:
+            state = checkpoint_plan.state()
+
+            if state:
+                logger.info("resuming from checkpoint %s", checkpoint_plan.path)
+
+                if checkpoint_plan.parameters_in_prefix:
+                    for cell in self.cells:
+                        if cell['is_parameters']:
+                            exec(cell['code'], namespace)
+                    namespace.update(parameters)
+
+                exec(compile(checkpoint_plan.definitions, "%s:checkpoint-definitions"%self.notebook_fn, 'exec'), namespace)
+                checkpoint.restore_state(namespace, state, workdir)
+
+                start = checkpoint_plan.prefix
+            elif state is None and keep is None:
+                # a partial run does not produce the complete prefix state
+                files_before = checkpoint.list_files(workdir)
+                save_before = checkpoint_plan.prefix
+
+        for cell in self.cells:
+            if cell['index'] < start or (keep is not None and cell['index'] not in keep):
+                continue
+
+            if save_before is not None and cell['index'] >= save_before:
+                checkpoint.save_checkpoint(namespace, checkpoint_plan.path, checkpoint_plan.parameter_names, workdir, files_before)
+                save_before = None
+
+            try:
+                exec(outputs_code.get(cell['index'], cell['code']), namespace)
+            except Exception as e:
+                return outputs, self.error(e, cell['index'] + 1, cell['source'])
+
+            if cell['is_parameters']:
+                namespace.update(parameters)
+
+            if len(pending) > 0:
+                self.record_ready_outputs(pending, cell['index'], namespace)
+
+        try:
+            for name in output_names:
+                value = namespace[name]
+                outputs[name] = jsonable(value)
+
+                if isinstance(value, str) and os.path.exists(value):
+                    outputs[name+"_content"] = jsonable(base64.b64encode(open(value, 'rb').read()))
+        except Exception as e:
+            return outputs, self.error(e, len(self.cells) + 1, "<output gathering>")
+
+        return outputs, None
+
+
+_compiled = {}
+
+def compile_notebook(notebook_fn, output_names):
+    key = notebook_signature(notebook_fn) + (tuple(output_names),)
+
+    if key not in _compiled:
+        try:
+            _compiled[key] = CompiledNotebook(notebook_fn, output_names)
+        except NotEligible as e:
+            logger.info("notebook %s is not eligible for in-process execution: %s", notebook_fn, e)
+            _compiled[key] = e
+
+    return _compiled[key]
+
+
+def choose_engine(nba):
+    if not hasattr(nba, 'system_parameters'):
+        nba.extract_parameters()
+
+    requested = nba.system_parameters.get('execution_engine', {}).get('default_value', default_engine)
+
+    if requested == "papermill":
+        return "papermill"
+
+    compiled = compile_notebook(nba.notebook_fn, nba.extract_output_declarations().keys())
+    if isinstance(compiled, NotEligible):
+        return "papermill"
+
+    # in-process workers are shared, a job with resource limits gets a child of its own which can be killed
+    if requested == "forkserver" or nba.resource_limits().limited:
+        return "forkserver"
+
+    return "compiled"
+
+
+def run_compiled(notebook_fn, output_names, parameters, workdir, checkpoint_plan=None, outputs=None, record_partial=False):
+    compiled = compile_notebook(notebook_fn, output_names)
+    if isinstance(compiled, NotEligible):
+        raise compiled
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    try:
+        with logs.redirect_output(os.path.join(workdir, logs.job_log_name)):
+            return compiled.run(parameters, checkpoint_plan, workdir, outputs, record_partial)
+    finally:
+        sys.path.remove(workdir)
+        os.chdir(cwd)
+
+
+_pool = None
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        # the service has threads by now, which plain fork does not copy safely: workers are forked from a server process
+        # which only imports the notebook runner and the modules notebooks commonly use
+        from nb2workflow import forkserver
+
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__] + forkserver.preload)
+        _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+    return _pool
+
+
+def start_pool():
+    # starts the workers, and imports the preloaded modules, before the first job
+    return get_pool().submit(os.getpid).result()
+
+
+def worker_pids():
+    """
+    processes of the in-process execution pool, which run jobs in turn
+    """
+    if _pool is None:
+        return set()
+    return set((_pool._processes or {}).keys())
+
+
+def reset_pool():
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = None
+
+
+def execute(notebook_fn, output_names, parameters, workdir, checkpoint_plan=None, outputs=None, record_partial=False):
+    try:
+        return get_pool().submit(run_compiled, notebook_fn, list(output_names), parameters, workdir, checkpoint_plan, outputs, record_partial).result()
+    except BrokenProcessPool:
+        reset_pool()
+        raise
@@ -3,16 +3,16 @@ from __future__ import print_function
 import os
 import argparse
 import json
-import docker
 import shutil
 import tempfile
-import checksumdir
  
 def build_python(dockefile):
     dockerfile.append("RUN yum install -y python")
     dockerfile.append("RUN curl https://bootstrap.pypa.io/get-pip.py | python")
 
 def import_repo(repo_source,target):
+    import checksumdir
+
     print("importing repo",repo_source,"to",target)
     if os.path.isdir(repo_source):
         shutil.copytree(repo_source, target)
@@ -50,6 +50,8 @@ def prepare_image(repo_source,from_image):
 
 
 def build_image(tempdir,tag_image,nb2workflow_revision):
+    import docker
+
     cli=docker.from_env()
     
     print("-- building image, tagging as",tag_image)
@@ -106,6 +108,8 @@ def main():
 
         if args.run:
             
+            import docker
+
             print("running",tag_image,"service on",args.port)
             cli=docker.from_env()
             c=cli.containers.run(
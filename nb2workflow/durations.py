@@ -0,0 +1,96 @@
+import math
+import threading
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DurationStats(object):
+    """
+    durations of the recent jobs of a target, or of a target with some parameter values
+    """
+
+    def __init__(self, window=50):
+        self.samples = collections.deque(maxlen=window)
+        self.n = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.n += 1
+
+    def quantile(self, q):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+    def as_dict(self):
+        return dict(n=self.n, median=self.quantile(0.5), p90=self.quantile(0.9))
+
+
+class DurationModel(object):
+    """
+    expected job durations per target. Targets may be conditioned on some of their parameters, set with the duration_parameters system-parameter:
+    jobs with the same values of these parameters are expected to take as long as the earlier ones, once there are min_samples of them,
+    and as long as the jobs of the target otherwise
+    """
+
+    def __init__(self, window=50, min_samples=3):
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.conditioning = {}
+
+    def condition_on(self, target, parameter_names):
+        if isinstance(parameter_names, str):
+            parameter_names = [name.strip() for name in parameter_names.split(",") if name.strip() != ""]
+
+        with self.lock:
+            if parameter_names:
+                self.conditioning[target] = sorted(parameter_names)
+            else:
+                self.conditioning.pop(target, None)
+
+    def keys(self, target, parameters):
+        keys = [(target, None)]
+
+        names = self.conditioning.get(target, None)
+        if names and parameters is not None:
+            keys.insert(0, (target, tuple((name, repr(parameters.get(name, None))) for name in names)))
+
+        return keys
+
+    def record(self, target, parameters, seconds):
+        if seconds is None:
+            return
+
+        with self.lock:
+            for key in self.keys(target, parameters):
+                self.stats.setdefault(key, DurationStats(self.window)).record(seconds)
+
+    def estimate(self, target, parameters=None, q=0.5):
+        """
+        expected duration in seconds, None for targets without enough recorded jobs
+        """
+        with self.lock:
+            for key in self.keys(target, parameters):
+                stats = self.stats.get(key, None)
+                if stats is not None and len(stats.samples) >= self.min_samples:
+                    return stats.quantile(q)
+
+    def status(self):
+        with self.lock:
+            return dict(
+                        (target, stats.as_dict())
+                        for (target, condition), stats in self.stats.items()
+                        if condition is None
+                    )
+
+
+def retry_after(eta, minimum=1, maximum=60):
+    """
+    seconds pollers should wait before asking again about a job expected to finish in eta seconds
+    """
+    if eta is None:
+        return minimum
+    return int(math.ceil(min(max(eta, minimum), maximum)))
@@ -0,0 +1,381 @@
+import time
+import queue
+import collections
+import threading
+import logging
+
+from nb2workflow import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class JobEvents:
+    """
+    state changes of background jobs, which long-polling and event stream clients wait for
+    """
+
+    terminal = ("done", "failed")
+
+    def __init__(self, ttl=3600):
+        self.condition = threading.Condition()
+        self.jobs = {}
+        # finished jobs are forgotten this long after their last change
+        self.ttl = ttl
+        self.pruned_at = time.time()
+
+    def publish(self, key, status):
+        with self.condition:
+            now = time.time()
+            version = self.jobs.get(key, {}).get('version', 0) + 1
+            self.jobs[key] = dict(status=status, version=version, updated_at=now)
+            self.prune(now)
+            self.condition.notify_all()
+
+    def prune(self, now):
+        if now - self.pruned_at < self.ttl / 10.:
+            return
+        self.pruned_at = now
+
+        for key, job in list(self.jobs.items()):
+            if job['status'] in self.terminal and now - job['updated_at'] > self.ttl:
+                del self.jobs[key]
+
+    def get(self, key):
+        with self.condition:
+            return self.jobs.get(key, None)
+
+    def wait(self, key, since=None, timeout=None):
+        """
+        job state once its version is newer than since, or once the job is finished if since is None;
+        the current state if this does not happen within timeout, None for unknown jobs
+        """
+        def ready():
+            job = self.jobs.get(key, None)
+            if job is None:
+                return True
+            if since is None:
+                return job['status'] in self.terminal
+            return job['version'] > since
+
+        with self.condition:
+            self.condition.wait_for(ready, timeout)
+            return self.jobs.get(key, None)
+
+    def forget(self, key=None):
+        with self.condition:
+            if key is None:
+                self.jobs.clear()
+            else:
+                self.jobs.pop(key, None)
+
+
+default_lane_weights = {"interactive": 8, "async": 4, "scheduled": 2, "test": 1}
+
+
+def parse_lane_weights(spec):
+    """
+    "interactive=8,async=4"
+    """
+    weights = {}
+    for item in spec.split(","):
+        if item.strip() != "":
+            lane, weight = item.split("=")
+            weights[lane.strip()] = float(weight)
+    return weights
+
+
+class Ticket(object):
+    def __init__(self, lane, target, job=None, estimate=None, key=None, gate=None):
+        self.lane = lane
+        self.target = target
+        self.job = job
+        self.estimate = estimate
+        self.key = key
+        self.gate = gate
+        # the job is not selected while its gate is being asked, nor for gate_interval after the gate held it
+        self.gate_open = gate is None
+        self.gate_asked = False
+        self.held_until = 0.
+        self.granted = False
+        self.submitted_at = time.time()
+        self.started_at = None
+
+
+class Lane(object):
+    def __init__(self, weight):
+        self.weight = weight
+        self.waiting = collections.deque()
+        self.served = 0.
+        self.running = 0
+
+    def status(self):
+        return dict(weight=self.weight, waiting=len(self.waiting), running=self.running)
+
+
+class Executor:
+    """
+    runs workflow jobs in at most max_workers slots: background jobs are run by a pool of worker threads,
+    synchronous jobs in the calling thread once they get a slot.
+
+    Jobs wait in lanes; a free slot goes to the waiting lane with the least service relative to its weight,
+    so that interactive calls are not starved by batch or scheduled work. In the lane, it goes to the job expected to be the shortest,
+    less the time it has waited so that long jobs are not postponed indefinitely, among those whose target is below its concurrency limit.
+    Jobs without an expected duration count as default_estimate seconds long.
+
+    Jobs may have a gate, asked when they are selected: jobs it holds keep their place in the lane without taking a slot,
+    and are selected again gate_interval later. Gates may be slow, as admission control sampling the node, and are asked outside the lock
+    """
+
+    def __init__(self, max_workers=4, lane_weights=None, default_estimate=10., gate_interval=1.):
+        self.max_workers = max_workers
+        self.default_estimate = default_estimate
+        self.gate_interval = gate_interval
+        self.redispatch = None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = 0
+        self.workers = []
+        self.events = JobEvents()
+
+        self.lanes = collections.OrderedDict()
+        for lane, weight in (lane_weights or default_lane_weights).items():
+            self.lanes[lane] = Lane(weight)
+
+        self.target_limits = {}
+        self.target_running = {}
+
+        self.running_tickets = set()
+        self.job_tickets = {}
+
+    def set_target_limit(self, target, max_concurrency):
+        with self.condition:
+            if max_concurrency > 0:
+                self.target_limits[target] = max_concurrency
+            else:
+                self.target_limits.pop(target, None)
+
+    def lane(self, name):
+        if name not in self.lanes:
+            self.lanes[name] = Lane(1)
+        return self.lanes[name]
+
+    def _ensure_workers(self):
+        with self.lock:
+            self.workers = [w for w in self.workers if w.is_alive()]
+            while len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _eligible(self, ticket):
+        limit = self.target_limits.get(ticket.target, 0)
+        return limit <= 0 or self.target_running.get(ticket.target, 0) < limit
+
+    def expected_seconds(self, ticket):
+        return self.default_estimate if ticket.estimate is None else ticket.estimate
+
+    def _priority(self, ticket, now):
+        return self.expected_seconds(ticket) - (now - ticket.submitted_at)
+
+    def _next_ticket(self):
+        now = time.time()
+
+        candidates = []
+        for lane in self.lanes.values():
+            eligible = [ticket for ticket in lane.waiting
+                        if not ticket.gate_asked and ticket.held_until <= now and self._eligible(ticket)]
+            if len(eligible) > 0:
+                ticket = min(eligible, key=lambda t: (self._priority(t, now), t.submitted_at))
+                candidates.append((lane.served / lane.weight, ticket.submitted_at, lane, ticket))
+
+        if len(candidates) > 0:
+            return min(candidates, key=lambda c: c[:2])[2:]
+
+    def _dispatch(self):
+        """
+        gives the free slots to waiting jobs; returns the gated jobs selected, whose gates are to be asked with _ask_gates, outside the lock
+        """
+        gated = []
+        while self.running < self.max_workers:
+            selected = self._next_ticket()
+            if selected is None:
+                break
+
+            lane, ticket = selected
+            if not ticket.gate_open:
+                ticket.gate_asked = True
+                gated.append(ticket)
+                continue
+
+            lane.waiting.remove(ticket)
+
+            # lanes which were idle do not bank service they did not use
+            active = [l.served / l.weight for l in self.lanes.values() if l is not lane and (l.waiting or l.running)]
+            if len(active) > 0:
+                lane.served = max(lane.served, min(active) * lane.weight)
+            lane.served += 1
+            lane.running += 1
+
+            self.running += 1
+            self.running_tickets.add(ticket)
+            self.target_running[ticket.target] = self.target_running.get(ticket.target, 0) + 1
+            ticket.granted = True
+            ticket.started_at = time.time()
+
+            if ticket.job is not None:
+                self.queue.put(ticket)
+
+        held = [ticket.held_until for lane in self.lanes.values() for ticket in lane.waiting if ticket.held_until > time.time()]
+        if len(held) > 0:
+            self._dispatch_later(min(held) - time.time())
+
+        self.condition.notify_all()
+        return gated
+
+    def _ask_gates(self, gated):
+        while len(gated) > 0:
+            opened = set()
+            for ticket in gated:
+                try:
+                    if ticket.gate():
+                        opened.add(ticket)
+                except Exception as e:
+                    logger.error("gate of job %s failed, holding it: %s", ticket.key, repr(e))
+
+            with self.condition:
+                for ticket in gated:
+                    ticket.gate_asked = False
+                    if ticket in opened:
+                        ticket.gate_open = True
+                    else:
+                        ticket.held_until = time.time() + self.gate_interval
+
+                gated = self._dispatch()
+
+    def _dispatch_later(self, delay):
+        if self.redispatch is not None:
+            return
+
+        def redispatch():
+            with self.condition:
+                self.redispatch = None
+                gated = self._dispatch()
+            self._ask_gates(gated)
+
+        self.redispatch = threading.Timer(max(0., delay), redispatch)
+        self.redispatch.daemon = True
+        self.redispatch.start()
+
+    def _acquire(self, ticket):
+        with self.condition:
+            if ticket.key is not None:
+                self.job_tickets[ticket.key] = ticket
+            self.lane(ticket.lane).waiting.append(ticket)
+            gated = self._dispatch()
+        self._ask_gates(gated)
+
+    def _release(self, ticket):
+        with self.condition:
+            if self.job_tickets.get(ticket.key, None) is ticket:
+                del self.job_tickets[ticket.key]
+            self.running_tickets.discard(ticket)
+            self.running -= 1
+            self.lane(ticket.lane).running -= 1
+            self.target_running[ticket.target] -= 1
+            gated = self._dispatch()
+        self._ask_gates(gated)
+
+    def _work(self):
+        while True:
+            ticket = self.queue.get()
+            func, args, kwargs, trace_context = ticket.job
+            try:
+                with tracing.start_span("executor.job", trace_context, lane=ticket.lane, queued_seconds=time.time() - ticket.submitted_at):
+                    func(*args, **kwargs)
+            except Exception as e:
+                logger.error("background job %s failed: %s", func, repr(e))
+            finally:
+                self._release(ticket)
+                self.queue.task_done()
+
+    def submit(self, func, *args, lane="async", target=None, estimate=None, key=None, gate=None, **kwargs):
+        self._ensure_workers()
+        # worker threads continue the trace of the submitting request
+        self._acquire(Ticket(lane, target, (func, args, kwargs, tracing.context()), estimate, key, gate))
+
+    def submit_job(self, key, func, *args, lane="async", target=None, estimate=None, gate=None, **kwargs):
+        """
+        background job whose progress is published as events under key
+        """
+        self.events.publish(key, "queued")
+        self.submit(self._run_job, key, func, args, kwargs, lane=lane, target=target, estimate=estimate, key=key, gate=gate)
+
+    def _run_job(self, key, func, args, kwargs):
+        self.events.publish(key, "running")
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            self.events.publish(key, "failed")
+            raise
+        self.events.publish(key, "done")
+
+    def run(self, func, *args, lane="interactive", target=None, estimate=None, **kwargs):
+        """
+        runs func in the calling thread once it gets a slot
+        """
+        ticket = Ticket(lane, target, estimate=estimate)
+
+        with self.condition:
+            self.lane(lane).waiting.append(ticket)
+            gated = self._dispatch()
+        self._ask_gates(gated)
+
+        with self.condition:
+            while not ticket.granted:
+                self.condition.wait()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._release(ticket)
+
+    def eta(self, key):
+        """
+        expected seconds until the job submitted under key finishes, None if it is not known here.
+        A waiting job starts when the running jobs, and the waiting jobs to be started before it, are expected to leave a slot free
+        """
+        with self.condition:
+            ticket = self.job_tickets.get(key, None)
+            if ticket is None:
+                return None
+
+            now = time.time()
+
+            if ticket.started_at is not None:
+                return max(0., self.expected_seconds(ticket) - (now - ticket.started_at))
+
+            backlog = sum(max(0., self.expected_seconds(t) - (now - t.started_at)) for t in self.running_tickets)
+            priority = (self._priority(ticket, now), ticket.submitted_at)
+            backlog += sum(self.expected_seconds(t) for lane in self.lanes.values() for t in lane.waiting
+                           if (self._priority(t, now), t.submitted_at) < priority)
+
+            return backlog / self.max_workers + self.expected_seconds(ticket)
+
+    @property
+    def queued(self):
+        return sum(len(lane.waiting) for lane in self.lanes.values())
+
+    def saturation(self):
+        return float(self.running + self.queued) / self.max_workers
+
+    def status(self):
+        return dict(
+                max_workers=self.max_workers,
+                running=self.running,
+                queued=self.queued,
+                saturation=self.saturation(),
+                lanes=dict((name, lane.status()) for name, lane in self.lanes.items()),
+                target_limits=dict(self.target_limits),
+            )
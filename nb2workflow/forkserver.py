@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
+import shutil
+import tempfile
+import importlib
+import threading
+import traceback
+import subprocess
+import logging
+
+from multiprocessing.connection import Client, Connection
+
+logger = logging.getLogger(__name__)
+
+# modules imported once by the zygote, and shared copy-on-write by the jobs forked from it; missing ones are skipped
+default_preload = ["numpy", "scipy", "astropy", "astropy.io.fits", "astropy.units", "matplotlib", "pandas"]
+
+# jobs running longer are killed, None for no timeout
+timeout = None
+
+
+class ForkserverError(Exception):
+    pass
+
+
+def parse_modules(spec):
+    return [m.strip() for m in spec.split(",") if m.strip() != ""]
+
+
+preload = parse_modules(os.environ.get('NB2WORKFLOW_FORKSERVER_PRELOAD', ",".join(default_preload)))
+
+
+def preload_modules(modules):
+    loaded = []
+    for module in modules:
+        try:
+            importlib.import_module(module)
+            loaded.append(module)
+        except Exception as e:
+            logger.warning("forkserver unable to preload %s: %s", module, repr(e))
+    return loaded
+
+
+def timeout_error(seconds):
+    return dict(
+                exec_count=0,
+                source="<forkserver>",
+                ename="TimeoutError",
+                evalue="job did not finish in %.4g s"%seconds,
+                traceback=[],
+            )
+
+
+def run_job(conn):
+    """
+    runs in a forked child: one job, whose result is sent back over the connection
+    """
+    from nb2workflow import compiled
+
+    request = conn.recv()
+    conn.send(("started", os.getpid()))
+
+    try:
+        result = compiled.run_compiled(**request)
+    except compiled.NotEligible as e:
+        conn.send(("not-eligible", str(e)))
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+    else:
+        conn.send(("done", result))
+
+
+def reap(signum, frame):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+
+
+def serve(address, modules):
+    """
+    the zygote: preloads the modules, then forks a child for each connection. It stays single-threaded, so that forking it is safe,
+    and exits when its parent closes its stdin
+    """
+    # the notebook runner itself is shared by the jobs too
+    from nb2workflow import compiled
+
+    loaded = preload_modules(modules)
+    logger.info("forkserver preloaded %s", ", ".join(loaded))
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(64)
+
+    signal.signal(signal.SIGCHLD, reap)
+
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+
+    while True:
+        readable, _, _ = select.select([listener, sys.stdin], [], [])
+
+        if sys.stdin in readable and os.read(sys.stdin.fileno(), 1024) == b"":
+            return
+
+        if listener in readable:
+            sock, _ = listener.accept()
+
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    listener.close()
+                    # nobody reads the zygote stdout after it is ready
+                    os.dup2(2, 1)
+                    # a process group of its own, to be killed with everything it started
+                    os.setsid()
+                    run_job(Connection(sock.detach()))
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+
+            sock.close()
+
+
+class Zygote(object):
+    def __init__(self, modules=None):
+        self.modules = list(preload if modules is None else modules)
+        self.directory = tempfile.mkdtemp(prefix="nb2workflow-forkserver-")
+        self.address = os.path.join(self.directory, "zygote.sock")
+
+        t0 = time.time()
+        self.process = subprocess.Popen(
+                    [sys.executable, "-m", "nb2workflow.forkserver", self.address, ",".join(self.modules)],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                )
+
+        if self.process.stdout.readline().strip() != b"ready":
+            self.stop()
+            raise ForkserverError("forkserver did not start")
+
+        self.started_seconds = time.time() - t0
+        logger.info("forkserver %i started in %.3f s", self.process.pid, self.started_seconds)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run(self, request, timeout=None):
+        """
+        runs a job in a child forked from the zygote; returns the result of compiled.run_compiled
+        """
+        conn = Client(self.address, family='AF_UNIX')
+        try:
+            conn.send(request)
+
+            try:
+                _, pid = conn.recv()
+            except EOFError:
+                raise ForkserverError("forkserver job exited before it started")
+
+            if not conn.poll(timeout):
+                logger.error("killing forkserver job %i after %s s", pid, timeout)
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                return dict(), timeout_error(timeout)
+
+            try:
+                status, value = conn.recv()
+            except EOFError:
+                raise ForkserverError("forkserver job %i exited without a result"%pid)
+
+            if status == "not-eligible":
+                from nb2workflow.compiled import NotEligible
+                raise NotEligible(value)
+
+            if status == "error":
+                raise ForkserverError("forkserver job %i failed:\n%s"%(pid, value))
+
+            return value
+        finally:
+            conn.close()
+
+
+_zygote = None
+_lock = threading.Lock()
+
+def get_zygote():
+    global _zygote
+
+    with _lock:
+        if _zygote is None or not _zygote.alive():
+            if _zygote is not None:
+                logger.warning("forkserver exited, restarting it")
+                _zygote.stop()
+            _zygote = Zygote()
+
+    return _zygote
+
+
+def start():
+    return get_zygote()
+
+
+def stop():
+    global _zygote
+
+    with _lock:
+        if _zygote is not None:
+            _zygote.stop()
+        _zygote = None
+
+
+def execute(notebook_fn, output_names, parameters, workdir, checkpoint_plan=None, outputs=None, record_partial=False):
+    request = dict(
+                notebook_fn=notebook_fn,
+                output_names=list(output_names),
+                parameters=parameters,
+                workdir=workdir,
+                checkpoint_plan=checkpoint_plan,
+                outputs=outputs,
+                record_partial=record_partial,
+            )
+    return get_zygote().run(request, timeout)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    serve(sys.argv[1], parse_modules(sys.argv[2]) if len(sys.argv) > 2 else preload)
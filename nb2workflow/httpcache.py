@@ -0,0 +1,184 @@
+import zlib
+import itertools
+import hashlib
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# smaller bodies are not worth compressing
+min_compress_size = 1024
+
+gzip_level = 6
+zstd_level = 3
+
+
+def available_encodings():
+    encodings = ["gzip"]
+    if zstandard is not None:
+        encodings.insert(0, "zstd")
+    return encodings
+
+
+def compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=zstd_level).compressobj()
+
+    raise ValueError("unknown encoding %s"%encoding)
+
+
+class ResultBody(object):
+    """
+    result JSON body. Cacheable bodies are encoded once, when the response is made: their chunks are hashed for a strong ETag,
+    compressed and kept, to be sent as they are. Other bodies are streamed as they are encoded, without validators,
+    and without a length unless they turn out to be short.
+    The body is picklable, to be cached with its response.
+    """
+
+    def __init__(self, stream, precompress=False):
+        self.stream = stream
+        self.chunks = None
+        self.digest = None
+        self.size = None
+        self.encoded = {}
+
+        if precompress:
+            self.encode()
+
+    def encode(self):
+        compressors = dict((encoding, compressor(encoding)) for encoding in available_encodings())
+        parts = dict((encoding, []) for encoding in compressors)
+
+        self.chunks = []
+        digest = hashlib.sha256()
+        self.size = 0
+        for chunk in self.stream:
+            self.chunks.append(chunk)
+            digest.update(chunk)
+            self.size += len(chunk)
+            for encoding, c in compressors.items():
+                parts[encoding].append(c.compress(chunk))
+
+        self.digest = digest.hexdigest()
+
+        if self.size >= min_compress_size:
+            for encoding, c in compressors.items():
+                parts[encoding].append(c.flush())
+                self.encoded[encoding] = b"".join(parts[encoding])
+
+    def start(self):
+        """
+        starts streaming a body which was not encoded before: only enough of it is encoded to know whether it is worth compressing
+        """
+        if self.chunks is not None:
+            return
+
+        self.pending = iter(self.stream)
+        self.head = []
+        head_size = 0
+        while head_size < min_compress_size:
+            chunk = next(self.pending, None)
+            if chunk is None:
+                self.size = head_size
+                break
+            self.head.append(chunk)
+            head_size += len(chunk)
+
+    def etag(self, encoding="identity"):
+        if self.digest is None:
+            return None
+
+        # representations in different encodings are not byte-identical, and have distinct strong validators
+        if encoding == "identity":
+            return self.digest
+        return "%s-%s"%(self.digest, encoding)
+
+    def choose_encoding(self, accept_encodings):
+        if self.size is not None and self.size < min_compress_size:
+            return "identity"
+
+        best, best_quality = "identity", 0
+        for encoding in available_encodings():
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+
+        return best
+
+    def iter_chunks(self):
+        if self.chunks is not None:
+            return iter(self.chunks)
+        return itertools.chain(self.head, self.pending)
+
+    def iter_encoded(self, encoding):
+        if encoding == "identity":
+            return self.iter_chunks()
+
+        if encoding in self.encoded:
+            return iter([self.encoded[encoding]])
+
+        return self._compress(encoding)
+
+    def _compress(self, encoding):
+        c = compressor(encoding)
+        for chunk in self.iter_chunks():
+            compressed = c.compress(chunk)
+            if compressed:
+                yield compressed
+        yield c.flush()
+
+    def content_length(self, encoding):
+        if encoding == "identity":
+            return self.size
+        if encoding in self.encoded:
+            return len(self.encoded[encoding])
+
+
+def negotiate(response, request):
+    """
+    sets the validators and the encoding of a result response for this request, or turns it into 304 Not Modified
+    """
+    body = response.result_body
+    cache_timeout = getattr(response, 'cache_timeout', 0)
+
+    body.start()
+    encoding = body.choose_encoding(request.accept_encodings)
+    response.headers.add('Vary', 'Accept-Encoding')
+
+    if response.status_code == 200:
+        etag = body.etag(encoding)
+        if etag is not None:
+            response.set_etag(etag)
+
+        if cache_timeout > 0:
+            response.headers['Cache-Control'] = 'public, max-age=%i'%cache_timeout
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+
+        if etag is not None and request.if_none_match.contains(etag):
+            response.status_code = 304
+            response.response = []
+            response.headers.pop('Content-Length', None)
+            return response
+    else:
+        response.headers['Cache-Control'] = 'no-store'
+
+    response.response = body.iter_encoded(encoding)
+
+    if encoding != "identity":
+        response.headers['Content-Encoding'] = encoding
+
+    length = body.content_length(encoding)
+    if length is not None:
+        response.headers['Content-Length'] = str(length)
+    else:
+        response.headers.pop('Content-Length', None)
+
+    return response
@@ -0,0 +1,63 @@
+import json
+
+
+def select_output(output, fields=None, exclude_content=False):
+    if not isinstance(output, dict):
+        return output
+
+    selected = dict()
+    for k, v in output.items():
+        if k.endswith("_content"):
+            if exclude_content:
+                continue
+            name = k[:-len("_content")]
+        else:
+            name = k
+
+        if fields is not None and name not in fields:
+            continue
+
+        selected[k] = v
+
+    return selected
+
+
+class JSONStream(object):
+    """
+    re-iterable JSON body: nested dictionaries are written member by member, so that at most one member value is encoded in memory at once.
+    It is also picklable, which allows to cache responses which carry it.
+    """
+
+    def __init__(self, obj, cls=json.JSONEncoder, depth=2, chunk_size=64*1024):
+        self.obj = obj
+        self.cls = cls
+        self.depth = depth
+        self.chunk_size = chunk_size
+
+    def _encode(self, obj, encoder, depth):
+        if isinstance(obj, dict) and depth > 0:
+            yield "{"
+            for i, (k, v) in enumerate(obj.items()):
+                yield ("," if i > 0 else "") + encoder.encode(str(k)) + ":"
+                for chunk in self._encode(v, encoder, depth - 1):
+                    yield chunk
+            yield "}"
+        else:
+            yield encoder.encode(obj)
+
+    def __iter__(self):
+        encoder = self.cls()
+
+        buffered = []
+        buffered_size = 0
+        for chunk in self._encode(self.obj, encoder, self.depth):
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+
+            if buffered_size >= self.chunk_size:
+                yield "".join(buffered).encode("utf-8")
+                buffered = []
+                buffered_size = 0
+
+        if len(buffered) > 0:
+            yield "".join(buffered).encode("utf-8")
@@ -0,0 +1,258 @@
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceLimitExceeded(Exception):
+    """
+    raised in place of the notebook error for a job which was killed for exceeding a limit;
+    has the ename and evalue attributes of notebook execution errors
+    """
+
+    def __init__(self, resource, usage, limit, unit):
+        self.resource = resource
+        self.usage = usage
+        self.limit = limit
+        self.unit = unit
+
+        self.ename = type(self).__name__
+        self.evalue = "job exceeded its %s limit: %.4g %s > %.4g %s"%(resource, usage, unit, limit, unit)
+
+        super(ResourceLimitExceeded, self).__init__(self.evalue)
+
+    def as_dict(self):
+        return dict(resource=self.resource, usage=self.usage, limit=self.limit, unit=self.unit)
+
+
+class ResourceLimits(object):
+    """
+    per-target limits, set with the max_memory_mb, max_cpu_seconds, max_wall_seconds and max_output_mb system-parameters; 0 is unlimited
+    """
+
+    system_parameters = dict(
+                memory_mb='max_memory_mb',
+                cpu_seconds='max_cpu_seconds',
+                wall_seconds='max_wall_seconds',
+                output_mb='max_output_mb',
+            )
+
+    def __init__(self, memory_mb=0, cpu_seconds=0, wall_seconds=0, output_mb=0):
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.output_mb = output_mb
+
+    @classmethod
+    def from_system_parameters(cls, system_parameters):
+        return cls(**dict([
+                    (name, system_parameters.get(parameter, {}).get('default_value', 0))
+                    for name, parameter in cls.system_parameters.items()
+                ]))
+
+    @property
+    def limited(self):
+        return any(getattr(self, name) > 0 for name in self.system_parameters)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.system_parameters)
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, filenames in os.walk(path):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for fn in filenames:
+            try:
+                size += os.lstat(os.path.join(root, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class JobMonitor(object):
+    """
+    polls the processes working in a job directory (the kernel, the forkserver child, or the in-process execution worker, and their children),
+    records their peak usage, and kills them when they exceed the limits.
+
+    Kernels are started by papermill, which offers no hook to set rlimits or a cgroup on them, so the job's process tree is found by its working directory instead.
+    The shared processes, in-process execution workers which run other jobs in turn, are accounted from the start of the job and never killed:
+    jobs with limits run in processes of their own.
+    """
+
+    def __init__(self, workdir, limits, poll_interval=0.5, shared_pids=()):
+        self.workdir = workdir
+        self.limits = limits
+        self.poll_interval = poll_interval
+        self.shared_pids = set(shared_pids)
+
+        self.violation = None
+        self.peak_rss = 0
+        self.cpu_baseline = {}
+        self.cpu = {}
+        self.output_size = 0
+        self.started_at = None
+        self.finished_at = None
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def current_workdir(self):
+        workdir = self.workdir() if callable(self.workdir) else self.workdir
+        if workdir is not None:
+            return os.path.realpath(workdir)
+
+    def processes(self, psutil, workdir):
+        job_processes = []
+        for p in psutil.Process().children(recursive=True):
+            try:
+                cwd = os.path.realpath(p.cwd())
+            except (psutil.Error, OSError):
+                continue
+
+            if cwd == workdir or cwd.startswith(workdir + os.sep):
+                job_processes.append(p)
+                try:
+                    job_processes += p.children(recursive=True)
+                except psutil.Error:
+                    pass
+
+        return dict((p.pid, p) for p in job_processes).values()
+
+    def sample(self, psutil):
+        workdir = self.current_workdir()
+        if workdir is None:
+            return [], 0
+
+        processes = self.processes(psutil, workdir)
+
+        rss = 0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+                cpu_times = p.cpu_times()
+            except psutil.Error:
+                continue
+
+            cpu = cpu_times.user + cpu_times.system
+            # processes started for the job have not worked before it
+            self.cpu[p.pid] = max(self.cpu.get(p.pid, 0), cpu - self.cpu_baseline.get(p.pid, 0.))
+
+        self.peak_rss = max(self.peak_rss, rss)
+
+        if self.limits.output_mb > 0:
+            self.output_size = directory_size(workdir)
+
+        return processes, rss
+
+    def check(self, rss):
+        limits = self.limits
+
+        if limits.memory_mb > 0 and rss / 1024. / 1024. > limits.memory_mb:
+            return ResourceLimitExceeded("memory", rss / 1024. / 1024., limits.memory_mb, "MB")
+
+        if limits.cpu_seconds > 0 and self.cpu_seconds > limits.cpu_seconds:
+            return ResourceLimitExceeded("cpu", self.cpu_seconds, limits.cpu_seconds, "s")
+
+        if limits.wall_seconds > 0 and self.wall_seconds > limits.wall_seconds:
+            return ResourceLimitExceeded("wall time", self.wall_seconds, limits.wall_seconds, "s")
+
+        if limits.output_mb > 0 and self.output_size / 1024. / 1024. > limits.output_mb:
+            return ResourceLimitExceeded("output size", self.output_size / 1024. / 1024., limits.output_mb, "MB")
+
+    def take_baseline(self, psutil):
+        """
+        cpu time of the shared processes before the job
+        """
+        for pid in self.shared_pids:
+            try:
+                cpu_times = psutil.Process(pid).cpu_times()
+            except psutil.Error:
+                continue
+            self.cpu_baseline[pid] = cpu_times.user + cpu_times.system
+
+    def kill(self, psutil, processes):
+        for p in processes:
+            if p.pid in self.shared_pids:
+                logger.warning("not killing process %i, shared with other jobs", p.pid)
+                continue
+            try:
+                p.kill()
+            except psutil.Error:
+                pass
+
+    def poll(self, psutil):
+        while True:
+            try:
+                processes, rss = self.sample(psutil)
+
+                violation = self.check(rss)
+                if violation is not None:
+                    logger.error("killing job in %s: %s", self.current_workdir(), violation)
+                    self.violation = violation
+                    self.kill(psutil, processes)
+                    return
+            except Exception as e:
+                logger.error("unable to monitor job resources: %s", repr(e))
+
+            if self.stopped.wait(self.poll_interval):
+                return
+
+    @property
+    def cpu_seconds(self):
+        return sum(self.cpu.values())
+
+    @property
+    def wall_seconds(self):
+        if self.started_at is None:
+            return 0.
+        return (self.finished_at or time.time()) - self.started_at
+
+    def start(self):
+        self.started_at = time.time()
+
+        try:
+            import psutil
+        except ImportError:
+            logger.warning("psutil is not available: job resource usage is not monitored")
+            return
+
+        self.take_baseline(psutil)
+
+        self.thread = threading.Thread(target=self.poll, args=(psutil,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.finished_at = time.time()
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+        workdir = self.current_workdir()
+        if workdir is not None and os.path.isdir(workdir):
+            self.output_size = directory_size(workdir)
+
+        # outputs written between the last poll and the end of the job
+        if self.violation is None and self.limits.output_mb > 0 and self.output_size / 1024. / 1024. > self.limits.output_mb:
+            self.violation = ResourceLimitExceeded("output size", self.output_size / 1024. / 1024., self.limits.output_mb, "MB")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def usage(self):
+        return dict(
+                    peak_rss_mb=self.peak_rss / 1024. / 1024.,
+                    cpu_seconds=self.cpu_seconds,
+                    wall_seconds=self.wall_seconds,
+                    output_mb=self.output_size / 1024. / 1024.,
+                    limits=self.limits.as_dict(),
+                    violation=self.violation.as_dict() if self.violation is not None else None,
+                )
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import contextlib
+import logging
+
+max_payload_chars = int(os.environ.get('NB2WORKFLOW_LOG_MAX_PAYLOAD', 1000))
+
+# kernel and in-process execution output of a job, in its job directory
+job_log_name = "job-output.log"
+
+
+class Truncated(object):
+    """
+    log argument which is converted to text, and cut to a limited length, only if the record is emitted
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        limit = max_payload_chars if self.limit is None else self.limit
+
+        if len(text) > limit:
+            return "%s... [%i chars]"%(text[:limit], len(text))
+        return text
+
+    __repr__ = __str__
+
+
+def payload(value, limit=None):
+    return Truncated(value, limit)
+
+
+class Fields(object):
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join("%s=%s"%(k, Truncated(v)) for k, v in sorted(self.fields.items()))
+
+
+def log_event(logger, level, event, **fields):
+    """
+    structured record: the event name and its fields, which the JSON formatter emits as separate keys
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", event, Fields(fields), extra=dict(event=event, fields=fields))
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        from nb2workflow import tracing
+
+        entry = dict(
+                    time=record.created,
+                    level=record.levelname,
+                    logger=record.name,
+                    message=record.getMessage(),
+                )
+
+        if hasattr(record, 'event'):
+            entry['event'] = record.event
+            entry['fields'] = dict((k, v if isinstance(v, (int, float, bool, type(None))) else str(Truncated(v)))
+                                   for k, v in record.fields.items())
+
+        span = tracing.current_span()
+        if span is not None:
+            entry['trace_id'] = span.trace_id
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    keeps a fraction of the records up to level (INFO by default), and all the more severe ones
+    """
+
+    def __init__(self, rate=None, level=logging.INFO):
+        super(SamplingFilter, self).__init__()
+        self.rate = float(os.environ.get('NB2WORKFLOW_LOG_SAMPLE_RATE', 1.)) if rate is None else rate
+        self.level = level
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class LogStats(object):
+    """
+    time spent formatting and writing log records, in total and in the current thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.records = 0
+        self.seconds = 0.
+
+    def add(self, seconds):
+        with self.lock:
+            self.records += 1
+            self.seconds += seconds
+        self.local.seconds = self.thread_seconds() + seconds
+
+    def thread_seconds(self):
+        return getattr(self.local, 'seconds', 0.)
+
+    def status(self):
+        return dict(records=self.records, seconds=self.seconds)
+
+
+stats = LogStats()
+
+
+class MeasuredStreamHandler(logging.StreamHandler):
+    def emit(self, record):
+        t0 = time.time()
+        try:
+            super(MeasuredStreamHandler, self).emit(record)
+        finally:
+            stats.add(time.time() - t0)
+
+
+class JobOutputCapture(logging.Filter):
+    """
+    diverts records of the papermill logger, which carry the kernel output, to the log file of the job executing in the same thread
+    """
+
+    def __init__(self):
+        super(JobOutputCapture, self).__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        f = getattr(self.local, 'file', None)
+        if f is None:
+            return True
+
+        f.write(record.getMessage() + "\n")
+        return False
+
+
+_job_output = None
+
+
+@contextlib.contextmanager
+def capture_job_output(path):
+    global _job_output
+
+    if _job_output is None:
+        _job_output = JobOutputCapture()
+        logging.getLogger('papermill').addFilter(_job_output)
+
+    with open(path, "a") as f:
+        _job_output.local.file = f
+        try:
+            yield f
+        finally:
+            _job_output.local.file = None
+
+
+@contextlib.contextmanager
+def redirect_output(path):
+    """
+    stdout and stderr of in-process execution, which runs one job at a time per worker process
+    """
+    with open(path, "a") as f:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = f, f
+        try:
+            yield f
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
@@ -1,21 +1,218 @@
 from ast import literal_eval
 import os
+import copy
+import json
 import sys
 import glob
 import re
-import time
 import tempfile
+import contextlib
 import subprocess
 
-import papermill as pm
 import nbformat
 
 import logging
+
+from nb2workflow import tracing, logs, blobstore, partial
 logger=logging.getLogger(__name__)
 
-def cast_parameter(x,par):
-    logger.debug("cast %s %s",x,par)
-    return par['python_type'](x)
+xsd_prefix = "http://www.w3.org/2001/XMLSchema#"
+
+def parse_bool(x):
+    if isinstance(x, bool):
+        return x
+
+    if isinstance(x, (int, float)) and x in (0, 1):
+        return bool(x)
+
+    s = str(x).strip().lower()
+    if s in ("true", "t", "yes", "y", "on", "1"):
+        return True
+    if s in ("false", "f", "no", "n", "off", "0"):
+        return False
+
+    raise ValueError("can not interpret %s as boolean"%repr(x))
+
+def parse_int(x):
+    if isinstance(x, bool):
+        raise ValueError("expected integer, got boolean %s"%repr(x))
+
+    if isinstance(x, int):
+        return x
+
+    if isinstance(x, float):
+        if x.is_integer():
+            return int(x)
+        raise ValueError("expected integer, got %s"%repr(x))
+
+    return int(str(x).strip())
+
+def parse_float(x):
+    if isinstance(x, bool):
+        raise ValueError("expected number, got boolean %s"%repr(x))
+
+    if isinstance(x, (int, float)):
+        return float(x)
+
+    return float(str(x).strip())
+
+def parse_str(x):
+    if isinstance(x, str):
+        return x
+
+    if isinstance(x, (int, float)) and not isinstance(x, bool):
+        return str(x)
+
+    raise ValueError("expected string, got %s"%repr(x))
+
+def parse_any(x):
+    if isinstance(x, str):
+        try:
+            return json.loads(x)
+        except ValueError:
+            return x
+    return x
+
+def structured_parser(python_type):
+    def parse_structured(x):
+        if isinstance(x, str):
+            try:
+                x = json.loads(x)
+            except ValueError:
+                x = literal_eval(x.strip())
+
+        if python_type is tuple and isinstance(x, list):
+            x = tuple(x)
+
+        if not isinstance(x, python_type):
+            raise ValueError("expected %s, got %s"%(python_type.__name__, repr(x)))
+
+        return x
+    return parse_structured
+
+def fallback_parser(python_type):
+    def parse_fallback(x):
+        return python_type(x)
+    return parse_fallback
+
+owl_type_parsers = {
+    xsd_prefix+"bool": parse_bool,
+    xsd_prefix+"boolean": parse_bool,
+    xsd_prefix+"int": parse_int,
+    xsd_prefix+"integer": parse_int,
+    xsd_prefix+"long": parse_int,
+    xsd_prefix+"float": parse_float,
+    xsd_prefix+"double": parse_float,
+    xsd_prefix+"decimal": parse_float,
+    xsd_prefix+"str": parse_str,
+    xsd_prefix+"string": parse_str,
+}
+
+def choose_parser(python_type, owl_type=None):
+    if owl_type in owl_type_parsers:
+        return owl_type_parsers[owl_type]
+
+    if issubclass(python_type, bool):
+        return parse_bool
+
+    if issubclass(python_type, int):
+        return parse_int
+
+    if issubclass(python_type, float):
+        return parse_float
+
+    if issubclass(python_type, str):
+        return parse_str
+
+    if issubclass(python_type, (list, dict, tuple)):
+        return structured_parser(python_type)
+
+    if python_type is type(None):
+        return parse_any
+
+    return fallback_parser(python_type)
+
+
+class CompiledParameter:
+    __slots__ = ['name', 'python_type', 'owl_type', 'default_value', 'parse']
+
+    def __init__(self, name, python_type, owl_type, default_value):
+        self.name = name
+        self.python_type = python_type
+        self.owl_type = owl_type
+        self.default_value = default_value
+        self.parse = choose_parser(python_type, owl_type)
+
+
+class ParameterSchema:
+    """
+    request parameter validation compiled once from the notebook parameters cell
+    """
+
+    def __init__(self, parameters):
+        self.parameters = dict([
+                (name, CompiledParameter(name, p['python_type'], p['owl_type'], p['default_value']))
+                for name, p in parameters.items()
+            ])
+
+    def interpret(self, parameters):
+        request_parameters = dict()
+        unexpected_parameters = []
+        invalid_parameters = []
+        missing_blobs = []
+
+        for arg, value in parameters.items():
+            if arg.startswith("_"): continue
+
+            p = self.parameters.get(arg, None)
+            if p is None:
+                unexpected_parameters.append(arg)
+                continue
+
+            try:
+                request_parameters[arg] = p.parse(value)
+            except (ValueError, TypeError, SyntaxError) as e:
+                invalid_parameters.append("%s=%s (%s)"%(arg, repr(value), e))
+                continue
+
+            digest = blobstore.parse_reference(request_parameters[arg])
+            if digest is not None and not blobstore.get_store().exists(digest):
+                missing_blobs.append("%s=%s"%(arg, value))
+
+        issues=[]
+
+        if len(unexpected_parameters)>0:
+            issues+=["found unexpected request parameters: "+(", ".join(unexpected_parameters))]
+
+        if len(invalid_parameters)>0:
+            issues+=["found invalid request parameter values: "+(", ".join(invalid_parameters))]
+
+        if len(missing_blobs)>0:
+            issues+=["found references to blobs which were not uploaded: "+(", ".join(missing_blobs))]
+
+        return dict(
+                        issues=issues,
+                        request_parameters=request_parameters,
+                    )
+
+
+_compiled_schemas = {}
+_checkpoint_plans = {}
+
+def notebook_signature(notebook_fn):
+    st = os.stat(notebook_fn)
+    return (os.path.realpath(notebook_fn), st.st_mtime, st.st_size)
+
+def compile_parameter_schema(nba):
+    signature = notebook_signature(nba.notebook_fn)
+
+    schema = _compiled_schemas.get(signature, None)
+    if schema is None:
+        logger.debug("compiling parameter schema for %s",nba.notebook_fn)
+        schema = ParameterSchema(nba.extract_parameters())
+        _compiled_schemas[signature] = schema
+
+    return schema
 
 def understand_comment_references(comment):
     logger.debug("treating comment %s",comment)
@@ -121,12 +318,46 @@ class InputParameter:
                 )
 
 
+class OutputNotReady(Exception):
+    pass
+
+
+def write_notebook_atomically(nb, fn):
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".ipynb")
+    with os.fdopen(fd, "w") as f:
+        nbformat.write(nb, f)
+    os.rename(tmp_fn, fn)
+
+
 class NotebookAdapter:
+    # set by the execution engine once the complete output is available
+    output_ready = False
+
     def __init__(self,notebook_fn):
         self.notebook_fn = notebook_fn
         self.name = notebook_short_name(notebook_fn)
+        self._parsed = None
         logger.debug("notebook adapter for %s",notebook_fn)
-        logger.debug(self.extract_parameters())
+
+    def job_adapter(self):
+        """
+        adapter for one execution of the notebook, sharing the notebook parsed for this one
+        """
+        nba = NotebookAdapter(self.notebook_fn)
+        self.parsed_notebook()
+        nba._parsed = self._parsed
+        return nba
+
+    def parsed_notebook(self):
+        """
+        the notebook, parsed again only when it changes; shared with the job adapters, to be copied before it is modified
+        """
+        signature = notebook_signature(self.notebook_fn)
+
+        if self._parsed is None or self._parsed[0] != signature:
+            self._parsed = (signature, nbformat.reads(open(self.notebook_fn).read(), as_version=4))
+
+        return self._parsed[1]
 
     def new_tmpdir(self):
         self._tmpdir = tempfile.mkdtemp()
@@ -146,8 +377,17 @@ class NotebookAdapter:
     def output_notebook_fn(self):
         return os.path.join(self.tmpdir,os.path.basename(self.notebook_fn.replace(".ipynb","_output.ipynb")))
 
+    @property
+    def job_log_fn(self):
+        return os.path.join(self.tmpdir, logs.job_log_name)
+
+    @property
+    def partial_output_notebook_fn(self):
+        # papermill rewrites the output notebook after every cell; readers only ever see the complete one, renamed into place
+        return os.path.join(self.tmpdir,os.path.basename(self.notebook_fn.replace(".ipynb","_output.partial.ipynb")))
+
     def extract_parameters(self):
-        nb=nbformat.reads(open(self.notebook_fn).read(), as_version=4)
+        nb = self.parsed_notebook()
 
         input_parameters = {}
         system_parameters = {}
@@ -171,73 +411,167 @@ class NotebookAdapter:
 
         return input_parameters
     
+    @property
+    def parameter_schema(self):
+        return compile_parameter_schema(self)
+
     def interpret_parameters(self,parameters):
-        expected_parameters=self.extract_parameters()
-        request_parameters=dict()
+        return self.parameter_schema.interpret(parameters)
 
-        unexpected_parameters=[]
-        for arg in parameters:
-            if arg.startswith("_"): continue
+    @property
+    def execution_engine(self):
+        from nb2workflow import compiled
+        return compiled.choose_engine(self)
 
-            logger.info("request arg %s",parameters[arg])
-            if arg in expected_parameters:
-                request_parameters[arg]=cast_parameter(parameters.get(arg),expected_parameters.get(arg))
-                logger.info("request arg %s provided as %s",parameters[arg],request_parameters[arg])
-            else:
-                unexpected_parameters.append(arg)
+    def resource_limits(self):
+        from nb2workflow.limits import ResourceLimits
 
-        issues=[]
+        if not hasattr(self, 'system_parameters'):
+            self.extract_parameters()
 
-        if len(unexpected_parameters)>0:
-            issues+=["found unexpected request parameters: "+(", ".join(unexpected_parameters))]
-            
-        return dict(
-                        issues=issues,
-                        request_parameters=request_parameters,
-                    )
+        return ResourceLimits.from_system_parameters(self.system_parameters)
+
+    def execute(self, parameters, progress_bar = True, log_output = True, outputs = None, on_output = None):
+        """
+        with on_output, each output is also recorded as soon as it is final, and passed to on_output(name, value) during the execution
+        """
+        from nb2workflow import compiled
+        from nb2workflow.limits import JobMonitor
+
+        monitor = JobMonitor(lambda: getattr(self, '_tmpdir', None), self.resource_limits(), shared_pids=compiled.worker_pids())
 
-    def execute(self, parameters, progress_bar = True, log_output = True):
-        exceptions = self._execute(parameters, progress_bar, log_output)
+        record_partial = on_output is not None
+        watcher = partial.PartialOutputWatcher(lambda: getattr(self, '_tmpdir', None), on_output) if record_partial else contextlib.nullcontext()
+
+        try:
+            with tracing.start_span("notebook.execute", notebook=self.name, engine=self.execution_engine) as span, monitor, watcher:
+                exceptions = self._execute_with_engine(parameters, progress_bar, log_output, outputs, monitor, record_partial)
+                span.set_attribute("exceptions", len(exceptions))
+        except Exception:
+            if monitor.violation is None:
+                raise
+
+        self.resource_usage = monitor.usage()
+        logger.info("job resource usage: %s", self.resource_usage)
+
+        if monitor.violation is not None:
+            e = monitor.violation
+            return [[e, e.args]]
 
         return exceptions
 
-    def _execute(self, parameters, progress_bar = True, log_output = True):
+    def _execute_with_engine(self, parameters, progress_bar, log_output, outputs, monitor, record_partial=False):
+        from nb2workflow.compiled import NotEligible
+
+        if self.execution_engine in ("compiled", "forkserver"):
+            try:
+                return self._execute_compiled(parameters, outputs, record_partial)
+            except NotEligible as e:
+                # other failures are the job's: running it again in a kernel would repeat its work and its side effects
+                logger.warning("notebook is not eligible for in-process execution, falling back to papermill: %s", e)
+
+        return self._execute(parameters, progress_bar, log_output, outputs, record_partial)
+
+    def _execute_compiled(self, parameters, outputs = None, record_partial = False):
+        from nb2workflow import compiled, forkserver
+
+        engine = self.execution_engine
+        execute = forkserver.execute if engine == "forkserver" else compiled.execute
+
+        tmpdir = self.provision_workdir()
+        parameters = self.link_inputs(parameters, tmpdir)
+
+        with tracing.start_span("compiled.execute", engine=engine):
+            output, error = execute(self.notebook_fn, self.extract_output_declarations().keys(), parameters, tmpdir, self.checkpoint_plan(), outputs, record_partial)
+
+        self._compiled_output = output
+        self.output_ready = True
+
+        self.write_compiled_output_notebook(parameters, error)
+
+        if error is not None:
+            from papermill.exceptions import PapermillExecutionError
+
+            e = PapermillExecutionError(**error)
+            logger.info(e)
+            return [[e, e.args]]
+
+        return []
+
+    def write_compiled_output_notebook(self, parameters, error):
+        """
+        output notebook of an in-process execution, for its trace: the notebook with the parameters, and the error in the failed cell.
+        Cell outputs are not captured, they are in the job log
+        """
+        nb = copy.deepcopy(self.parsed_notebook())
+
+        if error is not None and 0 < error['exec_count'] <= len(nb.cells):
+            nb.cells[error['exec_count'] - 1].outputs = [
+                    nbformat.v4.new_output("error", ename=error['ename'], evalue=error['evalue'], traceback=error['traceback']),
+                ]
+
+        injected = nbformat.v4.new_code_cell(source="\n".join(["# Parameters"] + ["%s = %s"%(k, repr(v)) for k, v in parameters.items()]))
+        injected.metadata['tags'] = ['injected-parameters']
+
+        position = next((i + 1 for i, cell in enumerate(nb.cells) if 'parameters' in cell.metadata.get('tags', [])), 0)
+        nb.cells.insert(position, injected)
+
+        nbformat.write(nb, self.partial_output_notebook_fn)
+        os.rename(self.partial_output_notebook_fn, self.output_notebook_fn)
+
+    def provision_workdir(self):
         tmpdir = self.new_tmpdir()
         logger.info("new tmpdir: %s", tmpdir)
 
-        logger.info(subprocess.check_output(["git","clone",os.path.dirname(os.path.realpath(self.notebook_fn)), tmpdir]))
+        with tracing.start_span("provision_workdir", tmpdir=tmpdir):
+            logger.info(subprocess.check_output(["git","clone",os.path.dirname(os.path.realpath(self.notebook_fn)), tmpdir]))
 
-        self.inject_output_gathering()
-        exceptions = []
+        return tmpdir
 
-        #    original = sys.stdout
+    def link_inputs(self, parameters, tmpdir):
+        """
+        uploaded blobs referred to by the parameters are hard-linked into the job directory, and the notebook gets their paths
+        """
+        if not any(blobstore.parse_reference(value) is not None for value in parameters.values()):
+            return parameters
 
-        ntries = 10
-        while ntries > 0:
-            try:
+        with tracing.start_span("link_inputs"):
+            return blobstore.get_store().link_inputs(parameters, tmpdir)
+
+    def _execute(self, parameters, progress_bar = True, log_output = True, outputs = None, record_partial = False):
+        import papermill as pm
+
+        tmpdir = self.provision_workdir()
+        parameters = self.link_inputs(parameters, tmpdir)
+
+        self.inject_output_gathering(outputs, record_partial)
+        exceptions = []
+
+        try:
+            # with log_output, the kernel output goes to the job log rather than to the service log
+            with tracing.start_span("papermill.execute"), logs.capture_job_output(self.job_log_fn):
                 pm.execute_notebook(
                    self.preproc_notebook_fn,
-                   self.output_notebook_fn,
+                   self.partial_output_notebook_fn,
                    parameters = parameters,
                    progress_bar = progress_bar,
                    log_output = log_output,
                    cwd = tmpdir, 
                 )
-            except pm.PapermillExecutionError as e:
-                exceptions.append([e,e.args])
-                logger.info(e)
-                logger.info(e.args)
-            except nbformat.reader.NotJSONError:
-                ntries -= 1
-                logger.info("retrying...", ntries)
-                time.sleep(2)
-                continue   
-
-            break
+        except pm.PapermillExecutionError as e:
+            exceptions.append([e,e.args])
+            logger.info(e)
+            logger.info(e.args)
+
+        # papermill has written the complete notebook, also when it raises an execution error
+        os.rename(self.partial_output_notebook_fn, self.output_notebook_fn)
+        self.output_ready = True
 
         return exceptions
 
     def extract_pm_output(self):
+        import papermill as pm
+
         nb = pm.read_notebook(self.output_notebook_fn)
 
         outputs=dict()
@@ -250,7 +584,7 @@ class NotebookAdapter:
 
     
     def extract_output_declarations(self):
-        nb=nbformat.reads(open(self.notebook_fn).read(), as_version=4)
+        nb = self.parsed_notebook()
 
         outputs = {}
 
@@ -264,11 +598,122 @@ class NotebookAdapter:
         return outputs 
 
     def extract_output(self):
-        return self.extract_pm_output()
+        if not self.output_ready:
+            raise OutputNotReady("no complete output for %s: the notebook was not executed, or its execution was interrupted"%self.notebook_fn)
+
+        if getattr(self, '_compiled_output', None) is not None:
+            return self._compiled_output
 
-    def inject_output_gathering(self):
+        with tracing.start_span("extract_output"):
+            return self.extract_pm_output()
+
+    def checkpoint_plan(self):
+        if not hasattr(self, 'system_parameters'):
+            self.extract_parameters()
+
+        timeout = self.system_parameters.get('checkpoint_timeout', {}).get('default_value', 0)
+        if timeout <= 0:
+            return None
+
+        signature = notebook_signature(self.notebook_fn)
+        if signature not in _checkpoint_plans:
+            from nb2workflow.checkpoint import CheckpointPlan
+
+            nb = self.parsed_notebook()
+            cells = [(cell.cell_type, cell.source, cell.metadata.get('tags', [])) for cell in nb.cells]
+
+            plan = CheckpointPlan(self.notebook_fn, cells, self.parameter_schema.parameters.keys(), timeout)
+            logger.info("notebook %s has %i parameter-independent leading cells", self.notebook_fn, plan.prefix)
+
+            _checkpoint_plans[signature] = plan if plan.useful else None
+
+        return _checkpoint_plans[signature]
+
+    def required_cells(self, cells, outputs):
+        from nb2workflow.celldeps import required_cells
+
+        keep = required_cells([(cell.cell_type, cell.source, cell.metadata.get('tags', [])) for cell in cells], outputs)
+        logger.info("outputs %s need %i of %i cells", ", ".join(outputs), len(keep), len(cells))
+
+        return keep
+
+    def select_cells(self, cells, outputs, keep, start=0):
+        from nb2workflow.celldeps import slice_cells
+
+        if outputs is None:
+            return cells
+
+        return slice_cells(cells, outputs, keep, start)
+
+    def apply_checkpoint_plan(self, cells, plan, outputs=None, keep=None):
+        state = plan.state()
+
+        if state is False:
+            return self.select_cells(cells, outputs, keep)
+
+        if state is None:
+            if outputs is not None:
+                # a partial run does not produce the complete prefix state
+                return self.select_cells(cells, outputs, keep)
+
+            files_cell = nbformat.v4.new_code_cell(source=plan.files_source())
+            files_cell.metadata['tags'] = ['injected-checkpoint-files']
+
+            save_cell = nbformat.v4.new_code_cell(source=plan.save_source())
+            save_cell.metadata['tags'] = ['injected-checkpoint-save']
+
+            return [files_cell] + cells[:plan.prefix] + [save_cell] + cells[plan.prefix:]
+
+        logger.info("resuming from checkpoint %s", plan.path)
+
+        parameters_source = "\n".join([cell.source for cell in cells[:plan.prefix] if 'parameters' in cell.metadata.get('tags', [])])
+
+        restore_cell = nbformat.v4.new_code_cell(source=plan.restore_source(parameters_source))
+        if plan.parameters_in_prefix:
+            restore_cell.metadata['tags'] = ['parameters', 'injected-checkpoint-restore']
+        else:
+            restore_cell.metadata['tags'] = ['injected-checkpoint-restore']
+
+        return [restore_cell] + self.select_cells(cells[plan.prefix:], outputs, keep, plan.prefix)
+
+    def inject_output_recording(self, cells, selected_cells, outputs):
+        """
+        selected cells with, after the last cell each output depends on, a cell recording it.
+        Papermill injects the parameters after the parameters cell, so outputs are not recorded right after it
+        """
+        from nb2workflow.celldeps import output_ready_after, select_output_lines
+
+        tags = [cell.metadata.get('tags', []) for cell in cells]
+        ready = output_ready_after([(cell.cell_type, cell.source, cell_tags) for cell, cell_tags in zip(cells, tags)], outputs)
+
+        outputs_source = "\n".join(cell.source for cell, cell_tags in zip(cells, tags) if 'outputs' in cell_tags)
+        index = dict((id(cell), i) for i, cell in enumerate(cells))
+
+        pending = sorted(outputs, key=lambda name: ready[name])
+        recorded_cells = []
+
+        for cell in selected_cells:
+            recorded_cells.append(cell)
+
+            i = index.get(id(cell), None)
+            if i is None or cell.cell_type != 'code' or 'parameters' in tags[i] or 'outputs' in tags[i]:
+                continue
+
+            for name in [name for name in pending if ready[name] <= i]:
+                pending.remove(name)
+
+                record_cell = nbformat.v4.new_code_cell(source=partial.recording_source(select_output_lines(outputs_source, [name]), name))
+                record_cell.metadata['tags'] = ['injected-record-output']
+                recorded_cells.append(record_cell)
+
+        return recorded_cells
+
+    def inject_output_gathering(self, selected_outputs=None, record_partial=False):
         outputs = self.extract_output_declarations()
 
+        if selected_outputs is not None:
+            outputs = dict([(k, v) for k, v in outputs.items() if k in selected_outputs])
+
         output_gather_content="""
 import papermill as pm
 import base64
@@ -287,12 +732,30 @@ import os
         newcell = nbformat.v4.new_code_cell(source=output_gather_content)
         newcell.metadata['tags'] = ['injected-gather-outputs']
 
-        nb=nbformat.reads(open(self.notebook_fn).read(), as_version=4)
+        nb = copy.deepcopy(self.parsed_notebook())
+        cells = nb.cells
+
+        keep = None
+        if selected_outputs is not None:
+            keep = self.required_cells(nb.cells, selected_outputs)
+
+        plan = self.checkpoint_plan()
+        if plan is not None:
+            nb.cells = self.apply_checkpoint_plan(nb.cells, plan, selected_outputs, keep)
+        else:
+            nb.cells = self.select_cells(nb.cells, selected_outputs, keep)
+
+        if record_partial:
+            nb.cells = self.inject_output_recording(cells, nb.cells, outputs.keys())
+
         nb.cells = nb.cells + [newcell] 
 
-        pm.iorw.write_ipynb(nb, self.preproc_notebook_fn)
+        write_notebook_atomically(nb, self.preproc_notebook_fn)
 
     def get_system_parameter_value(self, name, default):
+        if not hasattr(self, 'system_parameters'):
+            self.extract_parameters()
+
         if name in self.system_parameters:
             return self.system_parameters.pop(name)['default_value'] 
 
@@ -3,15 +3,28 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-import owlready2
-    
-xsd = owlready2.get_ontology("https://www.w3.org/2001/XMLSchema#").load()
-kees = owlready2.get_ontology("http://linkeddata.center/kees/v1#").load()
+_ontologies = {}
+
+def ontologies():
+    """
+    the ontologies are fetched over the network, when the semantic signature is first needed rather than at import
+    """
+    import owlready2
+
+    if len(_ontologies) == 0:
+        xsd = owlready2.get_ontology("https://www.w3.org/2001/XMLSchema#").load()
+        kees = owlready2.get_ontology("http://linkeddata.center/kees/v1#").load()
+
+        fno = owlready2.get_ontology("http://ontology.odahub.io/function.rdf").load()
+        fno.base_iri="https://w3id.org/function/ontology#"
 
-fno = owlready2.get_ontology("http://ontology.odahub.io/function.rdf").load()
-fno.base_iri="https://w3id.org/function/ontology#"
+        _ontologies.update(xsd=xsd, kees=kees, fno=fno)
+
+    return _ontologies
 
 def get_dda():
+    import owlready2
+
     return owlready2.get_ontology("http://ddahub.io/ontology/analysis#")
 
 
@@ -34,6 +47,8 @@ def to_xsd_type(p):
 
 
 def function_semantic_signature(dda, function_name, parameters, output):
+    fno = ontologies()['fno']
+
     with dda:
         parameter_attrs={}
         for pn,pv in parameters.items():
@@ -60,6 +75,8 @@ def function_semantic_signature(dda, function_name, parameters, output):
     
 
 def service_semantic_signature(nbas):
+    fno = ontologies()['fno']
+
     dda = get_dda()
     dda.graph.destroy()
     dda = get_dda()
@@ -0,0 +1,116 @@
+import os
+import json
+import base64
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# outputs recorded during execution, as JSON lines in the job directory
+partial_outputs_name = "partial-outputs.jsonl"
+
+
+def encode(obj):
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
+    return repr(obj)
+
+
+def record_output(name, value, path=partial_outputs_name):
+    """
+    records an output as soon as it is final; called in the job process, whose working directory is the job directory.
+    As in the complete outputs, a value which is the name of an existing file also gives its content
+    """
+    records = [dict(name=name, value=value)]
+    if isinstance(value, str) and os.path.exists(value):
+        records.append(dict(name=name+"_content", value=base64.b64encode(open(value, 'rb').read())))
+
+    with open(path, "a") as f:
+        f.write("".join(json.dumps(record, default=encode) + "\n" for record in records))
+        f.flush()
+
+
+def read_outputs(path, offset=0):
+    """
+    outputs recorded after offset, and the offset to read the next ones from; an incomplete last line is left for later
+    """
+    outputs = dict()
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line.decode('utf-8'))
+                outputs[record['name']] = record['value']
+                offset += len(line)
+    except (IOError, OSError):
+        pass
+
+    return outputs, offset
+
+
+def recording_source(output_line, name):
+    """
+    code of a cell recording an output, injected in notebooks executed by papermill; kernels without nb2workflow do not record it
+    """
+    return "\n".join([
+                output_line,
+                "try:",
+                "    import nb2workflow.partial as _nb2workflow_partial",
+                "except ImportError:",
+                "    pass",
+                "else:",
+                "    _nb2workflow_partial.record_output(%s, %s)"%(repr(name), name),
+            ])
+
+
+class PartialOutputWatcher(object):
+    """
+    follows the outputs recorded by a job, calling callback(name, value) for each of them
+    """
+
+    def __init__(self, workdir, callback, poll_interval=0.5):
+        self.workdir = workdir
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.path = None
+        self.offset = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def current_path(self):
+        workdir = self.workdir() if callable(self.workdir) else self.workdir
+        if workdir is not None:
+            return os.path.join(workdir, partial_outputs_name)
+
+    def check(self):
+        path = self.current_path()
+        if path is None:
+            return
+
+        # a job falling back to another engine starts over in a new directory
+        if path != self.path:
+            self.path, self.offset = path, 0
+
+        outputs, self.offset = read_outputs(path, self.offset)
+        for name, value in outputs.items():
+            try:
+                self.callback(name, value)
+            except Exception as e:
+                logger.error("unable to publish partial output %s: %s", name, repr(e))
+
+    def poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.check()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.poll)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stopped.set()
+        self.thread.join()
+        self.check()
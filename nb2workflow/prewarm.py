@@ -0,0 +1,162 @@
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# defaults of the service command line too
+default_top_n = 3
+default_lead_time = 60
+default_max_concurrent_refreshes = 1
+
+
+def parameter_set_key(args):
+    return tuple(sorted(args))
+
+
+class TargetStats:
+    def __init__(self, cache_timeout, max_tracked):
+        self.cache_timeout = cache_timeout
+        self.max_tracked = max_tracked
+        self.counts = {}
+        self.computed_at = {}
+
+    def record_access(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+        if len(self.counts) > self.max_tracked:
+            least_used = min(self.counts, key=self.counts.get)
+            self.counts.pop(least_used)
+            self.computed_at.pop(least_used, None)
+
+    def decay(self, factor):
+        for key in list(self.counts):
+            self.counts[key] *= factor
+            if self.counts[key] < 0.01:
+                self.counts.pop(key)
+                self.computed_at.pop(key, None)
+
+    def top(self, n):
+        return sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+
+
+class Prewarmer:
+    """
+    keeps the most requested parameter sets of each cached target warm:
+    their results are recomputed in background shortly before they expire, while the old entry is still served
+    """
+
+    def __init__(self, refresh, top_n=default_top_n, lead_time=default_lead_time, max_concurrent_refreshes=default_max_concurrent_refreshes,
+                 half_life=3600, max_tracked=1000):
+        self.refresh = refresh
+        self.top_n = top_n
+        self.lead_time = lead_time
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+
+        self.targets = {}
+        self.refreshing = set()
+        self.refresh_budget = threading.BoundedSemaphore(max_concurrent_refreshes)
+        self.lock = threading.Lock()
+        self.last_decay = time.time()
+
+    def register(self, target, cache_timeout):
+        if cache_timeout <= 0:
+            logger.debug("target %s is cached without expiry, not prewarming", target)
+            return
+
+        with self.lock:
+            self.targets[target] = TargetStats(cache_timeout, self.max_tracked)
+
+    def record_access(self, target, args):
+        with self.lock:
+            if target in self.targets:
+                self.targets[target].record_access(parameter_set_key(args))
+
+    def record_computed(self, target, args, now=None):
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            if target in self.targets:
+                self.targets[target].computed_at[parameter_set_key(args)] = now
+
+    def lead(self, stats):
+        return min(self.lead_time, stats.cache_timeout * 0.5)
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+
+        due = []
+        with self.lock:
+            for target, stats in self.targets.items():
+                for key in stats.top(self.top_n):
+                    computed_at = stats.computed_at.get(key, None)
+                    if computed_at is None:
+                        continue
+
+                    if (target, key) in self.refreshing:
+                        continue
+
+                    if now >= computed_at + stats.cache_timeout - self.lead(stats):
+                        due.append((target, key))
+        return due
+
+    def decay(self, now=None):
+        if now is None:
+            now = time.time()
+
+        if self.half_life <= 0:
+            return
+
+        factor = 0.5 ** ((now - self.last_decay) / self.half_life)
+        self.last_decay = now
+
+        with self.lock:
+            for stats in self.targets.values():
+                stats.decay(factor)
+
+    def tick(self, now=None):
+        self.decay(now)
+
+        submitted = []
+        for target, key in self.due(now):
+            if not self.refresh_budget.acquire(blocking=False):
+                logger.info("refresh budget exhausted, postponing remaining prewarming")
+                break
+
+            with self.lock:
+                self.refreshing.add((target, key))
+
+            logger.info("prewarming %s with %s", target, key)
+
+            thread = threading.Thread(target=self._refresh, args=(target, key))
+            thread.daemon = True
+            thread.start()
+
+            submitted.append((target, key))
+
+        return submitted
+
+    def _refresh(self, target, key):
+        try:
+            self.refresh(target, key)
+        except Exception as e:
+            logger.error("failed to prewarm %s with %s: %s", target, key, repr(e))
+        finally:
+            with self.lock:
+                self.refreshing.discard((target, key))
+            self.refresh_budget.release()
+
+    def summary(self):
+        with self.lock:
+            return dict([
+                    (target, dict(
+                        cache_timeout=stats.cache_timeout,
+                        tracked=len(stats.counts),
+                        top=[dict(parameters=key, weight=stats.counts[key], computed_at=stats.computed_at.get(key, None))
+                             for key in stats.top(self.top_n)],
+                    ))
+                    for target, stats in self.targets.items()
+                ])
@@ -1,11 +1,16 @@
+import os
 import re
+import atexit
+import signal
+import threading
 import consul
 
 import logging
 
 logger = logging.getLogger('nb2workflow.publish')
 
-def publish(upstream_url, name, service_host, service_port):
+
+def parse_upstream_url(upstream_url):
     r = re.match("(.*?)://(.*?)(?:$|:)(\d*)",upstream_url)
     if r:
         scheme, host, port = r.groups()
@@ -13,17 +18,154 @@ def publish(upstream_url, name, service_host, service_port):
         r = re.match("(.*?)(?:$|:)(\d*)",upstream_url)
         scheme = "http"
         host, port = r.groups()
-    
+
     if port == "":
         port = 8500
     else:
         port = int(port)
 
-    cc = consul.Consul(host = host, scheme = scheme, port = port)
+    return scheme, host, port
+
+
+def health_state(saturation, warn_saturation):
+    if saturation >= 1:
+        return "critical"
+
+    if saturation >= warn_saturation:
+        return "warning"
+
+    return "passing"
+
+
+class ConsulPublisher:
+    """
+    registers all service targets through one consul client, keeps their health checks up to date and deregisters them on shutdown
+    """
+
+    def __init__(self, upstream_url, service_host, service_port, check="ttl", ttl=30, saturation=None, warn_saturation=0.8, tags=None):
+        scheme, host, port = parse_upstream_url(upstream_url)
+
+        self.client = consul.Consul(host = host, scheme = scheme, port = port)
+
+        self.service_host = service_host
+        self.service_port = service_port
+        self.check = check
+        self.ttl = ttl
+        self.saturation = saturation
+        self.warn_saturation = warn_saturation
+
+        if tags is None:
+            tags = ["nb2service", "traefik.protocol=https"]
+        self.tags = tags
+
+        self.registered = []
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._previous_sigterm = None
+
+    def service_id(self, name):
+        return "%s:%s:%i"%(name, self.service_host, self.service_port)
+
+    def check_spec(self):
+        if self.check == "ttl":
+            return consul.Check.ttl("%is"%self.ttl)
+
+        if self.check == "http":
+            return consul.Check.http("http://%s:%i/health"%(self.service_host, self.service_port), "%is"%max(1, self.ttl//3), timeout="%is"%max(1, self.ttl//3))
+
+        return None
+
+    def register_all(self, names):
+        check = self.check_spec()
+
+        for name in names:
+            service_id = self.service_id(name)
 
-    logger.debug("found services: %s",cc.agent.services())
+            logger.debug("will publish %s as %s:%s", name, self.service_host, self.service_port)
 
-    logger.debug("will publish as %s",service_host, service_port)
-    
-    cc.agent.service.register(name, address = service_host, port = service_port, tags = ["nb2service", "traefik.protocol=https"])
+            self.client.agent.service.register(name,
+                                               service_id = service_id,
+                                               address = self.service_host,
+                                               port = self.service_port,
+                                               tags = self.tags,
+                                               check = check)
+            self.registered.append(service_id)
 
+        logger.info("published %i targets with %s check", len(names), self.check)
+
+        if self.check == "ttl":
+            self.report_health()
+
+    def report_health(self):
+        if self.saturation is None:
+            saturation = 0.
+        else:
+            saturation = self.saturation()
+
+        state = health_state(saturation, self.warn_saturation)
+        notes = "executor saturation %.3lg"%saturation
+
+        update = dict(
+                    passing = self.client.agent.check.ttl_pass,
+                    warning = self.client.agent.check.ttl_warn,
+                    critical = self.client.agent.check.ttl_fail,
+                )[state]
+
+        for service_id in self.registered:
+            update("service:"+service_id, notes=notes)
+
+        return state
+
+    def _beat(self):
+        while not self._stop.wait(max(1, self.ttl/3.)):
+            try:
+                self.report_health()
+            except Exception as e:
+                logger.error("unable to report health to consul: %s", repr(e))
+
+    def start(self):
+        if self.check == "ttl" and self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._beat)
+            self._heartbeat.daemon = True
+            self._heartbeat.start()
+
+        atexit.register(self.shutdown)
+
+        # atexit handlers do not run when the process is terminated by a signal, as orchestrators stop services
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM, self.terminate)
+
+    def terminate(self, signum, frame):
+        logger.info("terminated, deregistering targets")
+        self.shutdown()
+
+        previous = self._previous_sigterm
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def deregister_all(self):
+        # also called at exit, after a termination signal did it
+        if len(self.registered) == 0:
+            return
+
+        for service_id in self.registered:
+            try:
+                self.client.agent.service.deregister(service_id)
+            except Exception as e:
+                logger.error("unable to deregister %s: %s", service_id, repr(e))
+
+        logger.info("deregistered %i targets", len(self.registered))
+        self.registered = []
+
+    def shutdown(self):
+        self._stop.set()
+        self.deregister_all()
+
+
+def publish(upstream_url, name, service_host, service_port):
+    publisher = ConsulPublisher(upstream_url, service_host, service_port, check=None)
+    publisher.register_all([name])
+    return publisher
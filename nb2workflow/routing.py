@@ -0,0 +1,279 @@
+import os
+import time
+import random
+import threading
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+class NoEndpointAvailable(Exception):
+    pass
+
+
+class EndpointUnavailable(Exception):
+    """
+    raised by request functions to count an answer as an endpoint failure
+    """
+
+
+class Endpoint(object):
+    """
+    one place a workflow can be evaluated, with passive health derived from the outcome of requests sent to it,
+    and a circuit breaker which stops sending requests after consecutive failures until reset_timeout has passed
+    """
+
+    def __init__(self, router, location=None, weight=1., failure_threshold=3, reset_timeout=30., alpha=0.2):
+        self.router = router
+        self.location = location
+        self.weight = weight
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.alpha = alpha
+
+        self.outstanding = 0
+        self.latency = None
+        self.error_rate = 0.
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def name(self):
+        if self.location is None:
+            return self.router
+        return "%s:%s"%(self.router, self.location)
+
+    def args(self):
+        if self.location is None:
+            return ()
+        return (self.location,)
+
+    @property
+    def circuit(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def available(self):
+        circuit = self.circuit
+        return circuit == "closed" or (circuit == "half-open" and not self.trial)
+
+    def begin(self):
+        self.outstanding += 1
+        if self.circuit == "half-open":
+            self.trial = True
+
+    def end(self, latency, ok):
+        self.outstanding -= 1
+
+        self.latency = latency if self.latency is None else (1 - self.alpha) * self.latency + self.alpha * latency
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (0. if ok else 1.)
+
+        if ok:
+            self.consecutive_failures = 0
+            self.opened_at = None
+        else:
+            self.consecutive_failures += 1
+            if self.trial or self.consecutive_failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    logger.warning("opening circuit of %s after %i consecutive failures", self.name, self.consecutive_failures)
+                self.opened_at = time.time()
+
+        self.trial = False
+
+    def health_weight(self):
+        return self.weight * max(0.05, 1. - self.error_rate) / max(0.01, self.latency if self.latency is not None else 1.)
+
+    def status(self):
+        return dict(
+                    name=self.name,
+                    weight=self.weight,
+                    outstanding=self.outstanding,
+                    latency=self.latency,
+                    error_rate=self.error_rate,
+                    circuit=self.circuit,
+                )
+
+
+def parse_routes(routes):
+    """
+    WORKFLOW_ROUTES format: comma separated workflow=router[:location][*weight]; a workflow may be listed several times
+    """
+    table = {}
+    for route in routes.split(","):
+        if "=" not in route:
+            continue
+
+        workflow, spec = route.split("=", 1)
+
+        weight = 1.
+        if "*" in spec:
+            spec, weight = spec.rsplit("*", 1)
+            weight = float(weight)
+
+        if ":" in spec:
+            router, location = spec.split(":", 1)
+        else:
+            router, location = spec, None
+
+        table.setdefault(workflow.strip(), []).append((router.strip(), location, weight))
+    return table
+
+
+class RoutingTable(object):
+    """
+    endpoints of each workflow, chosen by health-weighted random selection ("weighted") or by fewest requests in flight ("least-outstanding").
+    With hedge_after, a request which is not answered in this many seconds is repeated at another endpoint, and the first answer wins.
+    """
+
+    strategies = ("weighted", "least-outstanding")
+
+    def __init__(self, routes=None, staging=(), strategy="weighted", hedge_after=None, failure_threshold=3, reset_timeout=30., rng=None):
+        if strategy not in self.strategies:
+            raise ValueError("unknown routing strategy %s, expected one of %s"%(strategy, ", ".join(self.strategies)))
+
+        self.strategy = strategy
+        self.hedge_after = hedge_after
+        self.staging = set(staging)
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+        self.hedge_pool = None
+
+        self.routes = {}
+        for workflow, endpoints in (routes or {}).items():
+            for router, location, weight in endpoints:
+                self.routes.setdefault(workflow, []).append(
+                    Endpoint(router, location, weight, failure_threshold=failure_threshold, reset_timeout=reset_timeout))
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        hedge_after = environ.get('WORKFLOW_HEDGE_AFTER', '')
+
+        return cls(
+                    routes=parse_routes(environ.get('WORKFLOW_ROUTES', '')),
+                    staging=[w for w in environ.get('STAGING_WORKFLOWS', '').split(',') if w != ''],
+                    strategy=environ.get('WORKFLOW_ROUTING_STRATEGY', 'weighted'),
+                    hedge_after=float(hedge_after) if hedge_after != '' else None,
+                    failure_threshold=int(environ.get('WORKFLOW_FAILURE_THRESHOLD', 3)),
+                    reset_timeout=float(environ.get('WORKFLOW_RESET_TIMEOUT', 30)),
+                )
+
+    def endpoints(self, workflow):
+        return self.routes.get(workflow, [])
+
+    def endpoint(self, workflow, router, location):
+        for endpoint in self.endpoints(workflow):
+            if endpoint.router == router and endpoint.location == location:
+                return endpoint
+
+    def select(self, workflow, exclude=(), router=None):
+        with self.lock:
+            candidates = [e for e in self.endpoints(workflow)
+                          if e.available() and e not in exclude and (router is None or e.router == router)]
+
+            if len(candidates) == 0:
+                return None
+
+            if self.strategy == "least-outstanding":
+                return min(candidates, key=lambda e: (e.outstanding / e.weight, e.latency or 0.))
+
+            weights = [e.health_weight() for e in candidates]
+            x = self.rng.uniform(0, sum(weights))
+            for endpoint, weight in zip(candidates, weights):
+                x -= weight
+                if x <= 0:
+                    return endpoint
+            return candidates[-1]
+
+    def reroute(self, router, args, kwargs):
+        workflow = args[0]
+
+        if len(self.endpoints(workflow)) > 0:
+            endpoint = self.select(workflow)
+            if endpoint is None:
+                raise NoEndpointAvailable("no endpoint available for workflow %s: %s"%(
+                        workflow, ", ".join("%(name)s is %(circuit)s"%e.status() for e in self.endpoints(workflow))))
+
+            return endpoint.router, endpoint.args() + tuple(args), kwargs
+
+        if workflow in self.staging:
+            return router+"-staging", args, kwargs
+
+        return router, args, kwargs
+
+    def timed(self, endpoint, send):
+        if endpoint is None:
+            return send(endpoint)
+
+        with self.lock:
+            endpoint.begin()
+
+        t0 = time.time()
+        try:
+            r = send(endpoint)
+        except Exception:
+            with self.lock:
+                endpoint.end(time.time() - t0, False)
+            raise
+
+        with self.lock:
+            endpoint.end(time.time() - t0, True)
+        return r
+
+    def call(self, workflow, endpoint, send):
+        """
+        send(endpoint) with health accounting, hedged at a second endpoint if enabled; send signals endpoint failure by raising
+        """
+        if endpoint is None or self.hedge_after is None or len(self.endpoints(workflow)) < 2:
+            return self.timed(endpoint, send)
+
+        with self.lock:
+            if self.hedge_pool is None:
+                self.hedge_pool = ThreadPoolExecutor(max_workers=16)
+
+        first = self.hedge_pool.submit(self.timed, endpoint, send)
+
+        done, pending = wait([first], timeout=self.hedge_after)
+        if len(done) > 0:
+            return first.result()
+
+        second_endpoint = self.select(workflow, exclude=[endpoint], router=endpoint.router)
+        if second_endpoint is None:
+            return first.result()
+
+        logger.info("%s did not answer in %lg s, hedging with %s", endpoint.name, self.hedge_after, second_endpoint.name)
+
+        pending = set([first, self.hedge_pool.submit(self.timed, second_endpoint, send)])
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+
+        raise error
+
+    def status(self):
+        return dict(
+                    strategy=self.strategy,
+                    hedge_after=self.hedge_after,
+                    staging=sorted(self.staging),
+                    routes=dict((workflow, [e.status() for e in endpoints]) for workflow, endpoints in self.routes.items()),
+                )
+
+
+_routing_table = None
+
+def routing_table():
+    global _routing_table
+
+    if _routing_table is None:
+        _routing_table = RoutingTable.from_environ()
+
+    return _routing_table
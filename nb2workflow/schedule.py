@@ -1,10 +1,10 @@
 import time
 import atexit
 
-from apscheduler.schedulers.background import BackgroundScheduler
-
 
 def schedule_callable(f, interval):
+    from apscheduler.schedulers.background import BackgroundScheduler
+
     scheduler = BackgroundScheduler()
     scheduler.add_job(func=f, trigger="interval", seconds=interval)
     scheduler.start()
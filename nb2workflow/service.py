@@ -1,5 +1,8 @@
 from __future__ import print_function
 
+# first, so that the imports of the service can be profiled
+from nb2workflow.startup import profile as startup_profile
+
 import os
 import json
 import glob
@@ -11,12 +14,12 @@ import base64
 import hashlib
 import datetime
 import tempfile
-import nbformat
+import traceback
 
 from io import BytesIO
 
 
-from flask import Flask, make_response, jsonify, request, url_for, send_file, Response
+from flask import Flask, make_response, jsonify, request, url_for, send_file, Response, g
 from flask.json import JSONEncoder
 from flask_caching import Cache
 from flask_cors import CORS
@@ -31,13 +34,22 @@ import threading
 
 dictConfig({
     'version': 1,
-    'formatters': {'default': {
-        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
+    'formatters': {
+        'default': {
+            'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
+        },
+        'json': {
+            '()': 'nb2workflow.logs.JSONFormatter',
+        },
+    },
+    'filters': {'sample': {
+        '()': 'nb2workflow.logs.SamplingFilter',
     }},
     'handlers': {'wsgi': {
-        'class': 'logging.StreamHandler',
+        'class': 'nb2workflow.logs.MeasuredStreamHandler',
   #      'stream': 'ext://flask.logging.wsgi_errors_stream',
-        'formatter': 'default'
+        'formatter': os.environ.get('NB2WORKFLOW_LOG_FORMAT', 'default'),
+        'filters': ['sample'],
     }},
     'root': {
         'level': 'INFO',
@@ -47,8 +59,15 @@ dictConfig({
 
 verify_tls = False
 
-from nb2workflow.nbadapter import NotebookAdapter, find_notebooks
-from nb2workflow import ontology, publish, schedule
+from nb2workflow.nbadapter import find_notebooks, notebook_signature
+from nb2workflow import schedule, compiled, forkserver, trace, tracing, logs, httpcache, blobstore, prewarm
+from nb2workflow.prewarm import Prewarmer
+from nb2workflow.executor import Executor, default_lane_weights, parse_lane_weights
+from nb2workflow.admission import AdmissionController, Overloaded
+from nb2workflow.durations import DurationModel, retry_after
+from nb2workflow.workqueue import open_queue, QueueConsumer
+from nb2workflow.jsonstream import JSONStream, select_output
+from nb2workflow.nbadapter import parse_bool
     
 logger=logging.getLogger('nb2workflow.service')
 
@@ -82,12 +101,43 @@ class CustomJSONEncoder(LazyJSONEncoder):
             return list(iterable)
         return JSONEncoder.default(self, obj)
 
+class ResultJSONEncoder(json.JSONEncoder):
+    """
+    plain encoder of the bodies serialised outside of flask: results, documents and events
+    """
+    def default(self, obj):
+        if isinstance(obj, LazyString):
+            return str(obj)
+        if isinstance(obj, type):
+            return dict(type_object=repr(obj))
+        try:
+            iterable = iter(obj)
+        except TypeError:
+            pass
+        else:
+            return list(iterable)
+        return json.JSONEncoder.default(self, obj)
+
+def stream_json(obj, status=200):
+    return Response(JSONStream(obj, cls=ResultJSONEncoder), status=status, mimetype='application/json')
+
+def result_response(obj, status=200, cache_timeout=0):
+    """
+    workflow result, whose validators and encoding are chosen per request, after the response cache
+    """
+    body = httpcache.ResultBody(JSONStream(obj, cls=ResultJSONEncoder), precompress=status == 200 and cache_timeout > 0)
+
+    response = Response(body.stream, status=status, mimetype='application/json')
+    response.result_body = body
+    response.cache_timeout = cache_timeout
+    return response
+
 cache = Cache(config={'CACHE_TYPE': 'simple'})
 
 def create_app():
     app=Flask(__name__)
     template = dict(swaggerUiPrefix=LazyString(lambda : request.environ.get('HTTP_X_FORWARDED_PREFIX', '')))
-    swagger = Swagger(app, template=template)
+    app.swagger = Swagger(app, template=template)
     app.wsgi_app = ReverseProxied(app.wsgi_app)
     app.json_encoder = CustomJSONEncoder
     cache.init_app(app, config={'CACHE_TYPE': 'simple'})
@@ -98,149 +148,351 @@ def create_app():
 app = create_app()
 
 app.async_workflows = dict()
+app.partial_outputs = dict()
 app.started_at = datetime.datetime.now()
+app.cached_views = dict()
+app.target_specs = dict()
+app.cache_timeouts = dict()
+app.documents = dict()
+app.notebook_set_checked = None
+app.executor = Executor()
+app.admission = AdmissionController(app.executor)
+app.durations = DurationModel()
+app.work_queue = None
+app.profile_startup = False
+
+@app.before_request
+def begin_request_span():
+    # continues the trace of the calling workflow, if it sent one
+    g.span = tracing.begin_span("service.request",
+                                tracing.parse_traceparent(request.headers.get('traceparent', None)),
+                                method=request.method, path=request.path)
+    g.log_seconds = logs.stats.thread_seconds()
 
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,traceparent')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Trace-Id')
+
+    if hasattr(response, 'result_body'):
+        response = httpcache.negotiate(response, request)
+
+    span = getattr(g, 'span', None)
+    if span is not None:
+        span.set_attribute('status_code', response.status_code)
+        response.headers['X-Trace-Id'] = span.trace_id
+        response.headers['traceparent'] = span.traceparent()
+
+    if startup_profile.request_served() and app.profile_startup:
+        logger.info(startup_profile.report())
+
+    if hasattr(g, 'log_seconds'):
+        log_seconds = logs.stats.thread_seconds() - g.log_seconds
+        response.headers.add('Server-Timing', 'log;dur=%.3f'%(log_seconds * 1000))
+        if span is not None:
+            span.set_attribute('log_seconds', log_seconds)
     return response
 
+@app.teardown_request
+def end_request_span(exc):
+    span = getattr(g, 'span', None)
+    if span is not None:
+        tracing.end_span(span, exc)
+
 def make_key():
     """Make a key that includes GET parameters."""
     return request.full_path
 
 
-class AsyncWorkflow(threading.Thread):
-    def __init__(self, key, target, params):
+class AsyncWorkflow(object):
+    def __init__(self, key, target, params, outputs=None, trace_context=None, lane="async"):
         self.key = key
         self.target = target
         self.params = params
-        super(AsyncWorkflow, self).__init__()
+        self.outputs = outputs
+        self.trace_context = trace_context
+        self.lane = lane
 
     def run(self):
         try:
-            self._run()
+            result = self._run()
         except Exception as e:
-            print("failed",e)
+            logger.exception("async job %s failed: %s", self.key, repr(e))
+            # the executor publishes the job as failed, and the next request for it submits it again
+            app.async_workflows[self.key] = failed_job_result(e.__class__.__name__, str(e), traceback.format_exc())
+            raise
+        else:
+            logger.info("updating key %s",self.key)
+            app.async_workflows[self.key] = result
 
     def _run(self):
+        try:
+            with tracing.start_span("async.job", self.trace_context, key=self.key, target=self.target, lane=self.lane):
+                return self._run_traced()
+        finally:
+            # reserved by the admission gate, when the executor started the job
+            app.admission.release(self.key)
+
+    def record_output(self, name, value):
+        """
+        outputs finished during the execution are published to status and event stream clients
+        """
+        outputs = app.partial_outputs.setdefault(self.key, {})
+        outputs[name] = value
+
+        if app.work_queue is not None:
+            app.queue_consumer.progress(self.key, outputs)
+        else:
+            app.executor.events.publish(self.key, "running")
+
+    def _run_traced(self):
         template_nba = app.notebook_adapters.get(self.target)
 
-        nba = NotebookAdapter(template_nba.notebook_fn)
+        nba = template_nba.job_adapter()
 
-        exceptions = nba.execute(self.params['request_parameters'])
+        try:
+            exceptions = nba.execute(self.params['request_parameters'], outputs=self.outputs, on_output=self.record_output)
+        finally:
+            app.partial_outputs.pop(self.key, None)
 
-        logger.info("exceptions: %s",repr(exceptions))
+        app.admission.record(self.target, nba.resource_usage)
+        record_duration(self.target, self.params['request_parameters'], nba.resource_usage)
+        trace.render_in_background(nba.output_notebook_fn, failed=len(exceptions) > 0)
 
         if len(exceptions)>0:
             output='incomplete'
-            logger.error("exceptions: %s",repr(exceptions))
+            logs.log_event(logger, logging.WARNING, "async job failed", key=self.key, target=self.target, exceptions=exceptions)
         else:
-            nretry=10
-            while nretry>0:
-                try:
-                    output=nba.extract_output()
-                    logger.info("completed, output length %s",len(output))
-                    if len(output) == 0:
-                        logger.debug("output from notebook is empty, something failed, attempts left:", nretry)
-                    else:
-                        break
-                except Exception as e:
-                    logger.debug("output notebook incomplte or does not exist", e, "attempts left:", nretry)
-                except nbformat.reader.NotJSONError as e:
-                    logger.debug("output notebook incomplte", e, "attempts left:", nretry)
-
-                nretry-=1
-                time.sleep(1)
-
-        logger.error("output: %s",output)
-        
-        logger.info("updating key %s",self.key)
-        app.async_workflows[self.key] = dict(output=output, exceptions=list(map(serialize_workflow_exception, exceptions)), jobdir=nba.tmpdir)
+            output=nba.extract_output()
+            logs.log_event(logger, logging.INFO, "async job done", key=self.key, target=self.target, outputs=len(output))
+
+        logger.debug("output: %s", logs.payload(output))
+
+        return dict(output=output, exceptions=list(map(serialize_workflow_exception, exceptions)), jobdir=nba.tmpdir, resource_usage=nba.resource_usage)
+
+
+def run_queued_job(key, job):
+    return AsyncWorkflow(key=key, **job)._run()
+
+
+def admission_gate(key, target):
+    """
+    background jobs are held in their executor lane while the node is under pressure, and start with a reservation under their key
+    """
+    deferred_since = time.time()
+    return lambda: app.admission.reserve_when_ready(target, key, deferred_since)
+
+
+def record_duration(target, parameters, resource_usage):
+    # jobs killed for exceeding their limits did not run their course
+    if resource_usage is not None and resource_usage.get('violation', None) is None:
+        app.durations.record(target, parameters, resource_usage['wall_seconds'])
+
+
+def estimate_duration(target, params):
+    return app.durations.estimate(target, params.get('request_parameters', None))
+
+
+def failed_job_result(ename, evalue, edump=""):
+    """
+    result of an async job which did not run its course
+    """
+    return dict(output='incomplete', exceptions=[dict(ename=ename, evalue=evalue, edump=edump)], jobdir=None)
+
+
+def job_failed(key):
+    job = job_events().get(key) or {}
+    return job.get('status', None) == "failed"
+
+
+def job_events():
+    if app.work_queue is not None:
+        return app.work_queue
+    return app.executor.events
+
+
+def get_async_value(key):
+    """
+    result of an async job, 'started' if it is not finished, None if it is not known
+    """
+    if app.work_queue is None:
+        return app.async_workflows.get(key, None)
+
+    job = app.work_queue.get(key)
+    if job is None:
+        return None
+
+    if job['status'] == "done":
+        return app.work_queue.result(key)
+
+    if job['status'] == "failed":
+        return app.work_queue.result(key) or failed_job_result("WorkerFailure", job['error'])
+
+    return 'started'
+
+
+def get_partial_output(key):
+    """
+    outputs of an unfinished async job recorded so far
+    """
+    if app.work_queue is not None:
+        return app.work_queue.partial(key)
+    return app.partial_outputs.get(key, None)
+
+
+def submit_async(key, target, params, outputs=None, lane="async"):
+    if app.work_queue is not None:
+        # jobs may run in another instance, which continues the trace of the submitting request
+        app.work_queue.put(key, dict(target=target, params=params, outputs=outputs, trace_context=tracing.context(), lane=lane))
+    else:
+        app.async_workflows[key]='started'
+        app.executor.submit_job(key, AsyncWorkflow(key=key, target=target, params=params, outputs=outputs, lane=lane).run,
+                                lane=lane, target=target, estimate=estimate_duration(target, params), gate=admission_gate(key, target))
+
+
+def get_request_parameters():
+    parameters = request.args.to_dict()
+
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            parameters.update(body)
+
+    return parameters
+
+
+def get_output_selection(parameters):
+    fields = parameters.get('_fields', None)
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(",") if f.strip() != ""]
+
+    exclude_content = parse_bool(parameters.get('_exclude_content', False))
+
+    return dict(fields=fields, exclude_content=exclude_content)
+
+
+def get_output_subset(parameters, declared_outputs):
+    """
+    outputs requested with _outputs, which are the only ones computed; None if all are
+    """
+    outputs = parameters.get('_outputs', None)
+    if outputs is None:
+        return None
+
+    if isinstance(outputs, str):
+        outputs = [o.strip() for o in outputs.split(",") if o.strip() != ""]
+
+    unknown = [o for o in outputs if o not in declared_outputs]
+    if len(unknown) > 0:
+        raise ValueError("unknown outputs %s; declared outputs: %s"%(", ".join(unknown), ", ".join(declared_outputs)))
+
+    return sorted(set(outputs))
+
+
+def overloaded_response(e):
+    response = make_response(jsonify(issues=["service overloaded: %s"%e.reason], retry_after=e.retry_after), 503)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
 
 
 def workflow(target, background=False, async_request=False):
     issues = []
 
-    async_request = request.args.get('_async_request', async_request)
+    if background:
+        parameters = dict()
+    else:
+        parameters = get_request_parameters()
+        logger.debug("raw parameters %s",parameters)
+
+    async_request = parameters.get('_async_request', async_request)
     
     logger.debug("target %s",target)
 
-    if not background:
-        logger.debug("raw parameters %s",request.args)
-
     template_nba = app.notebook_adapters.get(target)
-    nba = NotebookAdapter(template_nba.notebook_fn)
 
-    if nba is None:
+    if template_nba is None:
         issues.append("target not known: %s; available targets: %s"%(target,app.notebook_adapters.keys()))
-    else:
-        if not background:
-            interpreted_parameters = nba.interpret_parameters(request.args)
-            issues += interpreted_parameters['issues']
-        else:
-            interpreted_parameters = dict(request_parameters=[])
+        return make_response(jsonify(issues=issues), 400)
+
+    interpreted_parameters = template_nba.interpret_parameters(parameters)
+    issues += interpreted_parameters['issues']
 
     logger.debug("interpreted parameters %s",interpreted_parameters)
 
+    try:
+        output_selection = get_output_selection(parameters)
+        outputs = get_output_subset(parameters, template_nba.extract_output_declarations())
+    except ValueError as e:
+        issues.append("invalid output selection: %s"%e)
+
+    if len(issues)>0:
+        return make_response(jsonify(issues=issues), 400)
 
     ## async
     if async_request:
-        key = hashlib.sha224(json.dumps(dict(target=target, params=interpreted_parameters)).encode('utf-8')).hexdigest()
+        key = hashlib.sha224(json.dumps(dict(target=target, params=interpreted_parameters, outputs=outputs), sort_keys=True).encode('utf-8')).hexdigest()
         
-        value = app.async_workflows.get(key, None)
+        value = get_async_value(key)
 
-        print('cache key/value',key,value)
+        logger.debug("async key %s value %s", key, logs.payload(value))
     
-        if value is None:
-            async_task = AsyncWorkflow(key=key, target=target, params=interpreted_parameters)
-            async_task.start()
-            app.async_workflows[key]='started'
-            return make_response(jsonify(workflow_status="submitted", comment="task created"), 201)
+        # the shared work queue retries failed jobs itself
+        if value is None or (app.work_queue is None and job_failed(key)):
+            try:
+                app.admission.admit(target, background=True)
+            except Overloaded as e:
+                return overloaded_response(e)
+
+            submit_async(key, target, interpreted_parameters, outputs)
+            return pending_job_response(key, dict(workflow_status="submitted", comment="task created"))
 
         elif value == 'started':
-            return make_response(jsonify(workflow_status="started", comment="task created before"), 201)
+            return pending_job_response(key, dict(workflow_status="started", comment="task created before"))
 
         else:
-            return make_response(jsonify(workflow_status="done", data=value, comment=""), 200)
+            data = dict(value, output=select_output(value['output'], **output_selection))
+            return result_response(dict(workflow_status="done", data=data, comment=""), 200,
+                                   app.cache_timeouts.get(target, 0))
 
 
-    if len(issues)>0:
-        return make_response(jsonify(issues=issues), 400)
     else:
-        exceptions = nba.execute(interpreted_parameters['request_parameters'])
+        try:
+            reservation = app.admission.admit(target)
+        except Overloaded as e:
+            return overloaded_response(e)
 
-        nretry=10
-        while nretry>0:
-            try:
-                output=nba.extract_output()
-                if len(output) == 0:
-                    logger.debug("output from notebook is empty, something failed, attempts left:", nretry)
-                else:
-                    break
-            except nbformat.reader.NotJSONError as e:
-                logger.debug("output notebook incomplte", e, "attempts left:", nretry)
+        nba = template_nba.job_adapter()
 
-            nretry-=1
-            time.sleep(1)
-        
+        try:
+            # scheduled refreshes run in their own lane, behind interactive calls
+            exceptions = app.executor.run(nba.execute, interpreted_parameters['request_parameters'], outputs=outputs,
+                                          lane=g.get('lane', 'interactive'), target=target,
+                                          estimate=estimate_duration(target, interpreted_parameters))
+        finally:
+            app.admission.release(reservation)
 
-        logger.debug("output: %s",output)
-        logger.debug("exceptions: %s",exceptions)
+        app.admission.record(target, nba.resource_usage)
+        record_duration(target, interpreted_parameters['request_parameters'], nba.resource_usage)
+        trace.render_in_background(nba.output_notebook_fn, failed=len(exceptions) > 0)
 
-        r = jsonify(dict(
-                    output=output,
-                    exceptions=[repr(e) for e in exceptions],
-                    jobdir=nba.tmpdir,
-                ))
+        # outputs recorded before a failure are returned too; a job killed for exceeding its limits has none
+        output = nba.extract_output() if nba.output_ready else dict()
+
+        logger.debug("output: %s", logs.payload(output))
+        logger.debug("exceptions: %s",exceptions)
 
         return_code = 200
         if len(exceptions) > 0:
             return_code = 500
 
-        return r, return_code
+        return result_response(dict(
+                    output=select_output(output, **output_selection),
+                    exceptions=[repr(e) for e in exceptions],
+                    jobdir=nba.tmpdir,
+                    resource_usage=nba.resource_usage,
+                ), return_code, app.cache_timeouts.get(target, 0))
 
 
 def to_oapi_type(in_type):
@@ -249,17 +501,27 @@ def to_oapi_type(in_type):
     if issubclass(in_type,int):
         out_type='integer'
 
+    if issubclass(in_type,bool):
+        out_type='boolean'
+
     if issubclass(in_type,float):
         out_type='number'
     
     if issubclass(in_type,str):
         out_type='string'
+
+    if issubclass(in_type,(list,tuple)):
+        out_type='array'
+
+    if issubclass(in_type,dict):
+        out_type='object'
     
     logger.debug("oapi type cast from %s to %s",repr(in_type),repr(out_type))
     
     return out_type
 
-from werkzeug.routing import RequestRedirect, MethodNotAllowed, NotFound
+from werkzeug.routing import RequestRedirect
+from werkzeug.exceptions import MethodNotAllowed, NotFound
 
 def get_view_function(url, method='GET'):
     """Match a url and return the view and arguments
@@ -284,9 +546,37 @@ def get_view_function(url, method='GET'):
         # no view is associated with the endpoint
         return None
 
-def setup_routes(app):
-    for target, nba in app.notebook_adapters.items():
-        target_specs=specs_dict = {
+def response_filter(rv):
+    if isinstance(rv, tuple) and isinstance(rv[0], Response) and rv[1] != 200:
+        logger.info("NOT caching response %s", rv[1])
+        return False
+    elif isinstance(rv, Response) and rv.status_code != 200:
+        logger.info("NOT caching response %s", rv)
+        return False
+    else:
+        logger.info("caching response %s", rv)
+        return True
+
+def refresh_cached_target(target, args):
+    view = app.cached_views[target]
+
+    with app.test_request_context('/api/v1.0/get/'+target, query_string=list(args)):
+        g.lane = "scheduled"
+        cache_key = view.make_cache_key(use_request=True)
+        rv = view.uncached()
+
+        if response_filter(rv):
+            cache.set(cache_key, rv, timeout=view.cache_timeout)
+            logger.info("refreshed cache for %s with %s", target, args)
+        else:
+            logger.info("refresh of %s with %s did not produce a cacheable response", target, args)
+
+    return rv
+
+app.prewarmer = Prewarmer(refresh=refresh_cached_target)
+
+def get_target_specs(nba):
+    return {
               "parameters": [
                 {
                   "name": p_name,
@@ -305,60 +595,136 @@ def setup_routes(app):
               }
             }
 
+# the documents are polled often: the notebooks are looked at again at most this often
+notebook_check_interval = 5.
+
+def notebook_set_version():
+    now = time.time()
+
+    checked = app.notebook_set_checked
+    if checked is not None and checked['adapters'] is app.notebook_adapters and now - checked['at'] < notebook_check_interval:
+        return checked['version']
+
+    version = hashlib.sha224(repr(sorted(
+                (target, notebook_signature(nba.notebook_fn)) for target, nba in app.notebook_adapters.items()
+            )).encode('utf-8')).hexdigest()
+
+    app.notebook_set_checked = dict(adapters=app.notebook_adapters, at=now, version=version)
+    return version
+
+def precomputed_document(name, compute):
+    """
+    JSON document serialised once per version of the notebooks, with its strong etag
+    """
+    version = notebook_set_version()
+
+    document = app.documents.get(name, None)
+    if document is None or document['version'] != version:
+        logger.info("computing %s for notebooks version %s", name, version)
+        body = json.dumps(compute(), cls=ResultJSONEncoder, sort_keys=True).encode('utf-8')
+        document = dict(version=version, body=body, etag=hashlib.sha224(body).hexdigest())
+        app.documents[name] = document
+
+    return document
+
+def document_response(document):
+    response = Response(document['body'], mimetype='application/json')
+    response.set_etag(document['etag'])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def refresh_target_specs():
+    # swag_from keeps the specs dictionaries, which are updated in place
+    for target, specs in app.target_specs.items():
+        specs.clear()
+        specs.update(get_target_specs(app.notebook_adapters[target]))
+
+    getattr(app.swagger, 'apispecs', {}).clear()
+
+def compute_apispec(endpoint):
+    refresh_target_specs()
+    return app.swagger.get_apispecs(endpoint)
+
+def apispec_view(endpoint):
+    def view():
+        # the prefix of the swagger UI depends on the proxy forwarding the request
+        name = (endpoint, request.environ.get('HTTP_X_FORWARDED_PREFIX', ''))
+        return document_response(precomputed_document(name, lambda: compute_apispec(endpoint)))
+    return view
+
+def setup_routes(app):
+    for target, nba in app.notebook_adapters.items():
+        target_specs = app.target_specs[target] = get_target_specs(nba)
+
         endpoint='endpoint_'+target
 
 
         def funcg(target):
             def workflow_func():
-                return workflow(target)
+                rv = workflow(target)
+                if request.method == 'GET' and response_filter(rv):
+                    app.prewarmer.record_computed(target, request.args.items(multi=True))
+                return rv
             return workflow_func
 
+        def accessg(target, view):
+            def access_func():
+                if request.method == 'GET':
+                    app.prewarmer.record_access(target, request.args.items(multi=True))
+                return view()
+            return access_func
+
         logger.debug("target: %s with endpoint %s",target,endpoint)
 
-        def response_filter(rv):
-            if isinstance(rv, tuple) and isinstance(rv[0], Response) and rv[1] != 200:
-                logger.info("NOT caching response %s", rv[1])
-                return False
-            elif isinstance(rv, Response) and rv.status != 200:
-                logger.info("NOT caching response %s", rv)
-                return False
-            else:
-                logger.info("caching response %s", rv)
-                return True
+        # system parameters are read once: the getter consumes them
+        cache_timeout = app.cache_timeouts[target] = nba.get_system_parameter_value('cache_timeout', 0)
+
+        app.executor.set_target_limit(target, nba.get_system_parameter_value('max_concurrency', 0))
+        app.durations.condition_on(target, nba.get_system_parameter_value('duration_parameters', ''))
+
+        cached_view = cache.cached(timeout=cache_timeout,key_prefix=make_key,response_filter=response_filter,query_string=True,unless=lambda: request.method != 'GET')(
+                funcg(target)
+            )
+        app.cached_views[target] = cached_view
+        app.prewarmer.register(target, cache_timeout)
 
-        cache_timeout = nba.get_system_parameter_value('cache_timeout', 0)
         try:
-            app.route('/api/v1.0/get/'+target,methods=['GET'],endpoint=endpoint)(
+            app.route('/api/v1.0/get/'+target,methods=['GET', 'POST'],endpoint=endpoint)(
             swag_from(target_specs)(
-            cache.cached(timeout=cache_timeout,key_prefix=make_key,response_filter=response_filter,query_string=True)(
-                funcg(target)
-            )))
+                accessg(target, cached_view)
+            ))
         except AssertionError as e:
             logger.info("unable to add route:",e)
             raise
 
         schedule_interval = nba.get_system_parameter_value('schedule_interval', 0)
         if schedule_interval>0:
-            logger.info("scheduling callable %s every %lg", str(funcg), float(schedule_interval))
+            logger.info("scheduling refresh of %s every %lg", target, float(schedule_interval))
+
+            def scheduleg(target):
+                def schedulable():
+                    refresh_cached_target(target, [])
+                return schedulable
 
-            def schedulable():
-                with app.test_request_context('/api/v1.0/get/'+target):
-                    from flask import request
-                    get_view_function('/api/v1.0/get/'+target)[0]()
+            schedule.schedule_callable(scheduleg(target), schedule_interval)
 
-            schedule.schedule_callable(schedulable, schedule_interval)
+    for spec in app.swagger.config['specs']:
+        app.view_functions[app.swagger.config.get('endpoint', 'flasgger')+'.'+spec['endpoint']] = apispec_view(spec['endpoint'])
 
 # list input -> output function signatures and identities
 
-@app.route('/api/v1.0/options',methods=['GET'])
-def workflow_options():
-    return jsonify(dict([
+def compute_options():
+    return dict([
                     (
                         target,
                         dict(output=nba.extract_output_declarations(),parameters=nba.extract_parameters()),
                     )
                      for target, nba in app.notebook_adapters.items()
-                    ]))
+                    ])
+
+@app.route('/api/v1.0/options',methods=['GET'])
+def workflow_options():
+    return document_response(precomputed_document('options', compute_options))
 
 @app.route('/api/v1.0/get-<mode>/<target>/<filename>',methods=['GET'])
 def workflow_filename(mode, target, filename):
@@ -409,9 +775,17 @@ def workflow_filename(mode, target, filename):
                     exceptions={"problem decoding":repr(e),"raw_response":r.content.decode('utf-8')},
                 ))
 
+def get_service_semantic_signature():
+    from nb2workflow import ontology
+
+    # loading the ontologies takes network requests, which are not made on startup
+    if getattr(app, 'service_semantic_signature', None) is None:
+        app.service_semantic_signature = ontology.service_semantic_signature(app.notebook_adapters)
+    return app.service_semantic_signature
+
 @app.route('/api/v1.0/rdf',methods=['GET'])
 def workflow_rdf():
-    return make_response(app.service_semantic_signature)
+    return make_response(get_service_semantic_signature())
 
 @app.route('/health')
 def healthcheck():
@@ -460,6 +834,14 @@ def healthcheck():
 
     #status['processes'] = processes
 
+    status['executor'] = app.executor.status()
+    status['logging'] = logs.stats.status()
+    status['admission'] = app.admission.status()
+    status['durations'] = app.durations.status()
+
+    if status['executor']['saturation'] >= 1:
+        issues.append("executor saturated: %(running)i running and %(queued)i queued jobs for %(max_workers)i workers"%status['executor'])
+
     if len(issues)==0:
         return jsonify(dict(summary="all is ok!",status=status))
     else:
@@ -474,25 +856,25 @@ def test():
         if template_nba.name.startswith('test_'):
             key = template_nba.name
 
-            if key in app.async_workflows:
-                print("found", app.async_workflows[key])
+            value = get_async_value(key)
 
-                if isinstance(app.async_workflows[key], dict):
+            if value is not None:
+                print("found", value)
+
+                if isinstance(value, dict):
                     print("found result seems a reasonable dict")
-                    workflow_status = app.async_workflows[key].get('workflow_status', 'done')
+                    workflow_status = value.get('workflow_status', 'done')
                     print("workflow_status", workflow_status)
                 else:
-                    workflow_status = app.async_workflows[key]
+                    workflow_status = value
 
                 if workflow_status == 'done':
-                    results[template_nba.name] = app.async_workflows[key]['exceptions'] # and output notebook
+                    results[template_nba.name] = value['exceptions'] # and output notebook
                     print("workflow_status is done, results exceptions:", results[template_nba.name])
                 else:
                     expecting.append(dict(key = key, workflow_status=workflow_status))
             else:
-                async_task = AsyncWorkflow(key=key, target=template_nba.name, params=dict(request_parameters=dict(location=os.path.dirname(template_nba.notebook_fn))))
-                async_task.start()
-                app.async_workflows[key]='started'
+                submit_async(key, template_nba.name, dict(request_parameters=dict(location=os.path.dirname(template_nba.notebook_fn))), lane="test")
                 expecting.append(dict(key = key, workflow_status='submitted'))
 
 
@@ -527,20 +909,101 @@ def main():
     #parser.add_argument('--tmpdir', metavar='tmpdir', type=str, default=None)
     parser.add_argument('--publish', metavar='upstream-url', type=str, default=None)
     parser.add_argument('--publish-as', metavar='published url', type=str, default=None)
+    parser.add_argument('--publish-check', metavar='check', type=str, default="ttl", choices=["ttl", "http", "none"])
+    parser.add_argument('--publish-ttl', metavar='seconds', type=int, default=30)
+    parser.add_argument('--max-workers', metavar='N', type=int, default=4, help="number of concurrent background jobs")
+    parser.add_argument('--lane-weights', metavar='lane=weight,...', type=str, default=None, help="shares of the workers given to the lanes of waiting jobs, default interactive=8,async=4,scheduled=2,test=1")
+    parser.add_argument('--queue', metavar='url', type=str, default=None, help="shared work queue for async jobs, sqlite:///path/to/db or file:///path/to/directory")
+    parser.add_argument('--queue-visibility-timeout', metavar='seconds', type=float, default=60, help="leased jobs without heartbeats for this long are given to another worker")
+    parser.add_argument('--queue-max-attempts', metavar='N', type=int, default=3)
+    parser.add_argument('--execution-engine', metavar='engine', type=str, default="auto", choices=["auto", "forkserver", "papermill"], help="auto runs plain python notebooks in-process, without a kernel; forkserver runs them in processes forked from one with preloaded modules")
+    parser.add_argument('--compiled-workers', metavar='N', type=int, default=None, help="size of the process pool for in-process execution")
+    parser.add_argument('--forkserver-preload', metavar='module,...', type=str, default=None, help="modules imported once by the forkserver, default %s"%",".join(forkserver.default_preload))
+    parser.add_argument('--forkserver-timeout', metavar='seconds', type=float, default=None, help="kill forkserver jobs running longer")
+    parser.add_argument('--blob-store', metavar='path', type=str, default=blobstore.default_root, help="directory of uploaded input files")
+    parser.add_argument('--blob-max-mb', metavar='MB', type=float, default=1024, help="largest input file upload")
     parser.add_argument('--profile', metavar='service profile', type=str, default="oda")
+    parser.add_argument('--prewarm-top', metavar='N', type=int, default=prewarm.default_top_n, help="number of most requested parameter sets to keep warm per target, 0 to disable")
+    parser.add_argument('--prewarm-lead', metavar='seconds', type=float, default=prewarm.default_lead_time, help="refresh cached results this long before they expire")
+    parser.add_argument('--prewarm-max-refreshes', metavar='N', type=int, default=prewarm.default_max_concurrent_refreshes, help="maximum number of concurrent background refreshes")
+    parser.add_argument('--prewarm-interval', metavar='seconds', type=float, default=10)
+    parser.add_argument('--trace-file', metavar='path', type=str, default=None, help="append tracing spans to this JSONL file")
+    parser.add_argument('--trace-otlp', metavar='url', type=str, default=None, help="send tracing spans to an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces")
+    parser.add_argument('--admission-max-queue', metavar='jobs per worker', type=float, default=2., help="reject new jobs when this many are queued per worker, 0 to disable")
+    parser.add_argument('--admission-min-memory', metavar='MB', type=float, default=500, help="reject or defer jobs which would leave less available memory, 0 to disable")
+    parser.add_argument('--admission-max-load', metavar='load per cpu', type=float, default=2., help="reject or defer jobs above this load average per cpu, 0 to disable")
+    parser.add_argument('--admission-min-disk', metavar='MB', type=float, default=300, help="reject jobs when less disk space is left, 0 to disable")
+    parser.add_argument('--compress-min-size', metavar='bytes', type=int, default=1024, help="results smaller than this are sent uncompressed")
+    parser.add_argument('--profile-startup', action="store_true", help="report the time spent in imports and initialisation, until the first served request")
     parser.add_argument('--debug', action="store_true")
 
     args = parser.parse_args()
 
+    app.profile_startup = args.profile_startup
+    httpcache.min_compress_size = args.compress_min_size
+
+    tracing.configure(args.trace_file, args.trace_otlp)
+
     if args.debug:
         logging.getLogger("nb2workflow").setLevel(level=logging.DEBUG)
         logging.getLogger("flask").setLevel(level=logging.DEBUG)
 
-    app.notebook_adapters = find_notebooks(args.notebook)
-    setup_routes(app)
-    app.service_semantic_signature=ontology.service_semantic_signature(app.notebook_adapters)
+    lane_weights = dict(default_lane_weights)
+    if args.lane_weights:
+        lane_weights.update(parse_lane_weights(args.lane_weights))
+
+    app.executor = Executor(max_workers=args.max_workers, lane_weights=lane_weights)
+    app.admission = AdmissionController(app.executor,
+                                        max_queue_per_worker=args.admission_max_queue,
+                                        min_available_mb=args.admission_min_memory,
+                                        max_load_per_cpu=args.admission_max_load,
+                                        min_disk_mb=args.admission_min_disk)
+
+    compiled.default_engine = args.execution_engine
+    compiled.max_workers = args.compiled_workers
+
+    if args.forkserver_preload is not None:
+        forkserver.preload = forkserver.parse_modules(args.forkserver_preload)
+    forkserver.timeout = args.forkserver_timeout
+
+    blobstore.set_store(blobstore.BlobStore(args.blob_store, max_size_mb=args.blob_max_mb))
+
+    app.prewarmer = Prewarmer(
+                refresh=refresh_cached_target,
+                top_n=args.prewarm_top,
+                lead_time=args.prewarm_lead,
+                max_concurrent_refreshes=args.prewarm_max_refreshes,
+            )
+
+    with startup_profile.phase("find notebooks"):
+        app.notebook_adapters = find_notebooks(args.notebook)
+
+    if any(nba.execution_engine == "compiled" for nba in app.notebook_adapters.values()):
+        with startup_profile.phase("start in-process workers"):
+            compiled.start_pool()
+
+    if any(nba.execution_engine == "forkserver" for nba in app.notebook_adapters.values()):
+        with startup_profile.phase("start forkserver"):
+            forkserver.start()
+
+    with startup_profile.phase("setup routes"):
+        setup_routes(app)
+
+    if args.queue:
+        with startup_profile.phase("open work queue"):
+            app.work_queue = open_queue(args.queue, visibility_timeout=args.queue_visibility_timeout, max_attempts=args.queue_max_attempts)
+            app.queue_consumer = QueueConsumer(app.work_queue, app.executor, run_queued_job,
+                                               estimate=lambda job: estimate_duration(job['target'], job['params']),
+                                               gate=lambda key, job: admission_gate(key, job['target']))
+            app.queue_consumer.start()
+
+    if args.prewarm_top > 0:
+        with startup_profile.phase("start scheduler"):
+            schedule.schedule_callable(app.prewarmer.tick, args.prewarm_interval)
 
     if args.publish:
+        from nb2workflow import publish
+
         logger.info("publishing to %s",args.publish)
 
         if args.publish_as:
@@ -549,8 +1012,17 @@ def main():
         else:
             publish_host, publish_port = args.host, args.port
 
-        for nba_name, nba in app.notebook_adapters.items():
-            publish.publish(args.publish, nba_name, publish_host, publish_port)
+        app.publisher = publish.ConsulPublisher(args.publish, publish_host, publish_port,
+                                check=None if args.publish_check == "none" else args.publish_check,
+                                ttl=args.publish_ttl,
+                                saturation=app.executor.saturation)
+        with startup_profile.phase("publish"):
+            app.publisher.register_all(list(app.notebook_adapters.keys()))
+            app.publisher.start()
+
+    startup_profile.stop_recording_imports()
+    if args.profile_startup:
+        logger.info(startup_profile.report())
 
 
   #  for rule in app.url_map.iter_rules():
@@ -565,9 +1037,127 @@ def status():
                 started_at = app.started_at.strftime("%s"),
                 started_since = (datetime.datetime.now()-app.started_at).seconds,
                 background_jobs = len([w for w in app.async_workflows if w]),
+                executor = app.executor.status(),
                 stored_jobs = len(app.async_workflows),
+                work_queue = app.work_queue.stats() if app.work_queue is not None else None,
+                startup = startup_profile.summary(),
+            )
+
+job_workflow_status = dict(queued="submitted", running="started", done="done", failed="failed")
+
+max_long_poll = 60.
+event_stream_heartbeat = 15.
+
+def job_urls(key):
+    return dict(
+                job_id=key,
+                status_url=url_for('async_status', key=key, _external=True),
+                events_url=url_for('async_events', key=key, _external=True),
             )
 
+def job_status(key, output_selection):
+    value = get_async_value(key)
+    job = job_events().get(key) or {}
+
+    status = dict(job_id=key, version=job.get('version', 0), comment="")
+
+    if isinstance(value, dict):
+        status['workflow_status'] = "failed" if job.get('status', None) == "failed" else "done"
+        status['data'] = dict(value, output=select_output(value['output'], **output_selection))
+    elif job.get('status', None) in ("done", "failed"):
+        # finished without storing a result
+        status['workflow_status'] = "failed"
+    else:
+        status['workflow_status'] = job_workflow_status.get(job.get('status', None), "started")
+
+        partial_output = get_partial_output(key)
+        if partial_output:
+            status['partial_output'] = select_output(partial_output, **output_selection)
+
+        add_estimate(status, key)
+
+    return status
+
+def add_estimate(status, key):
+    eta = app.executor.eta(key)
+    if eta is not None:
+        status['estimated_seconds'] = eta
+        status['estimated_completion'] = datetime.datetime.utcfromtimestamp(time.time() + eta).isoformat() + "Z"
+    return status
+
+def pending_job_response(key, body):
+    """
+    response about an unfinished job, telling pollers when to ask again
+    """
+    body = add_estimate(dict(body, **job_urls(key)), key)
+
+    response = make_response(jsonify(body), 201)
+    response.headers['Retry-After'] = str(retry_after(body.get('estimated_seconds', None)))
+    return response
+
+def get_status_request(key):
+    if get_async_value(key) is None:
+        return None, make_response(jsonify(issues=["job not known: %s"%key]), 404)
+
+    try:
+        output_selection = get_output_selection(request.args.to_dict())
+        wait = min(float(request.args.get('wait', 0)), max_long_poll)
+        since = request.args.get('since', None)
+        if since is not None:
+            since = int(since)
+    except ValueError as e:
+        return None, make_response(jsonify(issues=["invalid status request: %s"%e]), 400)
+
+    return dict(output_selection=output_selection, wait=wait, since=since), None
+
+@app.route('/api/v1.0/status/<string:key>')
+def async_status(key):
+    """
+    state of an async job; with wait=<seconds> the response is held until the job finishes,
+    or, with since=<version>, until its state changes
+    """
+    status_request, error = get_status_request(key)
+    if error is not None:
+        return error
+
+    if status_request['wait'] > 0:
+        job_events().wait(key, status_request['since'], status_request['wait'])
+
+    status = job_status(key, status_request['output_selection'])
+    response = stream_json(status)
+
+    if status['workflow_status'] not in ("done", "failed"):
+        response.headers['Retry-After'] = str(retry_after(status.get('estimated_seconds', None)))
+
+    return response
+
+@app.route('/api/v1.0/events/<string:key>')
+def async_events(key):
+    """
+    server-sent events with every state change of an async job, ending with its result
+    """
+    status_request, error = get_status_request(key)
+    if error is not None:
+        return error
+
+    def events():
+        version = -1 if status_request['since'] is None else status_request['since']
+
+        while True:
+            job = job_events().wait(key, version, event_stream_heartbeat)
+            status = job_status(key, status_request['output_selection'])
+
+            if status['version'] > version or status['workflow_status'] in ("done", "failed"):
+                version = status['version']
+                yield "id: %i\nevent: %s\ndata: %s\n\n"%(version, status['workflow_status'], json.dumps(status, cls=ResultJSONEncoder))
+            else:
+                yield ": keep-alive\n\n"
+
+            if status['workflow_status'] in ("done", "failed") or job is None:
+                return
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/async/delete')
 def async_delete():
     return jsonify(app.async_workflows)
@@ -576,6 +1166,7 @@ def async_delete():
 def async_clear():
     s = app.async_workflows
     app.async_workflows = dict()
+    app.executor.events.forget()
     return jsonify(s)
 
 @app.route('/async/list')
@@ -605,17 +1196,115 @@ def trace_get(job):
 
 @app.route('/trace/<string:job>/<string:func>')
 def trace_get_func(job, func):
+    """
+    HTML rendering of the output notebook, optionally only of cells=<first>-<last> and/or of failed_only cells;
+    renderings are stored with the job and validated with etags
+    """
     if func == "custom.css":
         return ""
 
-    from nbconvert.exporters import HTMLExporter
-    exporter = HTMLExporter()
-   
     fn = os.path.join(tempfile.gettempdir(), job, func+"_output.ipynb")
 
-    output, resources = exporter.from_filename(fn)
+    if not os.path.exists(fn):
+        return make_response(jsonify(issues=["no trace %s for job %s"%(func, job)]), 404)
+
+    try:
+        cell_range = trace.parse_cell_range(request.args.get('cells', None))
+        failed_only = parse_bool(request.args.get('failed_only', False))
+    except ValueError as e:
+        return make_response(jsonify(issues=["invalid trace request: %s"%e]), 400)
+
+    path, etag = trace.render_trace(fn, cell_range, failed_only)
+
+    response = Response(open(path, "rb").read(), mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def blob_description(digest):
+    return dict(
+                sha256=digest,
+                reference=blobstore.reference(digest),
+                size=blobstore.get_store().size(digest),
+                url=url_for('blob', digest=digest, _external=True),
+            )
+
+def upload_response(upload_id, offset, status=200):
+    response = make_response(jsonify(upload_id=upload_id, offset=offset, upload_url=url_for('upload', upload_id=upload_id, _external=True)), status)
+    response.headers['Upload-Offset'] = str(offset)
+    return response
+
+@app.route('/api/v1.0/blobs', methods=['GET'])
+def blobs():
+    return jsonify(blobstore.get_store().status())
+
+@app.route('/api/v1.0/blobs/<string:digest>', methods=['GET', 'PUT'])
+def blob(digest):
+    """
+    input files for parameters, referred to as blob:sha256:<digest>: GET tells if one is stored, PUT uploads one in a single request
+    """
+    store = blobstore.get_store()
+
+    if blobstore.parse_reference(blobstore.reference(digest)) is None:
+        return make_response(jsonify(issues=["%s is not a sha256 hex digest"%digest]), 400)
+
+    if request.method == 'PUT':
+        if store.exists(digest):
+            return jsonify(blob_description(digest))
+
+        try:
+            digest = store.put(request.stream, digest)
+        except blobstore.UploadTooLarge as e:
+            return make_response(jsonify(issues=[str(e)]), 413)
+        except blobstore.BlobError as e:
+            return make_response(jsonify(issues=[str(e)]), 400)
+
+        return make_response(jsonify(blob_description(digest)), 201)
+
+    if not store.exists(digest):
+        return make_response(jsonify(issues=["no blob %s"%digest]), 404)
+
+    return jsonify(blob_description(digest))
 
-    return output
+@app.route('/api/v1.0/uploads', methods=['POST'])
+def uploads():
+    """
+    starts a resumable upload: chunks are sent with PATCH and their Upload-Offset, HEAD gives the offset to resume from,
+    and PUT with the expected sha256 completes it
+    """
+    return upload_response(blobstore.get_store().begin(), 0, 201)
+
+@app.route('/api/v1.0/uploads/<string:upload_id>', methods=['HEAD', 'PATCH', 'PUT'])
+def upload(upload_id):
+    store = blobstore.get_store()
+
+    try:
+        if request.method == 'HEAD':
+            return upload_response(upload_id, store.offset(upload_id))
+
+        if request.method == 'PATCH':
+            try:
+                offset = int(request.headers.get('Upload-Offset', ''))
+            except ValueError:
+                return make_response(jsonify(issues=["Upload-Offset header is required"]), 400)
+
+            return upload_response(upload_id, store.append(upload_id, offset, request.stream))
+
+        digest = store.finish(upload_id, request.args.get('sha256', None))
+        return make_response(jsonify(blob_description(digest)), 201)
+
+    except blobstore.UploadOffsetMismatch as e:
+        return upload_response(upload_id, e.offset, 409)
+    except blobstore.UnknownBlob as e:
+        return make_response(jsonify(issues=[str(e)]), 404)
+    except blobstore.UploadTooLarge as e:
+        return make_response(jsonify(issues=[str(e)]), 413)
+    except blobstore.BlobError as e:
+        return make_response(jsonify(issues=[str(e)]), 400)
+
+@app.route('/prewarm/status')
+def prewarm_status():
+    return jsonify(app.prewarmer.summary())
 
 @app.route('/clear-cache')
 def clear_cache():
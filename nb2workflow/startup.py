@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import builtins
+import contextlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+imported_at = time.time()
+
+
+def process_started_at():
+    """
+    start time of this process from /proc, the import time of this module where it is not available
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+
+        with open("/proc/stat") as f:
+            boot_time = [int(line.split()[1]) for line in f if line.startswith("btime")][0]
+
+        return boot_time + start_ticks / float(os.sysconf("SC_CLK_TCK"))
+    except Exception:
+        return imported_at
+
+
+class StartupProfile(object):
+    """
+    time spent importing each top-level package, and in each initialisation phase, from process start to the first served request
+    """
+
+    def __init__(self):
+        self.started_at = process_started_at()
+        self.imports = {}
+        self.phases = []
+        self.first_request_at = None
+        self.lock = threading.Lock()
+        self._import = None
+        self._depth = threading.local()
+
+    def record_imports(self):
+        if self._import is not None:
+            return
+
+        self._import = builtins.__import__
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            top = name.split(".")[0]
+            depth = getattr(self._depth, 'n', 0)
+
+            # only the outermost import of a new package is timed, it includes the imports it makes
+            if depth > 0 or level > 0 or top in sys.modules:
+                return self._import(name, globals, locals, fromlist, level)
+
+            t0 = time.time()
+            self._depth.n = 1
+            try:
+                return self._import(name, globals, locals, fromlist, level)
+            finally:
+                self._depth.n = 0
+                self.imports[top] = self.imports.get(top, 0.) + time.time() - t0
+
+        builtins.__import__ = timed_import
+
+    def stop_recording_imports(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - t0))
+
+    def request_served(self):
+        with self.lock:
+            if self.first_request_at is None:
+                self.first_request_at = time.time()
+                return True
+        return False
+
+    def summary(self):
+        return dict(
+                    imports=dict(sorted(self.imports.items(), key=lambda x: -x[1])),
+                    phases=self.phases,
+                    seconds_to_first_request=None if self.first_request_at is None else self.first_request_at - self.started_at,
+                    seconds_since_start=time.time() - self.started_at,
+                )
+
+    def report(self, top=15):
+        summary = self.summary()
+
+        lines = ["startup profile, %.3f s since process start"%summary['seconds_since_start']]
+
+        lines.append("  imports:")
+        for name, seconds in list(summary['imports'].items())[:top]:
+            lines.append("    %-30s %8.3f s"%(name, seconds))
+
+        lines.append("  initialisation:")
+        for name, seconds in summary['phases']:
+            lines.append("    %-30s %8.3f s"%(name, seconds))
+
+        if summary['seconds_to_first_request'] is not None:
+            lines.append("  first request served after %.3f s"%summary['seconds_to_first_request'])
+
+        return "\n".join(lines)
+
+
+profile = StartupProfile()
+
+# the service reads its arguments only after its imports, which are to be profiled too
+if "--profile-startup" in sys.argv:
+    profile.record_imports()
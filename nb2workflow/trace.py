@@ -0,0 +1,145 @@
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import nbformat
+
+from nb2workflow.nbadapter import notebook_signature
+
+logger = logging.getLogger(__name__)
+
+trace_dirname = ".trace"
+
+_hashes = {}
+_exporter = None
+_exporter_lock = threading.Lock()
+_renderer = None
+
+
+def output_notebook_hash(notebook_fn):
+    signature = notebook_signature(notebook_fn)
+
+    if signature not in _hashes:
+        if len(_hashes) > 1000:
+            _hashes.clear()
+        _hashes[signature] = hashlib.sha256(open(notebook_fn, "rb").read()).hexdigest()
+
+    return _hashes[signature]
+
+
+def parse_cell_range(cells):
+    """
+    "3-7" (inclusive, counted from 0) or "3"; None for all cells
+    """
+    if cells is None or cells == "":
+        return None
+
+    if "-" in cells:
+        start, end = cells.split("-", 1)
+    else:
+        start, end = cells, cells
+
+    start, end = int(start), int(end)
+    if start < 0 or end < start:
+        raise ValueError("invalid cell range %s"%cells)
+
+    return start, end
+
+
+def trace_variant(cell_range=None, failed_only=False):
+    variant = "all" if cell_range is None else "cells-%i-%i"%cell_range
+    if failed_only:
+        variant += "-failed"
+    return variant
+
+
+def is_failed(cell):
+    return cell.cell_type == 'code' and any(output.get('output_type', None) == 'error' for output in cell.get('outputs', []))
+
+
+def select_cells(nb, cell_range=None, failed_only=False):
+    cells = nb.cells
+
+    if cell_range is not None:
+        cells = cells[cell_range[0]:cell_range[1] + 1]
+
+    if failed_only:
+        cells = [cell for cell in cells if is_failed(cell)]
+
+    nb.cells = cells
+    return nb
+
+
+def rendered_path(notebook_fn, nbhash, variant):
+    return os.path.join(os.path.dirname(notebook_fn), trace_dirname,
+                        "%s-%s-%s.html"%(os.path.basename(notebook_fn).replace(".ipynb", ""), nbhash[:16], variant))
+
+
+def trace_etag(nbhash, variant):
+    return "%s-%s"%(nbhash, variant)
+
+
+def export_html(nb):
+    global _exporter
+
+    # exporters are costly to set up, but not safe to share between threads
+    with _exporter_lock:
+        if _exporter is None:
+            from nbconvert.exporters import HTMLExporter
+            _exporter = HTMLExporter()
+
+        output, resources = _exporter.from_notebook_node(nb)
+        return output
+
+
+def render_trace(notebook_fn, cell_range=None, failed_only=False):
+    """
+    path of the HTML rendering of an output notebook, rendered unless it was before; and its etag
+    """
+    nbhash = output_notebook_hash(notebook_fn)
+    variant = trace_variant(cell_range, failed_only)
+    path = rendered_path(notebook_fn, nbhash, variant)
+
+    if not os.path.exists(path):
+        logger.info("rendering %s trace of %s", variant, notebook_fn)
+
+        nb = select_cells(nbformat.read(notebook_fn, as_version=4), cell_range, failed_only)
+        html = export_html(nb)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(html.encode("utf-8"))
+        os.rename(tmp_path, path)
+
+    return path, trace_etag(nbhash, variant)
+
+
+def render_traces(notebook_fn, failed):
+    try:
+        render_trace(notebook_fn)
+        if failed:
+            render_trace(notebook_fn, failed_only=True)
+    except Exception as e:
+        logger.error("unable to render trace of %s: %s", notebook_fn, repr(e))
+
+
+def render_in_background(notebook_fn, failed=False):
+    """
+    renders the traces of a finished job in a single background thread, away from the job workers
+    """
+    global _renderer
+
+    if not os.path.exists(notebook_fn):
+        return None
+
+    if _renderer is None:
+        _renderer = ThreadPoolExecutor(max_workers=1)
+
+    return _renderer.submit(render_traces, notebook_fn, failed)
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import random
+import threading
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_random = random.SystemRandom()
+
+exporters = []
+service_name = "nb2workflow"
+
+
+def new_id(nbytes):
+    return "%0*x"%(nbytes * 2, _random.getrandbits(nbytes * 8))
+
+
+class Span(object):
+    """
+    timed operation of a trace; trace and span ids follow W3C trace context, so that spans can be exported to OpenTelemetry collectors
+    """
+
+    def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id or new_id(16)
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+
+    @property
+    def context(self):
+        return self.trace_id, self.span_id
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        if self.end_time is not None:
+            return
+
+        self.end_time = time.time()
+        if error is not None:
+            self.error = repr(error)
+
+        for exporter in exporters:
+            try:
+                exporter.export(self)
+            except Exception as e:
+                logger.error("unable to export span %s: %s", self.name, repr(e))
+
+    def traceparent(self):
+        return "00-%s-%s-01"%(self.trace_id, self.span_id)
+
+    def to_dict(self):
+        return dict(
+                    trace_id=self.trace_id,
+                    span_id=self.span_id,
+                    parent_id=self.parent_id,
+                    name=self.name,
+                    start_time=self.start_time,
+                    end_time=self.end_time,
+                    duration=self.duration,
+                    attributes=self.attributes,
+                    error=self.error,
+                    service=service_name,
+                )
+
+    def to_otlp(self):
+        span = dict(
+                    traceId=self.trace_id,
+                    spanId=self.span_id,
+                    name=self.name,
+                    kind=1,
+                    startTimeUnixNano=str(int(self.start_time * 1e9)),
+                    endTimeUnixNano=str(int((self.end_time or time.time()) * 1e9)),
+                    attributes=[dict(key=k, value=dict(stringValue=str(v))) for k, v in self.attributes.items()],
+                    status=dict(code=1) if self.error is None else dict(code=2, message=self.error),
+                )
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def parse_traceparent(header):
+    """
+    (trace_id, parent span_id) from a W3C traceparent header, None if it is absent or malformed
+    """
+    if not header:
+        return None
+
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+
+    return parts[1], parts[2]
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    if len(stack) > 0:
+        return stack[-1]
+
+
+def context():
+    """
+    (trace_id, span_id) of the current span, to continue the trace in another thread
+    """
+    span = current_span()
+    if span is not None:
+        return span.context
+
+
+def begin_span(name, parent=None, **attributes):
+    """
+    starts a span and makes it current; parent is a Span, a (trace_id, span_id) context, or by default the current span
+    """
+    if parent is None:
+        parent = current_span()
+
+    if isinstance(parent, Span):
+        parent = parent.context
+
+    trace_id, parent_id = parent if parent is not None else (None, None)
+
+    span = Span(name, trace_id, parent_id, attributes)
+    _stack().append(span)
+    return span
+
+
+def end_span(span, error=None):
+    stack = _stack()
+    if span in stack:
+        stack.remove(span)
+    span.finish(error)
+
+
+@contextlib.contextmanager
+def start_span(name, parent=None, **attributes):
+    span = begin_span(name, parent, **attributes)
+    try:
+        yield span
+    except Exception as e:
+        end_span(span, e)
+        raise
+    else:
+        end_span(span)
+
+
+def inject(headers):
+    span = current_span()
+    if span is not None:
+        headers['traceparent'] = span.traceparent()
+    return headers
+
+
+class JSONLExporter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=repr) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class OTLPExporter(object):
+    """
+    sends spans in batches as OTLP/HTTP JSON to a collector, e.g. http://localhost:4318/v1/traces
+    """
+
+    def __init__(self, endpoint, batch_size=256, interval=5.):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+
+        thread = threading.Thread(target=self._flush_loop)
+        thread.daemon = True
+        thread.start()
+
+    def export(self, span):
+        with self.lock:
+            self.pending.append(span.to_otlp())
+            full = len(self.pending) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def payload(self, spans):
+        return dict(resourceSpans=[dict(
+                    resource=dict(attributes=[dict(key="service.name", value=dict(stringValue=service_name))]),
+                    scopeSpans=[dict(scope=dict(name="nb2workflow"), spans=spans)],
+                )])
+
+    def flush(self):
+        import requests
+
+        with self.lock:
+            spans, self.pending = self.pending, []
+
+        if len(spans) > 0:
+            try:
+                requests.post(self.endpoint, json=self.payload(spans), timeout=10)
+            except Exception as e:
+                logger.warning("unable to send %i spans to %s: %s", len(spans), self.endpoint, repr(e))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+def configure(jsonl_path=None, otlp_endpoint=None, name=None):
+    global service_name
+
+    if name is not None:
+        service_name = name
+
+    if jsonl_path:
+        exporters.append(JSONLExporter(jsonl_path))
+
+    if otlp_endpoint:
+        exporters.append(OTLPExporter(otlp_endpoint))
+
+
+configure(os.environ.get('NB2WORKFLOW_TRACE_FILE', None), os.environ.get('NB2WORKFLOW_OTLP_ENDPOINT', None))
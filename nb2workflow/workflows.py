@@ -3,11 +3,16 @@ import os
 import requests
 import time
 import datetime
+import threading
+import logging
 from collections import OrderedDict
 
 from diskcache import Cache
 
-from nb2workflow import nbadapter
+from nb2workflow import nbadapter, tracing, logs
+from nb2workflow.routing import routing_table, EndpointUnavailable
+
+logger = logging.getLogger(__name__)
 
 cache = Cache('data/default-cache')
 enable_cache = False
@@ -18,7 +23,7 @@ try:
     import logstash
     logstasher = logstash.LogStasher(logstash_entrypoint)
 except Exception as e:
-    print("unable to setup logstash",repr(e))
+    logger.warning("unable to setup logstash: %s", repr(e))
 
     logstasher = None
 
@@ -28,7 +33,7 @@ try:
 except ImportError:
     sentry_sdk = None
 except Exception as e:
-    print("big problem with sentry:",repr(e))
+    logger.error("big problem with sentry: %s", repr(e))
     sentry_sdk = None
 
 
@@ -42,26 +47,131 @@ def serialize_workflow_exception(e):
                 edump = e[1][0],
             )
 
-    
-def reroute(router, *args, **kwargs):
-    workflow_routes = dict([ r.split("=") for r in os.environ.get('WORKFLOW_ROUTES','').split(",") if len(r.split("=")) == 2 ])
-
-    workflow = args[0]
 
-    if workflow in workflow_routes:
-        r_w = workflow_routes[workflow]
-        return r_w.split(":") + args, kwargs
-    
-    if workflow in os.environ.get('STAGING_WORKFLOWS','').split(','):
-        return router+"-staging", args, kwargs
+gateway_errors = (502, 503, 504)
 
-    return router, args, kwargs
+def reroute(router, *args, **kwargs):
+    return routing_table().reroute(router, args, kwargs)
+
+long_poll_wait = 30
+
+def async_job_id(result):
+    for r in (result, result.get('output', None)):
+        if isinstance(r, dict) and r.get('workflow_status', 'done') not in ('done', 'failed') and 'job_id' in r:
+            return r['job_id']
+
+def finished_job_result(result):
+    """
+    result of an async job which was already finished when it was requested, in the shape wait_for_job returns; None for other responses
+    """
+    if isinstance(result, dict) and result.get('workflow_status', None) in ('done', 'failed') and 'data' in result:
+        return result['data']
+
+def partial_result(outputs, return_after, job_id=None):
+    """
+    result with the outputs finished so far, if they include all those in return_after
+    """
+    if outputs and all(name in outputs for name in return_after):
+        return dict(output=outputs, exceptions=[], partial=True, job_id=job_id)
+
+def wait_for_job(url, job_id, auth=None, timeout=150, headers=None, return_after=None):
+    """
+    long-polls the status of a job submitted to the service behind the get url, returns the job result once it is finished;
+    with return_after, returns as soon as these outputs are recorded, with the partial outputs
+    """
+    status_url = url.split("/api/v1.0/get/")[0] + "/api/v1.0/status/" + job_id
+    deadline = time.time() + timeout
+    version = 0
+
+    while True:
+        wait = max(0, min(long_poll_wait, deadline - time.time()))
+
+        params = dict(wait=wait)
+        if return_after is not None:
+            # woken at every state change, not only at the end
+            params['since'] = version
+
+        status = requests.get(status_url, params=params, auth=auth, headers=headers, timeout=wait + 30).json()
+        logger.info("job %s status %s", job_id, status['workflow_status'])
+
+        if status['workflow_status'] == 'done':
+            return status['data']
+
+        if status['workflow_status'] == 'failed':
+            # the result of a failed job has its exceptions
+            if 'data' in status:
+                return status['data']
+            raise WorkflowException("job %s failed without a result"%job_id)
+
+        if return_after is not None:
+            result = partial_result(status.get('partial_output', None), return_after, job_id)
+            if result is not None:
+                logger.info("job %s recorded %s, returning before it finishes", job_id, ", ".join(return_after))
+                return result
+            version = status.get('version', version)
+
+        if wait == 0:
+            return status
+
+def execute_until(nba, params, outputs, return_after):
+    """
+    executes the notebook in the background until it records the outputs in return_after;
+    returns the exceptions if it finished before, None if it is still running. Recorded outputs are in nba.partial_output
+    """
+    nba.partial_output = dict()
+    recorded = threading.Event()
+    finished = dict()
+
+    def on_output(name, value):
+        nba.partial_output[name] = value
+        if all(name in nba.partial_output for name in return_after):
+            recorded.set()
+
+    def run():
+        try:
+            finished['exceptions'] = nba.execute(params, log_output=True, progress_bar=False, outputs=outputs, on_output=on_output)
+        except Exception as e:
+            finished['error'] = e
+        finally:
+            finished['done'] = True
+            recorded.set()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    recorded.wait()
+
+    if 'error' in finished:
+        raise finished['error']
+
+    if 'done' not in finished:
+        return None
+
+    return finished['exceptions']
 
 def evaluate(router, *args, **kwargs):
+    """
+    evaluates a workflow, in a trace which the services it calls continue; the result has the trace_id
+    """
+    with tracing.start_span("evaluate", router=router, workflow=args[0] if len(args) > 0 else None) as span:
+        result = _evaluate(router, *args, **kwargs)
+
+    result['trace_id'] = span.trace_id
+    return result
+
+def _evaluate(router, *args, **kwargs):
     key = json.dumps((router, args, OrderedDict(sorted(kwargs.items()))))
 
     ntries = kwargs.pop('_ntries', 30)
-    async_request = kwargs.pop('_async_request', 30)
+    async_request = kwargs.pop('_async_request', False)
+
+    # outputs after which to return, while the workflow continues
+    return_after = kwargs.pop('_return_after', None)
+    if isinstance(return_after, str):
+        return_after = return_after.split(",")
+    if return_after is not None:
+        async_request = True
 
 
     if logstasher:
@@ -70,17 +180,19 @@ def evaluate(router, *args, **kwargs):
 
     if enable_cache and key in cache:
         v = cache.get(key)
-        print("restored from cache, key:", key)
-        print("restored from cache, value:", v)
+        logger.info("restored from cache, key: %s", logs.payload(key))
+        logger.debug("restored from cache, value: %s", logs.payload(v))
 
         if v == {} or v is None:
-            print("this value is empty, regenerate")
+            logger.info("this value is empty, regenerate")
         else:
             return v
 
-    print("before routing", router, args, kwargs)
+    workflow = args[0]
+
     router, args, kwargs = reroute(router, *args, **kwargs)
-    print("after routing", router, args, kwargs)
+    logs.log_event(logger, logging.INFO, "routed", workflow=workflow, router=router, args=args)
+    logger.debug("parameters: %s", logs.payload(kwargs))
 
     if router == "localfile":
         location = args[0]
@@ -90,17 +202,27 @@ def evaluate(router, *args, **kwargs):
 
         # unused args
 
-        params = kwargs
+        params = dict(kwargs)
+        outputs = params.pop('_outputs', None)
+        if isinstance(outputs, str):
+            outputs = outputs.split(",")
 
-        print("calling",params)
+        logger.debug("calling %s", logs.payload(params))
 
-        exceptions = nba.execute(params,
-                    log_output=True,
-                    progress_bar=False)
+        if return_after is None:
+            exceptions = nba.execute(params,
+                        log_output=True,
+                        progress_bar=False,
+                        outputs=outputs)
+        else:
+            exceptions = execute_until(nba, params, outputs, return_after)
 
-        output = nba.extract_output()
+        if exceptions is None:
+            result = partial_result(nba.partial_output, return_after)
+        else:
+            output = nba.extract_output()
 
-        result = dict(output = output, exceptions = [serialize_workflow_exception(e) for e in exceptions])
+            result = dict(output = output, exceptions = [serialize_workflow_exception(e) for e in exceptions])
 
     elif router.startswith("odahub") or router.startswith("host"):
         if router == "odahub-staging":
@@ -113,31 +235,61 @@ def evaluate(router, *args, **kwargs):
             url_template = args[0]+"/api/v1.0/get/{}"
 
         url = url_template.format(*args[1:])
-        print("url:",url)
+        logger.debug("url: %s", url)
+
+        table = routing_table()
+        endpoint = table.endpoint(workflow, router, args[0]) if router == "host" else None
+
+        trace_headers = tracing.inject({})
+
+        def send(endpoint):
+            target_url = url if endpoint is None else (endpoint.location+"/api/v1.0/get/{}").format(*args[1:])
+
+            logger.debug("towards %s, %i tries left", target_url, ntries)
+            c=requests.get(
+                url=target_url,
+                params=params,
+                auth=auth,
+                headers=trace_headers,
+            )
+
+            if c.status_code in gateway_errors:
+                raise EndpointUnavailable("%s answered %i"%(target_url, c.status_code))
+
+            return c
 
         ntries = ntries
         while ntries > 0:
             try:
-                print("towards",ntries,url,kwargs)
-                c=requests.get(
-                    url=url,
-                    params=kwargs,
-                    auth=requests.auth.HTTPBasicAuth("cdci", open("/cdci-resources/reproducible").read().strip())
-                )
-                print("decoding",c.text)
+                if endpoint is not None and not endpoint.available():
+                    endpoint = table.select(workflow, router="host") or endpoint
+
+                auth=requests.auth.HTTPBasicAuth("cdci", open("/cdci-resources/reproducible").read().strip())
+                params = dict(kwargs, _async_request=True) if async_request else kwargs
+                c = table.call(workflow, endpoint, send)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("decoding %s", logs.payload(c.text))
 
                 try:
                     result = c.json()
                 except Exception as ed:
-                    print("problem decoding:", repr(ed))
-                    print("raw output:",c.text)
+                    logger.error("problem decoding: %s; raw output: %s", repr(ed), logs.payload(c.text))
                     logstasher.log(dict(event='failed to decode output',raw_output=c.text, exception=repr(ed)))
                     raise
 
+                job_id = async_job_id(result)
+                if job_id is not None:
+                    logger.info("waiting for async workflow %s", job_id)
+                    result = wait_for_job(c.url, job_id, auth, timeout=ntries*5, headers=trace_headers, return_after=return_after)
+                    break
+
+                if finished_job_result(result) is not None:
+                    result = finished_job_result(result)
+                    break
 
                 if 'output' in result and 'workflow_status' in result['output']:
                     if result['output']['workflow_status'] != "done": # bad
-                        print("waiting for async workflow")
+                        logger.info("waiting for async workflow")
                         time.sleep(5)
 
                         ntries -= 1
@@ -146,7 +298,7 @@ def evaluate(router, *args, **kwargs):
                 break
 
             except Exception as e:
-                print("problem from service", repr(e))
+                logger.warning("problem from service: %s", repr(e))
 
                 logstasher.log(dict(event='problem evaluating',exception=repr(e)))
                 
@@ -170,8 +322,10 @@ def evaluate(router, *args, **kwargs):
     if logstasher:
         logstasher.log(dict(event='done'))
 
-    cache.set(key, result)
-    print("stored to cache", key)
+    # partial results are returned while the workflow continues, they are not its result
+    if not result.get('partial', False):
+        cache.set(key, result)
+        logger.debug("stored to cache %s", logs.payload(key))
 
     return result
 
@@ -0,0 +1,493 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+import sqlite3
+import tempfile
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue(object):
+    """
+    backlog of jobs shared by several service instances, which lease jobs from it and store results into it.
+
+    A leased job which is not completed and whose lease is not renewed by heartbeats within visibility_timeout
+    is given to another worker, until max_attempts is reached.
+    Job states are reported with the same status, version and updated_at fields as local executor events.
+    """
+
+    terminal = ("done", "failed")
+
+    def __init__(self, visibility_timeout=60, max_attempts=3, poll_interval=0.5):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+    def wait(self, key, since=None, timeout=None):
+        """
+        as JobEvents.wait, but by polling the shared store
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            job = self.get(key)
+
+            if job is None:
+                return None
+            if since is None and job['status'] in self.terminal:
+                return job
+            if since is not None and job['version'] > since:
+                return job
+
+            if deadline is not None and time.time() >= deadline:
+                return job
+
+            time.sleep(self.poll_interval if deadline is None else max(0, min(self.poll_interval, deadline - time.time())))
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    queue in a SQLite database, for instances sharing a filesystem with working locks
+    """
+
+    def __init__(self, path, **kwargs):
+        super(SQLiteQueue, self).__init__(**kwargs)
+        self.path = path
+
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            key TEXT PRIMARY KEY,
+                            job TEXT,
+                            status TEXT,
+                            version INTEGER,
+                            attempts INTEGER,
+                            worker TEXT,
+                            lease_expires REAL,
+                            created_at REAL,
+                            updated_at REAL,
+                            result TEXT,
+                            error TEXT
+                        )""")
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return Transaction(db)
+
+    def put(self, key, job):
+        now = time.time()
+        with self.connect() as db:
+            cursor = db.execute("INSERT OR IGNORE INTO jobs (key, job, status, version, attempts, created_at, updated_at) VALUES (?, ?, 'queued', 1, 0, ?, ?)",
+                                (key, json.dumps(job), now, now))
+            return cursor.rowcount == 1
+
+    def requeue_expired(self, db, now):
+        db.execute("""UPDATE jobs SET
+                        status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                        error = CASE WHEN attempts >= ? THEN 'lease expired after ' || attempts || ' attempts' ELSE error END,
+                        worker = NULL, version = version + 1, updated_at = ?
+                      WHERE status = 'running' AND lease_expires < ?""",
+                   (self.max_attempts, self.max_attempts, now, now))
+
+    def lease(self, worker):
+        now = time.time()
+        with self.connect() as db:
+            self.requeue_expired(db, now)
+
+            row = db.execute("SELECT key, job FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            db.execute("""UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?,
+                            version = version + 1, updated_at = ? WHERE key = ?""",
+                       (worker, now + self.visibility_timeout, now, row['key']))
+
+            return row['key'], json.loads(row['job'])
+
+    def heartbeat(self, key, worker):
+        with self.connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires = ? WHERE key = ? AND worker = ? AND status = 'running'",
+                                (time.time() + self.visibility_timeout, key, worker))
+            return cursor.rowcount == 1
+
+    def finish(self, key, status, result, error):
+        # the first completion wins, also if the lease was meanwhile given to another worker
+        with self.connect() as db:
+            cursor = db.execute("""UPDATE jobs SET status = ?, result = ?, error = ?, worker = NULL, version = version + 1, updated_at = ?
+                                   WHERE key = ? AND status IN ('queued', 'running')""",
+                                (status, json.dumps(result), error, time.time(), key))
+            return cursor.rowcount == 1
+
+    def complete(self, key, worker, result):
+        return self.finish(key, "done", result, None)
+
+    def fail(self, key, worker, error, result=None):
+        return self.finish(key, "failed", result, error)
+
+    def progress(self, key, worker, outputs):
+        # outputs finished so far are kept in place of the result until the job finishes
+        with self.connect() as db:
+            cursor = db.execute("UPDATE jobs SET result = ?, version = version + 1, updated_at = ? WHERE key = ? AND worker = ? AND status = 'running'",
+                                (json.dumps(outputs), time.time(), key, worker))
+            return cursor.rowcount == 1
+
+    def partial(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT status, result FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None or row['status'] != 'running' or row['result'] is None:
+                return None
+            return json.loads(row['result'])
+
+    def get(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT status, version, attempts, worker, updated_at, error FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            return dict(row)
+
+    def result(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT result FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None or row['result'] is None:
+                return None
+            return json.loads(row['result'])
+
+    def stats(self):
+        with self.connect() as db:
+            return dict((row['status'], row['n']) for row in db.execute("SELECT status, count(*) AS n FROM jobs GROUP BY status"))
+
+    def forget(self, key=None):
+        with self.connect() as db:
+            if key is None:
+                db.execute("DELETE FROM jobs")
+            else:
+                db.execute("DELETE FROM jobs WHERE key = ?", (key,))
+
+
+class Transaction(object):
+    """
+    connection which holds an immediate (write-locking) transaction while in the context
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self.db.close()
+
+
+class FileLock(object):
+    """
+    exclusive lock on a file while in the context, between processes and between threads each entering their own FileLock
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, "a")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        finally:
+            self.f.close()
+
+
+class FileQueue(WorkQueue):
+    """
+    queue in a directory, for instances sharing a filesystem with atomic renames and flock.
+    A job is leased by renaming it from queued/ to running/, and its lease is the modification time of the running file.
+    Changes of job states hold the lock of the queue: a rename alone does not keep a lease from expiring before its time is set,
+    nor a finished job from being requeued
+    """
+
+    def __init__(self, root, **kwargs):
+        super(FileQueue, self).__init__(**kwargs)
+        self.root = root
+
+        for d in ("queued", "running", "state", "results", "tmp"):
+            if not os.path.isdir(self.path(d)):
+                os.makedirs(self.path(d))
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def locked(self):
+        return FileLock(self.path("lock"))
+
+    def write(self, path, obj):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path("tmp"))
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f)
+        os.rename(tmp_path, path)
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def update_state(self, key, **changes):
+        state = self.get(key) or dict(version=0, attempts=0, worker=None, error=None)
+        state.update(changes)
+        state['version'] += 1
+        state['updated_at'] = time.time()
+        self.write(self.path("state", key), state)
+        return state
+
+    def put(self, key, job):
+        with self.locked():
+            if self.get(key) is not None:
+                return False
+
+            self.update_state(key, status="queued")
+            self.write(self.path("queued", key), job)
+            return True
+
+    def requeue_expired(self, now):
+        for key in os.listdir(self.path("running")):
+            try:
+                if now - os.stat(self.path("running", key)).st_mtime < self.visibility_timeout:
+                    continue
+            except OSError:
+                continue
+
+            state = self.get(key) or dict(attempts=0)
+            if state['attempts'] >= self.max_attempts:
+                try:
+                    os.remove(self.path("running", key))
+                except OSError:
+                    continue
+                self.update_state(key, status="failed", worker=None, error="lease expired after %i attempts"%state['attempts'])
+            else:
+                try:
+                    os.rename(self.path("running", key), self.path("queued", key))
+                except OSError:
+                    continue
+                self.update_state(key, status="queued", worker=None)
+
+            logger.info("lease of job %s expired", key)
+
+    def lease(self, worker):
+        with self.locked():
+            return self._lease(worker)
+
+    def _lease(self, worker):
+        now = time.time()
+        self.requeue_expired(now)
+
+        def mtime(key):
+            try:
+                return os.stat(self.path("queued", key)).st_mtime
+            except OSError:
+                return now
+
+        for key in sorted(os.listdir(self.path("queued")), key=mtime):
+            try:
+                os.rename(self.path("queued", key), self.path("running", key))
+            except OSError:
+                # leased by another worker
+                continue
+
+            os.utime(self.path("running", key), None)
+
+            job = self.read(self.path("running", key))
+            state = self.get(key) or dict(attempts=0)
+            self.update_state(key, status="running", worker=worker, attempts=state['attempts'] + 1)
+
+            return key, job
+
+    def heartbeat(self, key, worker):
+        with self.locked():
+            state = self.get(key)
+            if state is None or state['status'] != "running" or state['worker'] != worker:
+                return False
+
+            try:
+                os.utime(self.path("running", key), None)
+                return True
+            except OSError:
+                return False
+
+    def finish(self, key, status, result, error):
+        with self.locked():
+            state = self.get(key)
+            if state is None or state['status'] in self.terminal:
+                return False
+
+            self.write(self.path("results", key), result)
+            self.update_state(key, status=status, worker=None, error=error)
+
+            for d in ("running", "queued"):
+                try:
+                    os.remove(self.path(d, key))
+                except OSError:
+                    pass
+
+            return True
+
+    def complete(self, key, worker, result):
+        return self.finish(key, "done", result, None)
+
+    def fail(self, key, worker, error, result=None):
+        return self.finish(key, "failed", result, error)
+
+    def progress(self, key, worker, outputs):
+        with self.locked():
+            state = self.get(key)
+            if state is None or state['status'] != "running" or state['worker'] != worker:
+                return False
+
+            self.write(self.path("results", key), outputs)
+            self.update_state(key)
+            return True
+
+    def partial(self, key):
+        state = self.get(key)
+        if state is None or state['status'] != "running":
+            return None
+        return self.read(self.path("results", key))
+
+    def get(self, key):
+        return self.read(self.path("state", key))
+
+    def result(self, key):
+        return self.read(self.path("results", key))
+
+    def stats(self):
+        stats = {}
+        for key in os.listdir(self.path("state")):
+            state = self.get(key)
+            if state is not None:
+                stats[state['status']] = stats.get(state['status'], 0) + 1
+        return stats
+
+    def forget(self, key=None):
+        keys = os.listdir(self.path("state")) if key is None else [key]
+        for key in keys:
+            for d in ("queued", "running", "state", "results"):
+                try:
+                    os.remove(self.path(d, key))
+                except OSError:
+                    pass
+
+
+def open_queue(url, **kwargs):
+    """
+    sqlite:///path/to/queue.db or file:///path/to/queue-directory
+    """
+    if url.startswith("sqlite://"):
+        return SQLiteQueue(url[len("sqlite://"):], **kwargs)
+
+    if url.startswith("file://"):
+        return FileQueue(url[len("file://"):], **kwargs)
+
+    raise ValueError("unsupported work queue url %s, expected sqlite:// or file://"%url)
+
+
+class QueueConsumer(object):
+    """
+    leases jobs from a shared queue whenever the local executor has free workers, and keeps the leases alive while they run
+    """
+
+    def __init__(self, queue, executor, handler, worker_id=None, poll_interval=1., estimate=None, gate=None):
+        self.queue = queue
+        self.executor = executor
+        self.handler = handler
+        # expected duration of a job, for the executor to schedule it
+        self.estimate = estimate
+        # executor gate of a job, holding it until it may start
+        self.gate = gate
+        self.worker_id = worker_id or "%s:%i:%s"%(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.poll_interval = poll_interval
+        self.leased = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def poll(self):
+        """
+        leases as many jobs as there are free workers; returns the number leased
+        """
+        n = 0
+        while self.executor.saturation() < 1:
+            leased = self.queue.lease(self.worker_id)
+            if leased is None:
+                break
+
+            key, job = leased
+            logger.info("leased job %s", key)
+
+            with self.lock:
+                self.leased.add(key)
+            self.executor.submit_job(key, self.process, key, job, lane=job.get('lane', 'async'), target=job.get('target'),
+                                     estimate=self.estimate(job) if self.estimate is not None else None,
+                                     gate=self.gate(key, job) if self.gate is not None else None)
+            n += 1
+
+        return n
+
+    def process(self, key, job):
+        try:
+            result = self.handler(key, job)
+        except Exception as e:
+            logger.error("queued job %s failed: %s", key, repr(e))
+            self.queue.fail(key, self.worker_id, repr(e))
+            raise
+        else:
+            self.queue.complete(key, self.worker_id, result)
+        finally:
+            with self.lock:
+                self.leased.discard(key)
+
+    def progress(self, key, outputs):
+        if not self.queue.progress(key, self.worker_id, outputs):
+            logger.warning("unable to publish partial outputs of job %s", key)
+
+    def heartbeat(self):
+        with self.lock:
+            leased = list(self.leased)
+
+        for key in leased:
+            if not self.queue.heartbeat(key, self.worker_id):
+                logger.warning("lost lease of job %s", key)
+
+    def _poll_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error("unable to lease jobs: %s", repr(e))
+            self.stopped.wait(self.poll_interval)
+
+    def _heartbeat_loop(self):
+        while not self.stopped.wait(self.queue.visibility_timeout / 3.):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error("unable to renew leases: %s", repr(e))
+
+    def start(self):
+        for target in (self._poll_loop, self._heartbeat_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,49 @@
+import time
+import pytest
+
+
+def test_admission():
+    from nb2workflow.admission import AdmissionController, Overloaded
+    from nb2workflow.executor import Executor
+
+    signals = dict(load_per_cpu=0.5, disk_avail_mb=10000., memory_avail_mb=2000.)
+
+    executor = Executor(max_workers=2)
+    admission = AdmissionController(executor, max_queue_per_worker=1, min_available_mb=500, max_load_per_cpu=2, min_disk_mb=300)
+    admission.sample = lambda: dict(signals)
+
+    admission.record("spectrum", dict(peak_rss_mb=600., wall_seconds=20.))
+    assert admission.estimate("spectrum").memory_mb == 600.
+
+    first = admission.admit("spectrum")
+    second = admission.admit("spectrum")
+
+    # 2000 MB available, 1200 MB reserved for the admitted jobs
+    with pytest.raises(Overloaded) as e:
+        admission.admit("spectrum")
+    assert e.value.retry_after >= 20
+    assert admission.rejected["spectrum"] == 1
+
+    assert admission.admit("spectrum", background=True) is None
+
+    admission.release(first)
+    admission.release(second)
+    admission.release(admission.admit("spectrum"))
+
+    signals['load_per_cpu'] = 3.
+    admission._signals = None
+    with pytest.raises(Overloaded):
+        admission.admit("spectrum")
+    # background jobs are deferred under pressure, for at most max_defer_seconds
+    assert not admission.reserve_when_ready("spectrum", "job", time.time())
+    assert admission.reserve_when_ready("spectrum", "job", time.time() - admission.max_defer_seconds)
+    assert admission.status()['reserved_mb'] == 600.
+    admission.release("job")
+
+    signals['disk_avail_mb'] = 100.
+    admission._signals = None
+    with pytest.raises(Overloaded) as e:
+        admission.admit("spectrum", background=True)
+    assert "disk" in e.value.reason
+
+    assert admission.status()['reserved_mb'] == 0
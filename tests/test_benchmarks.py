@@ -0,0 +1,87 @@
+import json
+
+
+def test_synthetic_notebooks(tmpdir):
+    from benchmarks.synthetic import write_synthetic_repo, variant_name
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    variant = dict(n_cells=3, n_parameters=5, n_outputs=2, output_file_kb=1)
+    notebooks = write_synthetic_repo(str(tmpdir.join("repo")), [variant])
+
+    nba = NotebookAdapter(notebooks[variant_name(variant)])
+
+    assert len(nba.extract_parameters()) == 5
+    assert sorted(nba.extract_output_declarations()) == ["out0", "out1", "output_file"]
+
+
+def test_benchmark_report_is_json():
+    from benchmarks.run import run, quick_variants
+
+    report = run(quick_variants, repeat=2, execute_repeat=1, selected=["parse_notebook", "interpret_parameters"])
+
+    stages = json.loads(json.dumps(report))['benchmarks'][0]['stages']
+    assert stages['parse_notebook']['seconds']['n'] == 2
+    assert stages['interpret_parameters']['seconds']['median'] > 0
+
+
+def test_benchmark_failures():
+    from benchmarks.run import run, quick_variants, failures
+
+    report = run(quick_variants, repeat=1, execute_repeat=1, selected=["serialize_output"])
+    assert failures(report) == []
+    assert report['benchmarks'][0]['stages']['serialize_output_bytes'] > 0
+
+    report['benchmarks'][0]['stages']['execute'] = dict(error="Exception()")
+    report['end_to_end'] = dict(load=[dict(variant=quick_variants[0], concurrency=1, requests=2, errors=2)])
+    assert len(failures(report)) == 2
+
+
+def test_startup_benchmark():
+    from benchmarks.startup import measure_startup, regressions
+
+    report = measure_startup(repeat=1)
+
+    assert regressions(report, max_seconds=30) == []
+
+    baseline = dict(cold_start_seconds=dict(median=report['cold_start_seconds']['median'] / 2))
+    assert len(regressions(report, baseline, tolerance=0.25)) == 1
+
+
+def test_startup_profile():
+    import sys
+    from nb2workflow.startup import StartupProfile
+
+    sys.modules.pop('colorsys', None)
+
+    profile = StartupProfile()
+    profile.record_imports()
+    try:
+        with profile.phase("find notebooks"):
+            import colorsys
+    finally:
+        profile.stop_recording_imports()
+
+    profile.request_served()
+
+    summary = profile.summary()
+    assert 'colorsys' in summary['imports']
+    assert summary['phases'][0][0] == "find notebooks"
+    assert summary['seconds_to_first_request'] > 0
+    assert "colorsys" in profile.report()
+
+
+def test_engines_benchmark():
+    from benchmarks.engines import compare_engines
+    from benchmarks.run import quick_variants
+    from nb2workflow import forkserver
+
+    preload = forkserver.preload
+    forkserver.preload = []
+    try:
+        report = compare_engines(quick_variants, repeat=1, selected=["compiled", "forkserver"])
+    finally:
+        forkserver.preload = preload
+
+    engines = json.loads(json.dumps(report))['benchmarks'][0]['engines']
+    assert engines['forkserver']['seconds']['n'] == 1
+    assert engines['compiled']['seconds']['median'] > 0
@@ -0,0 +1,78 @@
+import io
+import os
+import hashlib
+
+import pytest
+
+
+def test_blob_store(tmpdir):
+    from nb2workflow.blobstore import BlobStore, UploadOffsetMismatch, BlobError, UploadTooLarge, parse_reference, reference
+
+    store = BlobStore(str(tmpdir.join("blobs")), max_size_mb=1)
+    content = b"events" * 1000
+    digest = hashlib.sha256(content).hexdigest()
+
+    upload_id = store.begin()
+    assert store.append(upload_id, 0, io.BytesIO(content[:100])) == 100
+
+    # a lost chunk is resent from the offset the store has
+    with pytest.raises(UploadOffsetMismatch) as e:
+        store.append(upload_id, 200, io.BytesIO(content[200:]))
+    assert e.value.offset == store.offset(upload_id) == 100
+
+    store.append(upload_id, 100, io.BytesIO(content[100:]))
+    assert store.finish(upload_id, digest) == digest
+    assert store.exists(digest)
+
+    # the same content is stored once
+    assert store.put(io.BytesIO(content)) == digest
+    assert os.listdir(os.path.join(store.root, "uploads")) == []
+    assert store.status()['blobs'] == 1
+
+    with pytest.raises(BlobError):
+        store.put(io.BytesIO(b"other"), digest)
+
+    with pytest.raises(UploadTooLarge):
+        store.put(io.BytesIO(b"x" * (2*1024*1024)))
+
+    assert parse_reference(reference(digest)) == digest
+    assert parse_reference("blob:sha256:abc") is None
+
+    workdir = str(tmpdir.join("job"))
+    os.makedirs(workdir)
+    parameters = store.link_inputs(dict(events=reference(digest), nbins=3), workdir)
+
+    assert parameters['nbins'] == 3
+    fn = os.path.join(workdir, parameters['events'])
+    assert open(fn, "rb").read() == content
+    assert os.stat(fn).st_ino == os.stat(store.path(digest)).st_ino
+
+
+def test_blob_parameters(tmpdir):
+    import nbformat
+    from nb2workflow import blobstore
+    from nb2workflow.nbadapter import NotebookAdapter
+    from test_compiled import write_repo, tagged_cell
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+            tagged_cell("events = 'events.txt'", "parameters"),
+            nbformat.v4.new_code_cell(source="n_events = len(open(events).read().split())"),
+            tagged_cell("n_events = n_events", "outputs"),
+        ])
+
+    store = blobstore.BlobStore(str(tmpdir.join("blobs")))
+    blobstore.set_store(store)
+    try:
+        digest = store.put(io.BytesIO(b"1 2 3 4"))
+
+        nba = NotebookAdapter(fn)
+        interpreted = nba.interpret_parameters(dict(events=blobstore.reference(digest)))
+        assert interpreted['issues'] == []
+
+        assert nba.execute(interpreted['request_parameters']) == []
+        assert nba.extract_output()['n_events'] == 4
+
+        missing = nba.interpret_parameters(dict(events=blobstore.reference("0"*64)))
+        assert "not uploaded" in missing['issues'][0]
+    finally:
+        blobstore.set_store(None)
@@ -0,0 +1,120 @@
+import time
+
+import nbformat
+
+from test_compiled import tagged_cell, write_repo
+
+
+def test_required_cells():
+    from nb2workflow.celldeps import required_cells, select_output_lines, output_ready_after
+
+    cells = [
+        ('code', "import numpy as np", []),
+        ('code', "emin = 20.\nnbins = 4", ['parameters']),
+        ('markdown', "# spectrum", []),
+        ('code', "spectrum = np.linspace(emin, 100., nbins)", []),
+        ('code', "print(spectrum)", []),
+        ('code', "lc = [1, 2, 3]\nlc.append(4)", []),
+        ('code', "fn = 'lc.txt'\nnp.savetxt(fn, lc)", []),
+        ('code', "spectrum = spectrum\nlc = lc\nlc_txt = fn", ['outputs']),
+        ('code', "cache_timeout = 60", ['system-parameters']),
+    ]
+
+    # the cells writing the light curve file, and changing lc, may matter to any output
+    assert required_cells(cells, ["spectrum"]) == set([0, 1, 3, 4, 5, 6, 7])
+    assert required_cells(cells, ["lc_txt"]) == set([0, 1, 5, 6, 7])
+    assert required_cells(cells[:6] + cells[7:], ["lc"]) == set([1, 5, 6])
+
+    assert required_cells([('code', "%%bash\nls", [])] + cells, ["spectrum"]) == set([0, 1, 2, 4, 5, 6, 7, 8])
+
+    assert select_output_lines(cells[7][1], ["lc"]) == "lc = lc"
+
+    assert output_ready_after(cells, ["spectrum", "lc", "lc_txt"]) == dict(spectrum=6, lc=6, lc_txt=6)
+
+
+def test_file_outputs():
+    from nb2workflow.celldeps import required_cells, output_ready_after
+
+    cells = [
+        ('code', "emin = 20.", ['parameters']),
+        ('code', "spectrum = [emin, emin * 2]", []),
+        ('code', "lc = [1, 2]\nprint(lc)", []),
+        ('code', "import time\ntime.sleep(1)\nlogger.info('slow')", []),
+        ('code', "import matplotlib.pyplot as plt\nplt.plot(spectrum)\nplt.savefig('spectrum.png')", []),
+        ('code', "if emin < 0:\n    raise Exception('negative energy')", []),
+        ('code', "spectrum_png = 'spectrum.png'\nlc = lc", ['outputs']),
+    ]
+
+    # the figure file is written by a cell no output name depends on
+    assert required_cells(cells, ["spectrum_png"]) == set([0, 1, 4, 6])
+    assert required_cells(cells, ["lc"]) == set([0, 1, 2, 4, 6])
+
+    # outputs are not final before the figure is written
+    assert output_ready_after(cells, ["spectrum_png", "lc"]) == dict(spectrum_png=4, lc=4)
+
+
+def test_file_outputs_execution(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        tagged_cell("emin = 20.", "parameters"),
+        nbformat.v4.new_code_cell(source="spectrum = [emin, emin * 2]"),
+        nbformat.v4.new_code_cell(source="with open('spectrum.txt', 'w') as f:\n    f.write(repr(spectrum))"),
+        tagged_cell("spectrum_txt = 'spectrum.txt'\nemin = emin", "outputs"),
+    ])
+
+    nba = NotebookAdapter(fn)
+    assert nba.execution_engine == "compiled"
+    assert nba.execute(dict(emin=10.), outputs=["spectrum_txt"]) == []
+    assert 'spectrum_txt_content' in nba.extract_output()
+
+
+def test_compiled_partial_execution(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        tagged_cell("emin = 20.", "parameters"),
+        nbformat.v4.new_code_cell(source="spectrum = [emin, emin * 2]"),
+        nbformat.v4.new_code_cell(source="raise Exception('slow and broken light curve')"),
+        nbformat.v4.new_code_cell(source="lc = [1, 2]"),
+        tagged_cell("spectrum = spectrum\nlc = lc", "outputs"),
+    ])
+
+    nba = NotebookAdapter(fn)
+    assert nba.execution_engine == "compiled"
+    assert nba.execute(dict(emin=10.), outputs=["spectrum"]) == []
+    assert nba.extract_output() == dict(spectrum=[10., 20.])
+
+    nba = NotebookAdapter(fn)
+    assert len(nba.execute(dict(emin=10.))) == 1
+
+
+def test_partial_outputs(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        tagged_cell("emin = 20.", "parameters"),
+        nbformat.v4.new_code_cell(source="lc = [emin, emin * 2]"),
+        nbformat.v4.new_code_cell(source="import time\ntime.sleep(1.5)"),
+        nbformat.v4.new_code_cell(source="spectrum = [x + 1 for x in lc]"),
+        tagged_cell("lc = lc\nspectrum = spectrum", "outputs"),
+    ])
+
+    nba = NotebookAdapter(fn)
+    assert nba.execution_engine == "compiled"
+
+    t0 = time.time()
+    recorded = []
+    assert nba.execute(dict(emin=10.), on_output=lambda name, value: recorded.append((name, value, time.time() - t0))) == []
+
+    assert [r[:2] for r in recorded] == [("lc", [10., 20.]), ("spectrum", [11., 21.])]
+    # the light curve was published before the slow cell finished
+    assert recorded[0][2] < 1.5 < recorded[1][2]
+    assert nba.extract_output() == dict(lc=[10., 20.], spectrum=[11., 21.])
+
+    # notebooks executed by papermill get cells recording the outputs, after the parameters are injected
+    nba = NotebookAdapter(fn)
+    nba.inject_output_gathering(None, record_partial=True)
+    tags = [cell.metadata.get('tags', []) for cell in nbformat.read(nba.preproc_notebook_fn, as_version=4).cells]
+    assert tags[:5] == [['parameters'], [], ['injected-record-output'], [], []]
+    assert tags[5] == ['injected-record-output']
@@ -0,0 +1,79 @@
+import os
+
+import nbformat
+
+from test_compiled import tagged_cell, write_repo
+
+
+def test_independent_prefix():
+    from nb2workflow.checkpoint import independent_prefix, definitions_source
+
+    cells = [
+        ('code', "%matplotlib inline\nimport numpy as np", []),
+        ('markdown', "# setup", []),
+        ('code', "emin = 20.\nemax = 100.", ['parameters']),
+        ('code', "def load(fn):\n    return open(fn).read()\ncatalog = load('catalog.txt')", []),
+        ('code', "selection = [s for s in catalog if s > emin]", []),
+        ('code', "spectrum = selection", ['outputs']),
+    ]
+
+    assert independent_prefix(cells, ["emin", "emax"]) == 4
+    assert independent_prefix(cells[:2] + [('code', "emin = 5", [])] + cells[2:], ["emin", "emax"]) == 1
+    assert independent_prefix([('code', "%%bash\nls", [])] + cells, ["emin"]) == 0
+
+    assert definitions_source(cells[3][1]) == "def load(fn):\n    return open(fn).read()"
+
+
+def test_compiled_checkpoint(tmpdir):
+    from nb2workflow import checkpoint
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    checkpoint.checkpoint_dir = str(tmpdir.join("checkpoints"))
+    counter = str(tmpdir.join("counter"))
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        nbformat.v4.new_code_cell(source="import os"),
+        tagged_cell("emin = 20.", "parameters"),
+        nbformat.v4.new_code_cell(source="\n".join([
+            "open(%s, 'a').write('x')"%repr(counter),
+            "catalog = [10., 30., 50.]",
+            "open('catalog.txt', 'w').write(repr(catalog))",
+        ])),
+        nbformat.v4.new_code_cell(source="spectrum = [c for c in eval(open('catalog.txt').read()) if c > emin]"),
+        tagged_cell("spectrum = spectrum", "outputs"),
+        tagged_cell("checkpoint_timeout = 3600", "system-parameters"),
+    ])
+
+    for emin, expected in (20., [30., 50.]), (40., [50.]):
+        nba = NotebookAdapter(fn)
+        assert nba.checkpoint_plan().prefix == 3
+        assert nba.execute(dict(emin=emin)) == []
+        assert nba.extract_output()['spectrum'] == expected
+
+    assert open(counter).read() == "x"
+
+
+def test_checkpoint_signed(tmpdir):
+    import pytest
+    from nb2workflow import checkpoint
+
+    directory = str(tmpdir.join("checkpoints"))
+    path = os.path.join(directory, "nbhash-3.pickle")
+
+    checkpoint.private_dir(directory)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    checkpoint.write_checkpoint(path, dict(state=dict(values={}, modules={}, files={})))
+    assert checkpoint.read_checkpoint(path, 3600) == dict(values={}, modules={}, files={})
+
+    # a checkpoint written without the key of the directory is not unpickled
+    data = open(path, "rb").read()
+    open(path, "wb").write(b"x" * 32 + data[32:])
+    assert checkpoint.read_checkpoint(path, 3600) is None
+
+    # neither are checkpoints in a directory others can write to
+    shared = str(tmpdir.join("shared"))
+    os.makedirs(shared)
+    os.chmod(shared, 0o777)
+    with pytest.raises(checkpoint.UntrustedCheckpoint):
+        checkpoint.write_checkpoint(os.path.join(shared, "nbhash-3.pickle"), dict(error="none"))
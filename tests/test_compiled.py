@@ -0,0 +1,153 @@
+import os
+import subprocess
+
+import nbformat
+
+
+def tagged_cell(source, tag):
+    cell = nbformat.v4.new_code_cell(source=source)
+    cell.metadata['tags'] = [tag]
+    return cell
+
+
+def write_repo(location, cells):
+    os.makedirs(location)
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = cells
+    fn = os.path.join(location, "workflow-notebook.ipynb")
+    nbformat.write(nb, fn)
+
+    open(os.path.join(location, "data.txt"), "w").write("12")
+
+    subprocess.check_call(["git", "init", "-q", location])
+    subprocess.check_call(["git", "-C", location, "add", "."])
+    subprocess.check_call(["git", "-C", location, "-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "-q", "-m", "test"])
+
+    return fn
+
+
+def plain_cells():
+    return [
+        nbformat.v4.new_code_cell(source="import os"),
+        tagged_cell("emin = 20.\nnbins = 2", "parameters"),
+        nbformat.v4.new_code_cell(source="offset = int(open('data.txt').read())\nassert nbins > 0, 'need bins'\nspectrum = [emin + offset + i for i in range(nbins)]\nopen('spectrum.txt', 'w').write(repr(spectrum))"),
+        tagged_cell("spectrum = spectrum\nspectrum_txt = 'spectrum.txt'", "outputs"),
+    ]
+
+
+def test_compiled_execution(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.workflows import serialize_workflow_exception
+
+    fn = write_repo(str(tmpdir.join("repo")), plain_cells())
+
+    nba = NotebookAdapter(fn)
+    assert nba.execution_engine == "compiled"
+
+    exceptions = nba.execute(dict(emin=30., nbins=3))
+    assert exceptions == []
+
+    output = nba.extract_output()
+    assert output['spectrum'] == [42., 43., 44.]
+    assert output['spectrum_txt'] == 'spectrum.txt'
+    assert 'spectrum_txt_content' in output
+
+    nba = NotebookAdapter(fn)
+    exceptions = nba.execute(dict(nbins=0))
+    assert len(exceptions) == 1
+
+    e = serialize_workflow_exception(exceptions[0])
+    assert e['ename'] == 'AssertionError'
+    assert e['evalue'] == 'need bins'
+
+    # the trace has the parameters of the job, and the error in the cell which raised it
+    nb = nbformat.read(nba.output_notebook_fn, as_version=4)
+    assert nb.cells[2].metadata['tags'] == ['injected-parameters']
+    assert "nbins = 0" in nb.cells[2].source
+    assert nb.cells[3].outputs[0]['ename'] == 'AssertionError'
+
+
+def test_compiled_failure(tmpdir, monkeypatch):
+    import pytest
+    from nb2workflow import compiled
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = write_repo(str(tmpdir.join("repo")), plain_cells())
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("worker died")
+
+    monkeypatch.setattr(compiled, "execute", broken)
+
+    # the job is not run again in a kernel
+    nba = NotebookAdapter(fn)
+    with pytest.raises(RuntimeError):
+        nba.execute(dict(emin=30.))
+    assert not os.path.exists(nba.output_notebook_fn)
+
+
+def test_compiled_eligibility(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    cells = plain_cells()
+    cells.insert(0, nbformat.v4.new_code_cell(source="%matplotlib inline"))
+    fn = write_repo(str(tmpdir.join("magics")), cells)
+    assert NotebookAdapter(fn).execution_engine == "papermill"
+
+    cells = plain_cells()
+    cells.append(tagged_cell("execution_engine = \"papermill\"", "system-parameters"))
+    fn = write_repo(str(tmpdir.join("opt-out")), cells)
+    assert NotebookAdapter(fn).execution_engine == "papermill"
+
+
+def test_forkserver_execution(tmpdir):
+    from nb2workflow import forkserver
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.workflows import serialize_workflow_exception
+
+    cells = plain_cells()
+    cells.append(tagged_cell("execution_engine = \"forkserver\"", "system-parameters"))
+    cells.insert(3, nbformat.v4.new_code_cell(source="import time\ntime.sleep(max(0, emin - 40))"))
+    fn = write_repo(str(tmpdir.join("repo")), cells)
+
+    forkserver.preload = ["json"]
+    try:
+        nba = NotebookAdapter(fn)
+        assert nba.execution_engine == "forkserver"
+
+        assert nba.execute(dict(emin=30., nbins=3)) == []
+        assert nba.extract_output()['spectrum'] == [42., 43., 44.]
+
+        zygote = forkserver.get_zygote()
+
+        forkserver.timeout = 1
+        nba = NotebookAdapter(fn)
+        exceptions = nba.execute(dict(emin=60.))
+        assert serialize_workflow_exception(exceptions[0])['ename'] == 'TimeoutError'
+
+        # jobs run in children forked from the same zygote
+        assert forkserver.get_zygote() is zygote
+        assert zygote.alive()
+    finally:
+        forkserver.timeout = None
+        forkserver.stop()
+
+
+class ExitOnLoad(object):
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
+def test_forkserver_child_death():
+    import pytest
+    from nb2workflow import forkserver
+
+    zygote = forkserver.Zygote(modules=[])
+    try:
+        # the child dies reading the request, before it reports being started
+        with pytest.raises(forkserver.ForkserverError):
+            zygote.run(dict(request=ExitOnLoad()))
+        assert zygote.alive()
+    finally:
+        zygote.stop()
@@ -0,0 +1,26 @@
+def test_duration_model():
+    from nb2workflow.durations import DurationModel, retry_after
+
+    model = DurationModel(min_samples=2)
+    model.condition_on("spectrum", "nbins")
+
+    assert model.estimate("spectrum") is None
+
+    for seconds in (10, 12, 11):
+        model.record("spectrum", dict(nbins=10, emin=20.), seconds)
+    model.record("spectrum", dict(nbins=1000, emin=20.), 100)
+
+    assert model.estimate("spectrum") == 12
+    assert model.estimate("spectrum", dict(nbins=10, emin=30.)) == 11
+    # too few jobs with these parameters
+    assert model.estimate("spectrum", dict(nbins=1000)) == 12
+
+    model.record("spectrum", dict(nbins=1000, emin=30.), 120)
+    assert model.estimate("spectrum", dict(nbins=1000)) in (100, 120)
+    assert model.estimate("spectrum", dict(nbins=1000), q=0.9) == 120
+
+    assert model.status()['spectrum']['n'] == 5
+
+    assert retry_after(None) == 1
+    assert retry_after(2.2) == 3
+    assert retry_after(3600) == 60
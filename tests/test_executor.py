@@ -0,0 +1,171 @@
+import time
+import threading
+
+
+def test_job_events():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=1)
+    release = threading.Event()
+
+    executor.submit_job("blocker", release.wait)
+    executor.submit_job("job", lambda: None)
+
+    assert executor.events.get("job")['status'] == "queued"
+    assert executor.events.wait("job", timeout=0.1)['status'] == "queued"
+
+    version = executor.events.get("job")['version']
+
+    t0 = time.time()
+    threading.Timer(0.2, release.set).start()
+    job = executor.events.wait("job", since=version, timeout=5)
+
+    assert job['status'] in ("running", "done")
+    assert time.time() - t0 < 2
+
+    assert executor.events.wait("job", timeout=5)['status'] == "done"
+    assert executor.events.wait("unknown", timeout=5) is None
+
+
+def test_job_events_expire():
+    from nb2workflow.executor import JobEvents
+
+    events = JobEvents(ttl=0.1)
+    events.publish("done", "done")
+    events.publish("running", "running")
+
+    time.sleep(0.2)
+    events.publish("other", "queued")
+
+    # finished jobs are forgotten after the ttl, others are kept
+    assert events.get("done") is None
+    assert events.get("running")['status'] == "running"
+
+
+def test_lanes():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=1, lane_weights={"interactive": 8, "async": 1})
+    release = threading.Event()
+    started = []
+
+    executor.submit(release.wait)
+    for i in range(3):
+        executor.submit(started.append, "async")
+
+    t = threading.Thread(target=executor.run, args=(started.append, "interactive"))
+    t.start()
+
+    while executor.queued < 4:
+        time.sleep(0.01)
+
+    assert executor.status()['lanes']['async']['waiting'] == 3
+    assert executor.status()['lanes']['interactive']['waiting'] == 1
+
+    release.set()
+    t.join(5)
+    executor.queue.join()
+
+    # the interactive call is not queued behind earlier background jobs
+    assert started[0] == "interactive"
+    assert len(started) == 4
+
+
+def test_target_limits():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=3)
+    executor.set_target_limit("spectrum", 1)
+
+    lock = threading.Lock()
+    running = dict(spectrum=0, image=0)
+    peak = dict(spectrum=0, image=0)
+
+    def job(target):
+        with lock:
+            running[target] += 1
+            peak[target] = max(peak[target], running[target])
+        time.sleep(0.05)
+        with lock:
+            running[target] -= 1
+
+    for i in range(3):
+        executor.submit(job, "spectrum", target="spectrum")
+        executor.submit(job, "image", target="image")
+
+    executor.queue.join()
+
+    assert peak['spectrum'] == 1
+    assert peak['image'] > 1
+    assert executor.status()['target_limits'] == dict(spectrum=1)
+
+
+def test_shortest_expected_job_first():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=1)
+    release = threading.Event()
+    started = []
+
+    executor.submit_job("blocker", release.wait, estimate=100)
+    executor.submit_job("long", started.append, "long", estimate=60)
+    executor.submit_job("short", started.append, "short", estimate=1)
+
+    assert 0 < executor.eta("blocker") <= 100
+    # the short job goes first, after the blocker is expected to finish
+    assert 100 < executor.eta("short") < executor.eta("long") <= 100 + 1 + 60
+    assert executor.eta("unknown") is None
+
+    release.set()
+    executor.queue.join()
+
+    assert started == ["short", "long"]
+    assert executor.eta("short") is None
+
+
+def test_gate():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=1, gate_interval=0.05)
+    ready = threading.Event()
+    started = []
+
+    # a held job does not take the slot of the jobs behind it
+    executor.submit_job("deferred", started.append, "deferred", gate=ready.is_set, estimate=1)
+    executor.submit_job("other", started.append, "other", estimate=5)
+
+    deadline = time.time() + 5
+    while executor.events.get("other")['status'] != "done" and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert started == ["other"]
+    assert executor.status()['queued'] == 1
+
+    ready.set()
+    deadline = time.time() + 5
+    while executor.events.get("deferred")['status'] != "done" and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert started == ["other", "deferred"]
+
+
+def test_slow_gate():
+    from nb2workflow.executor import Executor
+
+    executor = Executor(max_workers=2, gate_interval=0.05)
+
+    def slow_gate():
+        time.sleep(1)
+        return True
+
+    threading.Thread(target=executor.submit_job, args=("deferred", lambda: None), kwargs=dict(gate=slow_gate)).start()
+    time.sleep(0.1)
+
+    # other jobs are submitted, started and finished while the gate is asked
+    t0 = time.time()
+    executor.submit_job("other", lambda: None)
+    assert executor.events.wait("other", timeout=5)['status'] == "done"
+    assert executor.status()['queued'] == 1
+    assert time.time() - t0 < 0.5
+
+    assert executor.events.wait("deferred", timeout=5)['status'] == "done"
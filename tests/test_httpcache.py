@@ -0,0 +1,98 @@
+import gzip
+import json
+import pickle
+
+from flask import Flask, Response, request
+
+
+def result(obj, status=200, cache_timeout=0):
+    from nb2workflow.httpcache import ResultBody
+    from nb2workflow.jsonstream import JSONStream
+
+    body = ResultBody(JSONStream(obj), precompress=status == 200 and cache_timeout > 0)
+
+    response = Response(body.stream, status=status, mimetype='application/json')
+    response.result_body = body
+    response.cache_timeout = cache_timeout
+    return response
+
+
+def test_negotiate():
+    from nb2workflow.httpcache import negotiate
+
+    app = Flask(__name__)
+    obj = dict(output=dict(spectrum=list(range(1000))), exceptions=[])
+
+    cached = pickle.loads(pickle.dumps(result(obj, cache_timeout=600)))
+    assert set(cached.result_body.encoded) >= set(["gzip"])
+
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip, deflate'}):
+        r = negotiate(cached, request)
+        assert r.headers['Content-Encoding'] == "gzip"
+        assert r.headers['Cache-Control'] == "public, max-age=600"
+        assert json.loads(gzip.decompress(b"".join(r.response))) == obj
+        etag = r.get_etag()[0]
+
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"%s"'%etag}):
+        assert negotiate(result(obj, cache_timeout=600), request).status_code == 304
+
+    with app.test_request_context('/', headers={'If-None-Match': '"%s"'%etag}):
+        r = negotiate(result(obj), request)
+        assert r.status_code == 200
+        assert 'Content-Encoding' not in r.headers
+        assert r.headers['Cache-Control'] == "no-cache"
+        assert json.loads(b"".join(r.response)) == obj
+        assert r.get_etag()[0] != etag
+
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+        r = negotiate(result(dict(output={}), status=500), request)
+        assert r.status_code == 500
+        assert r.get_etag()[0] is None
+        assert 'Content-Encoding' not in r.headers
+
+
+def test_encoded_once():
+    from nb2workflow.httpcache import ResultBody
+    from nb2workflow.jsonstream import JSONStream
+
+    class CountingStream(JSONStream):
+        passes = 0
+
+        def __iter__(self):
+            CountingStream.passes += 1
+            return super(CountingStream, self).__iter__()
+
+    obj = dict(output=dict(spectrum=list(range(10000))))
+
+    # cacheable bodies are encoded when they are made, and sent from what was encoded
+    body = ResultBody(CountingStream(obj, chunk_size=1024), precompress=True)
+    assert len(body.chunks) > 1
+    assert json.loads(b"".join(body.iter_encoded("identity"))) == obj
+    assert json.loads(gzip.decompress(b"".join(body.iter_encoded("gzip")))) == obj
+    assert CountingStream.passes == 1
+
+    # other bodies are encoded while they are sent
+    body = ResultBody(CountingStream(obj, chunk_size=1024))
+    body.start()
+    assert len(body.head) == 1
+    assert body.content_length("identity") is None
+    assert json.loads(gzip.decompress(b"".join(body.iter_encoded("gzip")))) == obj
+    assert CountingStream.passes == 2
+
+
+def test_streamed():
+    from nb2workflow.httpcache import negotiate
+
+    app = Flask(__name__)
+    obj = dict(output=dict(spectrum=list(range(1000))), exceptions=[])
+
+    with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+        r = negotiate(result(obj), request)
+        assert r.get_etag()[0] is None
+        assert 'Content-Length' not in r.headers
+        assert r.headers['Content-Encoding'] == "gzip"
+        assert json.loads(gzip.decompress(b"".join(r.response))) == obj
+
+        r = negotiate(result(dict(output=1)), request)
+        assert 'Content-Encoding' not in r.headers
+        assert r.headers['Content-Length'] == str(len(b"".join(r.response)))
@@ -0,0 +1,29 @@
+import json
+import pickle
+
+from nb2workflow.jsonstream import JSONStream, select_output
+
+
+def test_json_stream():
+    result = dict(
+                output=dict(spectrum=list(range(10000)), spectrum_png="spectrum.png", spectrum_png_content="A"*100000),
+                exceptions=[],
+                jobdir="/tmp/job",
+            )
+
+    stream = JSONStream(result, chunk_size=1024)
+    chunks = list(stream)
+
+    assert len(chunks) > 1
+    assert json.loads(b"".join(chunks).decode()) == result
+
+    assert b"".join(pickle.loads(pickle.dumps(stream))) == b"".join(chunks)
+
+
+def test_select_output():
+    output = dict(spectrum=[1, 2], spectrum_png="spectrum.png", spectrum_png_content="AAAA", lc=[3])
+
+    assert select_output(output, fields=["spectrum_png"]) == dict(spectrum_png="spectrum.png", spectrum_png_content="AAAA")
+    assert select_output(output, exclude_content=True) == dict(spectrum=[1, 2], spectrum_png="spectrum.png", lc=[3])
+    assert select_output(output, fields=["spectrum_png", "lc"], exclude_content=True) == dict(spectrum_png="spectrum.png", lc=[3])
+    assert select_output("incomplete", fields=["lc"]) == "incomplete"
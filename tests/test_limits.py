@@ -0,0 +1,68 @@
+import sys
+import time
+import subprocess
+
+import nbformat
+
+from test_compiled import tagged_cell, write_repo
+
+
+def test_job_limits(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.workflows import serialize_workflow_exception
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        tagged_cell("duration = 0.\nsize_mb = 1", "parameters"),
+        nbformat.v4.new_code_cell(source="\n".join([
+            "import time",
+            "t0 = time.time()",
+            "while time.time() - t0 < duration: pass",
+            "open('output.bin', 'wb').write(b'x' * size_mb * 1024 * 1024)",
+        ])),
+        tagged_cell("duration = duration", "outputs"),
+        tagged_cell("max_wall_seconds = 3\nmax_cpu_seconds = 2\nmax_output_mb = 5", "system-parameters"),
+    ])
+
+    nba = NotebookAdapter(fn)
+    # jobs with limits are not run in the shared in-process workers
+    assert nba.execution_engine == "forkserver"
+    assert nba.execute(dict(duration=1.5)) == []
+    assert nba.resource_usage['violation'] is None
+    assert nba.resource_usage['cpu_seconds'] > 1.2
+    assert nba.resource_usage['peak_rss_mb'] > 0
+    assert 1 < nba.resource_usage['output_mb'] < 2
+    assert nba.resource_usage['limits']['wall_seconds'] == 3
+
+    t0 = time.time()
+    nba = NotebookAdapter(fn)
+    exceptions = nba.execute(dict(duration=30.))
+    assert time.time() - t0 < 10
+
+    assert len(exceptions) == 1
+    e = serialize_workflow_exception(exceptions[0])
+    assert e['ename'] == "ResourceLimitExceeded"
+    assert nba.resource_usage['violation']['resource'] in ("cpu", "wall time")
+
+    nba = NotebookAdapter(fn)
+    exceptions = nba.execute(dict(size_mb=10))
+    assert len(exceptions) == 1
+    assert nba.resource_usage['violation']['resource'] == "output size"
+    assert nba.resource_usage['output_mb'] >= 10
+
+
+def test_shared_processes(tmpdir):
+    from nb2workflow.limits import JobMonitor, ResourceLimits
+
+    worker = subprocess.Popen([sys.executable, "-c", "import time\nt0 = time.time()\nwhile time.time() - t0 < 3: pass"], cwd=str(tmpdir))
+    try:
+        time.sleep(1)
+
+        with JobMonitor(str(tmpdir), ResourceLimits(cpu_seconds=0.5), poll_interval=0.1, shared_pids=[worker.pid]) as monitor:
+            time.sleep(0.7)
+
+        # the work done before the job is not counted, and the shared process is not killed
+        assert monitor.violation is not None
+        assert monitor.cpu_seconds < 1.3
+        assert worker.poll() is None
+    finally:
+        worker.wait()
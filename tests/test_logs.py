@@ -0,0 +1,86 @@
+import io
+import json
+import logging
+import threading
+
+import nbformat
+
+from test_compiled import tagged_cell, write_repo
+
+
+def test_structured_logging():
+    from nb2workflow import logs
+
+    assert str(logs.payload("x" * 20, limit=5)) == "xxxxx... [20 chars]"
+    assert str(logs.payload(dict(a=1))) == "{'a': 1}"
+
+    stream = io.StringIO()
+    handler = logs.MeasuredStreamHandler(stream)
+    handler.setFormatter(logs.JSONFormatter())
+
+    logger = logging.getLogger("nb2workflow.test_logs")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    try:
+        records = logs.stats.records
+        logs.log_event(logger, logging.INFO, "async job done", key="abc", output="y" * 5000)
+        logs.log_event(logger, logging.DEBUG, "not emitted", output="y" * 5000)
+
+        handler.addFilter(logs.SamplingFilter(rate=0.))
+        logger.info("sampled out")
+        logger.warning("kept")
+    finally:
+        logger.removeHandler(handler)
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [e['message'][:14] for e in entries] == ["async job done", "kept"]
+    assert entries[0]['fields']['key'] == "abc"
+    assert len(entries[0]['fields']['output']) < 1100
+    assert logs.stats.records == records + 2
+    assert logs.stats.thread_seconds() > 0
+
+
+def test_job_output_capture(tmpdir):
+    from nb2workflow import logs
+
+    papermill_logger = logging.getLogger('papermill')
+    seen = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            seen.append(record.getMessage())
+
+    collect = Collect()
+    papermill_logger.addHandler(collect)
+
+    try:
+        with logs.capture_job_output(str(tmpdir.join("job.log"))):
+            papermill_logger.warning("kernel output")
+
+            other = threading.Thread(target=papermill_logger.warning, args=("other job",))
+            other.start()
+            other.join()
+
+        papermill_logger.warning("after the job")
+    finally:
+        papermill_logger.removeHandler(collect)
+
+    assert tmpdir.join("job.log").read() == "kernel output\n"
+    assert seen == ["other job", "after the job"]
+
+
+def test_compiled_job_output(tmpdir):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = write_repo(str(tmpdir.join("repo")), [
+        tagged_cell("x = 1", "parameters"),
+        nbformat.v4.new_code_cell(source="print('computing', x)\ny = x + 1"),
+        tagged_cell("y = y", "outputs"),
+    ])
+
+    nba = NotebookAdapter(fn)
+    assert nba.execute(dict(x=2)) == []
+    assert nba.extract_output()['y'] == 3
+    assert "computing 2" in open(nba.job_log_fn).read()
@@ -76,3 +76,102 @@ def test_nbadapter_repo():
 
        # assert 'spectrum' in output
         
+
+def test_parameter_schema(tmpdir):
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    cell = nbformat.v4.new_code_cell(source="\n".join([
+                "emin = 20. # keV",
+                "nbins = 10",
+                "use_background = True",
+                "scwids = [\"066500220010.001\"]",
+                "options = {}",
+                "scwid = \"066500220010.001\" # http://odahub.io/ontology/integral#ScWID",
+            ]))
+    cell.metadata['tags'] = ['parameters']
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [cell]
+
+    fn = str(tmpdir.join("typed-notebook.ipynb"))
+    nbformat.write(nb, fn)
+
+    nba = NotebookAdapter(fn)
+
+    r = nba.interpret_parameters(dict(
+                emin="25",
+                nbins=12,
+                use_background="False",
+                scwids='["066500220020.001", "066500220030.001"]',
+                options={"mode": "fast"},
+                _async_request="yes",
+            ))
+
+    assert r['issues'] == []
+    assert r['request_parameters'] == dict(
+                emin=25.,
+                nbins=12,
+                use_background=False,
+                scwids=["066500220020.001", "066500220030.001"],
+                options={"mode": "fast"},
+            )
+
+    r = nba.interpret_parameters(dict(nbins="1.5", use_background="maybe", scwids="{}", eminFAKE=1))
+    assert len(r['issues']) == 2
+    assert "eminFAKE" in r['issues'][0]
+    for name in "nbins", "use_background", "scwids":
+        assert name in r['issues'][1]
+
+    assert NotebookAdapter(fn).parameter_schema is nba.parameter_schema
+
+
+def test_output_completion(tmpdir):
+    import pytest
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter, OutputNotReady, write_notebook_atomically
+    from test_compiled import plain_cells, write_repo
+
+    fn = write_repo(str(tmpdir.join("repo")), plain_cells())
+
+    nba = NotebookAdapter(fn)
+    with pytest.raises(OutputNotReady):
+        nba.extract_output()
+
+    assert nba.execute(dict(nbins=0), outputs=["spectrum"]) != []
+    assert nba.output_ready
+    assert nba.extract_output() == dict()
+
+    nb = nbformat.read(fn, as_version=4)
+    write_notebook_atomically(nb, str(tmpdir.join("copy.ipynb")))
+    assert nbformat.read(str(tmpdir.join("copy.ipynb")), as_version=4) == nb
+    assert sorted(os.listdir(str(tmpdir))) == ["copy.ipynb", "repo"]
+
+
+def test_job_adapter(tmpdir, monkeypatch):
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter
+    from test_compiled import plain_cells, write_repo
+
+    fn = write_repo(str(tmpdir.join("repo")), plain_cells())
+
+    nba = NotebookAdapter(fn)
+    assert nba.execution_engine == "compiled"
+
+    reads = []
+    def reads_counted(*args, **kwargs):
+        reads.append(args)
+        return nbformat_reads(*args, **kwargs)
+
+    nbformat_reads = nbformat.reads
+    monkeypatch.setattr(nbformat, "reads", reads_counted)
+
+    # jobs use the notebook parsed for their target
+    job_nba = nba.job_adapter()
+    assert job_nba.parameter_schema is nba.parameter_schema
+    assert job_nba.execute(dict(emin=30., nbins=3)) == []
+    assert job_nba.extract_output()['spectrum'] == [42., 43., 44.]
+    assert reads == []
+
+    # the trace notebook is a copy
+    assert not any('injected-parameters' in cell.metadata.get('tags', []) for cell in nba.parsed_notebook().cells)
@@ -0,0 +1,59 @@
+import time
+import threading
+
+from nb2workflow.prewarm import Prewarmer
+
+
+def test_prewarm_refreshes_top_entries_before_expiry():
+    refreshed = []
+    done = threading.Event()
+
+    def refresh(target, key):
+        refreshed.append((target, key))
+        done.set()
+
+    prewarmer = Prewarmer(refresh, top_n=1, lead_time=10, max_concurrent_refreshes=1, half_life=0)
+    prewarmer.register("workflow-notebook", 100)
+    prewarmer.register("uncached-notebook", 0)
+
+    for i in range(3):
+        prewarmer.record_access("workflow-notebook", [("emin", "20")])
+    prewarmer.record_access("workflow-notebook", [("emin", "30")])
+    prewarmer.record_access("uncached-notebook", [])
+
+    prewarmer.record_computed("workflow-notebook", [("emin", "20")], now=1000)
+    prewarmer.record_computed("workflow-notebook", [("emin", "30")], now=1000)
+
+    assert prewarmer.due(now=1050) == []
+    assert prewarmer.due(now=1095) == [("workflow-notebook", (("emin", "20"),))]
+
+    assert prewarmer.tick(now=1095) == [("workflow-notebook", (("emin", "20"),))]
+    assert done.wait(5)
+    assert refreshed == [("workflow-notebook", (("emin", "20"),))]
+
+
+def test_prewarm_respects_refresh_budget():
+    release = threading.Event()
+
+    def refresh(target, key):
+        release.wait(5)
+
+    prewarmer = Prewarmer(refresh, top_n=5, lead_time=10, max_concurrent_refreshes=1, half_life=0)
+    prewarmer.register("workflow-notebook", 100)
+
+    for emin in "123":
+        prewarmer.record_access("workflow-notebook", [("emin", emin)])
+        prewarmer.record_computed("workflow-notebook", [("emin", emin)], now=1000)
+
+    assert len(prewarmer.tick(now=1100)) == 1
+    assert len(prewarmer.tick(now=1100)) == 0
+
+    release.set()
+    for i in range(50):
+        if len(prewarmer.refreshing) == 0:
+            break
+        time.sleep(0.1)
+
+    release.clear()
+    assert len(prewarmer.tick(now=1100)) == 1
+    release.set()
@@ -0,0 +1,102 @@
+import json
+import threading
+
+import pytest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class ConsulAgentStub(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length > 0 else None
+
+        self.server.calls.append((self.path, json.loads(body) if body else None))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b"true")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def consul_stub():
+    server = HTTPServer(("127.0.0.1", 0), ConsulAgentStub)
+    server.calls = []
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+
+
+def test_publish_batch_with_ttl(consul_stub):
+    from nb2workflow.publish import ConsulPublisher
+
+    saturation = [0.]
+
+    publisher = ConsulPublisher("http://127.0.0.1:%i"%consul_stub.server_port, "10.0.0.1", 9191,
+                                ttl=30, saturation=lambda: saturation[0])
+    publisher.register_all(["workflow-notebook", "test_notebook"])
+
+    registrations = [data for path, data in consul_stub.calls if path.startswith("/v1/agent/service/register")]
+    assert [r['name'] for r in registrations] == ["workflow-notebook", "test_notebook"]
+    assert all(r['check'] == {'ttl': '30s'} for r in registrations)
+    assert all(r['port'] == 9191 for r in registrations)
+
+    passes = [path for path, data in consul_stub.calls if path.startswith("/v1/agent/check/pass/")]
+    assert len(passes) == 2
+
+    saturation[0] = 0.9
+    assert publisher.report_health() == "warning"
+
+    saturation[0] = 1.5
+    assert publisher.report_health() == "critical"
+    assert any(path.startswith("/v1/agent/check/fail/service:workflow-notebook") for path, data in consul_stub.calls)
+
+    publisher.shutdown()
+
+    deregistrations = [path for path, data in consul_stub.calls if path.startswith("/v1/agent/service/deregister/")]
+    assert deregistrations == [
+                "/v1/agent/service/deregister/workflow-notebook:10.0.0.1:9191",
+                "/v1/agent/service/deregister/test_notebook:10.0.0.1:9191",
+            ]
+    assert publisher.registered == []
+
+
+def test_publish_http_check(consul_stub):
+    from nb2workflow.publish import ConsulPublisher
+
+    publisher = ConsulPublisher("127.0.0.1:%i"%consul_stub.server_port, "10.0.0.1", 9191, check="http", ttl=30)
+    publisher.register_all(["workflow-notebook"])
+
+    (path, data), = consul_stub.calls
+    assert data['check']['http'] == "http://10.0.0.1:9191/health"
+
+
+def test_publish_deregisters_on_sigterm(consul_stub):
+    import os
+    import signal
+    from nb2workflow.publish import ConsulPublisher
+
+    terminated = []
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: terminated.append(signum))
+    try:
+        publisher = ConsulPublisher("127.0.0.1:%i"%consul_stub.server_port, "10.0.0.1", 9191, check=None)
+        publisher.register_all(["workflow-notebook"])
+        publisher.start()
+
+        os.kill(os.getpid(), signal.SIGTERM)
+
+        assert any(path.startswith("/v1/agent/service/deregister/workflow-notebook") for path, data in consul_stub.calls)
+        assert publisher.registered == []
+        # the handler installed before still runs
+        assert terminated == [signal.SIGTERM]
+    finally:
+        signal.signal(signal.SIGTERM, previous)
@@ -0,0 +1,65 @@
+import time
+import random
+
+import pytest
+
+
+def test_reroute():
+    from nb2workflow.routing import RoutingTable, NoEndpointAvailable
+
+    table = RoutingTable.from_environ(dict(
+            WORKFLOW_ROUTES="spectrum=host:http://a:9191*3,spectrum=host:http://b:9191,lc=localfile:/data/workflows",
+            STAGING_WORKFLOWS="image",
+            WORKFLOW_FAILURE_THRESHOLD="2",
+        ))
+
+    assert table.reroute("odahub", ("lc", "lc"), {}) == ("localfile", ("/data/workflows", "lc", "lc"), {})
+    assert table.reroute("odahub", ("image", "image"), {}) == ("odahub-staging", ("image", "image"), {})
+    assert table.reroute("odahub", ("other",), {}) == ("odahub", ("other",), {})
+
+    table.rng = random.Random(1)
+    chosen = [table.reroute("odahub", ("spectrum",), {})[1][0] for i in range(400)]
+    assert 250 < chosen.count("http://a:9191") < 350
+
+    a = table.endpoint("spectrum", "host", "http://a:9191")
+    b = table.endpoint("spectrum", "host", "http://b:9191")
+
+    for i in range(2):
+        a.begin()
+        a.end(0.1, False)
+    assert a.circuit == "open"
+    assert set(table.reroute("odahub", ("spectrum",), {})[1][0] for i in range(20)) == set(["http://b:9191"])
+
+    b.begin()
+    b.end(0.1, False)
+    b.begin()
+    b.end(0.1, False)
+    with pytest.raises(NoEndpointAvailable):
+        table.reroute("odahub", ("spectrum",), {})
+
+    a.reset_timeout = 0
+    assert a.circuit == "half-open"
+    assert table.select("spectrum") is a
+    a.begin()
+    assert table.select("spectrum") is None
+    a.end(0.1, True)
+    assert a.circuit == "closed"
+
+
+def test_least_outstanding_and_hedging():
+    from nb2workflow.routing import RoutingTable, parse_routes
+
+    table = RoutingTable(parse_routes("w=host:slow,w=host:fast"), strategy="least-outstanding", hedge_after=0.1)
+    slow, fast = table.endpoints("w")
+
+    slow.begin()
+    assert table.select("w") is fast
+    slow.end(1., True)
+
+    def send(endpoint):
+        time.sleep(1. if endpoint is slow else 0.01)
+        return endpoint.location
+
+    t0 = time.time()
+    assert table.call("w", slow, send) == "fast"
+    assert time.time() - t0 < 0.5
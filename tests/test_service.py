@@ -25,6 +25,12 @@ def test_service(client):
 
     assert len(service_signature['parameters'])==4
 
+    assert client.get('/api/v1.0/options', headers={'If-None-Match': r.headers['ETag']}).status_code == 304
+
+    r_spec=client.get('/apispec_1.json')
+    assert '/api/v1.0/get/'+service_name in r_spec.json['paths']
+    assert client.get('/apispec_1.json', headers={'If-None-Match': r_spec.headers['ETag']}).status_code == 304
+
     print('get: /api/v1.0/get/'+service_name)
 
     r=client.get('/api/v1.0/get/'+service_name,query_string=dict(eminFAKE=20.))
@@ -40,3 +46,90 @@ def test_service(client):
     print(r.json)
 
     open("output.png","wb").write(base64.b64decode(r.json['output']['spectrum_png_content']))
+
+
+@pytest.fixture(scope="module")
+def plain_service(tmpdir_factory):
+    """
+    the service with plain-python notebooks of its own, not depending on TEST_NOTEBOOK: one with cached results, and one streaming them
+    """
+    import subprocess
+    import nbformat
+    from test_compiled import write_repo, plain_cells, tagged_cell
+
+    fn = write_repo(str(tmpdir_factory.mktemp("service").join("repo")), plain_cells() + [
+            tagged_cell("cache_timeout = 600", "system-parameters"),
+        ])
+
+    location = os.path.dirname(fn)
+    nb = nbformat.v4.new_notebook()
+    nb.cells = plain_cells()
+    nbformat.write(nb, os.path.join(location, "streamed.ipynb"))
+    subprocess.check_call(["git", "-C", location, "add", "."])
+    subprocess.check_call(["git", "-C", location, "-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "-q", "-m", "streamed"])
+
+    app = nb2workflow.service.app
+    app.notebook_adapters = nb2workflow.nbadapter.find_notebooks(location)
+    nb2workflow.service.setup_routes(app)
+    return app.test_client()
+
+
+def test_cache_control(plain_service):
+    # every computed result is cacheable, not only the first one
+    for nbins in (300, 400):
+        r = plain_service.get('/api/v1.0/get/workflow-notebook', query_string=dict(nbins=nbins), headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == 200
+        assert r.headers['Cache-Control'] == "public, max-age=600"
+        assert r.headers['Content-Encoding'] == "gzip"
+
+        # served again from the response cache, with the validator of its precompressed body
+        again = plain_service.get('/api/v1.0/get/workflow-notebook', query_string=dict(nbins=nbins), headers={'Accept-Encoding': 'gzip'})
+        assert again.headers['ETag'] == r.headers['ETag']
+        assert again.headers['Content-Length'] == str(len(again.data))
+
+        assert plain_service.get('/api/v1.0/get/workflow-notebook', query_string=dict(nbins=nbins),
+                                 headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']}).status_code == 304
+
+
+def test_streamed_result(plain_service):
+    r = plain_service.get('/api/v1.0/get/streamed', query_string=dict(nbins=300))
+    assert r.status_code == 200
+    assert len(r.json['output']['spectrum']) == 300
+    assert r.headers['Cache-Control'] == "no-cache"
+    assert 'ETag' not in r.headers
+
+
+def test_documents(plain_service):
+    for url in ('/api/v1.0/options', '/apispec_1.json'):
+        r = plain_service.get(url)
+        assert r.status_code == 200
+        assert r.headers['ETag']
+        assert plain_service.get(url, headers={'If-None-Match': r.headers['ETag']}).status_code == 304
+
+    assert sorted(plain_service.get('/api/v1.0/options').json) == ["streamed", "workflow-notebook"]
+
+
+def test_async_failure(plain_service, tmpdir):
+    import nbformat
+    from test_compiled import tagged_cell
+
+    # a notebook outside of a repository, which jobs are unable to clone
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [tagged_cell("emin = 20.", "parameters"), tagged_cell("e = emin", "outputs")]
+    nbformat.write(nb, str(tmpdir.join("crashing.ipynb")))
+
+    app = nb2workflow.service.app
+    app.notebook_adapters.update(nb2workflow.nbadapter.find_notebooks(str(tmpdir)))
+
+    with app.test_request_context():
+        nb2workflow.service.submit_async("crashing-job", "crashing", dict(request_parameters=dict(emin=20.)))
+
+    r = plain_service.get('/api/v1.0/status/crashing-job', query_string=dict(wait=10))
+    assert r.json['workflow_status'] == "failed"
+    assert r.json['data']['output'] == "incomplete"
+    assert len(r.json['data']['exceptions']) == 1
+    assert 'Retry-After' not in r.headers
+
+    events = plain_service.get('/api/v1.0/events/crashing-job').data.decode()
+    assert "event: failed" in events
+
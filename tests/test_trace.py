@@ -0,0 +1,38 @@
+import os
+
+import nbformat
+
+
+def output_notebook(fn):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        nbformat.v4.new_markdown_cell(source="# trace"),
+        nbformat.v4.new_code_cell(source="spectrum = [1, 2]", outputs=[nbformat.v4.new_output("stream", text="fine-output-marker\n")]),
+        nbformat.v4.new_code_cell(source="1/0", outputs=[nbformat.v4.new_output("error", ename="ZeroDivisionError", evalue="division by zero", traceback=["ZeroDivisionError: division by zero"])]),
+    ]
+    nbformat.write(nb, fn)
+    return fn
+
+
+def test_render_trace(tmpdir):
+    from nb2workflow import trace
+
+    fn = output_notebook(str(tmpdir.join("workflow-notebook_output.ipynb")))
+
+    path, etag = trace.render_trace(fn)
+    assert os.path.dirname(path) == str(tmpdir.join(trace.trace_dirname))
+    assert "fine-output-marker" in open(path).read()
+
+    mtime = os.stat(path).st_mtime
+    assert trace.render_trace(fn) == (path, etag)
+    assert os.stat(path).st_mtime == mtime
+
+    failed_path, failed_etag = trace.render_trace(fn, failed_only=True)
+    assert failed_etag != etag
+    assert "fine-output-marker" not in open(failed_path).read()
+    assert "ZeroDivisionError" in open(failed_path).read()
+
+    assert trace.parse_cell_range("1-2") == (1, 2)
+    range_path, range_etag = trace.render_trace(fn, trace.parse_cell_range("1"))
+    assert "fine-output-marker" in open(range_path).read()
+    assert "ZeroDivisionError" not in open(range_path).read()
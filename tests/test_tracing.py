@@ -0,0 +1,79 @@
+import json
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+def test_spans(tmpdir):
+    from nb2workflow import tracing
+    from nb2workflow.executor import Executor
+
+    exporter = tracing.JSONLExporter(str(tmpdir.join("spans.jsonl")))
+    tracing.exporters.append(exporter)
+
+    try:
+        remote = tracing.parse_traceparent("00-%s-%s-01"%("a" * 32, "b" * 16))
+        assert remote == ("a" * 32, "b" * 16)
+        assert tracing.parse_traceparent("garbage") is None
+
+        executor = Executor(max_workers=1)
+        done = threading.Event()
+
+        with tracing.start_span("service.request", remote) as request_span:
+            assert tracing.inject({}) == dict(traceparent=request_span.traceparent())
+            executor.submit(lambda: done.set())
+
+        done.wait(5)
+        executor.queue.join()
+    finally:
+        tracing.exporters.remove(exporter)
+
+    spans = dict((s['name'], s) for s in map(json.loads, open(exporter.path)))
+
+    assert spans['service.request']['trace_id'] == "a" * 32
+    assert spans['service.request']['parent_id'] == "b" * 16
+    assert spans['executor.job']['trace_id'] == "a" * 32
+    assert spans['executor.job']['parent_id'] == request_span.span_id
+    assert spans['executor.job']['attributes']['queued_seconds'] >= 0
+    assert tracing.current_span() is None
+
+
+def test_otlp_export():
+    from nb2workflow import tracing
+
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Collector)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+
+    exporter = tracing.OTLPExporter("http://127.0.0.1:%i/v1/traces"%server.server_port, interval=3600)
+    tracing.exporters.append(exporter)
+
+    try:
+        with tracing.start_span("notebook.execute", notebook="workflow") as span:
+            raise RuntimeError("kernel died")
+    except RuntimeError:
+        pass
+    finally:
+        tracing.exporters.remove(exporter)
+
+    exporter.flush()
+    thread.join(10)
+    server.server_close()
+
+    path, payload = received[0]
+    assert path == "/v1/traces"
+    spans = payload['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert spans[0]['traceId'] == span.trace_id
+    assert spans[0]['attributes'] == [dict(key="notebook", value=dict(stringValue="workflow"))]
+    assert spans[0]['status']['code'] == 2
@@ -98,3 +98,35 @@ def test_async_service_exception(service_fixture, app):
     ex = result['exceptions'][0]
 
     print(ex)
+
+
+def test_finished_job_result():
+    from nb2workflow.workflows import finished_job_result
+
+    # jobs finished before they are requested give their result as wait_for_job does
+    data = dict(output=dict(spectrum=[1]), exceptions=[])
+    assert finished_job_result(dict(workflow_status="done", data=data, comment="")) == data
+    assert finished_job_result(dict(workflow_status="submitted", job_id="key")) is None
+    assert finished_job_result(data) is None
+
+def test_partial_result_not_cached(tmpdir, monkeypatch):
+    import nbformat
+    from diskcache import Cache
+    from nb2workflow import workflows
+    from test_compiled import tagged_cell, write_repo
+
+    location = str(tmpdir.join("repo"))
+    write_repo(location, [
+        tagged_cell("emin = 20.", "parameters"),
+        nbformat.v4.new_code_cell(source="lc = [emin, emin * 2]"),
+        nbformat.v4.new_code_cell(source="import time\ntime.sleep(1)"),
+        nbformat.v4.new_code_cell(source="spectrum = [x + 1 for x in lc]"),
+        tagged_cell("lc = lc\nspectrum = spectrum", "outputs"),
+    ])
+
+    monkeypatch.setattr(workflows, "cache", Cache(str(tmpdir.join("cache"))))
+
+    result = workflows.evaluate("localfile", location, "workflow-notebook", emin=10., _return_after="lc")
+    assert result['partial']
+    assert result['output']['lc'] == [10., 20.]
+    assert len(workflows.cache) == 0
@@ -0,0 +1,131 @@
+import time
+
+import pytest
+
+
+@pytest.fixture(params=["sqlite", "file"])
+def work_queue(request, tmpdir):
+    from nb2workflow.workqueue import open_queue
+
+    if request.param == "sqlite":
+        url = "sqlite://" + str(tmpdir.join("queue.db"))
+    else:
+        url = "file://" + str(tmpdir.join("queue"))
+
+    return open_queue(url, visibility_timeout=0.5, max_attempts=2, poll_interval=0.05)
+
+
+def test_lease_and_requeue(work_queue):
+    assert work_queue.put("a", dict(target="t", params={}))
+    assert not work_queue.put("a", dict(target="t", params={}))
+    assert work_queue.put("b", dict(target="t", params={}))
+
+    key, job = work_queue.lease("worker-1")
+    assert key == "a" and job['target'] == "t"
+    assert work_queue.get("a")['status'] == "running"
+    assert work_queue.lease("worker-2")[0] == "b"
+    assert work_queue.lease("worker-2") is None
+
+    time.sleep(0.3)
+    assert work_queue.heartbeat("a", "worker-1")
+    assert not work_queue.heartbeat("a", "worker-2")
+    time.sleep(0.3)
+
+    # worker-2 died holding b, which goes to worker-3; a is still leased by worker-1
+    assert work_queue.lease("worker-3")[0] == "b"
+    assert work_queue.get("b")['attempts'] == 2
+
+    version = work_queue.get("a")['version']
+    assert work_queue.progress("a", "worker-1", dict(x=1))
+    assert not work_queue.progress("a", "worker-2", dict(x=2))
+    assert work_queue.get("a")['version'] == version + 1
+    assert work_queue.partial("a") == dict(x=1)
+
+    version = work_queue.get("a")['version']
+    assert work_queue.complete("a", "worker-1", dict(output=dict(x=1)))
+    assert work_queue.partial("a") is None
+    assert work_queue.wait("a", since=version, timeout=1)['status'] == "done"
+    assert work_queue.result("a") == dict(output=dict(x=1))
+
+    time.sleep(0.6)
+    assert work_queue.lease("worker-4") is None
+    assert work_queue.get("b")['status'] == "failed"
+    assert work_queue.stats() == dict(done=1, failed=1)
+
+
+def test_consumer(work_queue):
+    from nb2workflow.executor import Executor
+    from nb2workflow.workqueue import QueueConsumer
+
+    def handler(key, job):
+        time.sleep(0.8)
+        return dict(output=job['params'])
+
+    consumer = QueueConsumer(work_queue, Executor(max_workers=1), handler, poll_interval=0.05)
+    consumer.start()
+
+    try:
+        work_queue.put("slow", dict(target="t", params=dict(x=1)))
+        work_queue.put("next", dict(target="t", params=dict(x=2)))
+
+        # the lease outlives the visibility timeout thanks to heartbeats
+        assert work_queue.wait("slow", timeout=5)['status'] == "done"
+        assert work_queue.get("slow")['attempts'] == 1
+        assert work_queue.wait("next", timeout=5)['status'] == "done"
+        assert work_queue.result("next") == dict(output=dict(x=2))
+    finally:
+        consumer.stop()
+
+
+def test_file_queue_concurrent_consumers(tmpdir):
+    import threading
+    from nb2workflow.workqueue import open_queue
+
+    url = "file://" + str(tmpdir.join("queue"))
+    queues = [open_queue(url, visibility_timeout=0.2, max_attempts=3) for i in range(4)]
+
+    keys = ["job%i"%i for i in range(40)]
+    for key in keys:
+        assert queues[0].put(key, dict(target="t", params={}))
+
+    # queued jobs older than the visibility timeout are not taken for expired leases when they are claimed
+    time.sleep(0.3)
+
+    leased = []
+
+    def consume(queue, worker):
+        while True:
+            job = queue.lease(worker)
+            if job is None:
+                return
+            leased.append(job[0])
+            queue.complete(job[0], worker, dict(output={}))
+
+    threads = [threading.Thread(target=consume, args=(queue, "worker-%i"%i)) for i, queue in enumerate(queues)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert sorted(leased) == sorted(keys)
+    assert all(queues[0].get(key)['attempts'] == 1 for key in keys)
+    assert queues[0].stats() == dict(done=40)
+
+    # claims and lease renewals wait for the lock held by another instance
+    queues[0].put("locked", dict(target="t", params={}))
+    claimed = []
+    with queues[0].locked():
+        thread = threading.Thread(target=lambda: claimed.append(queues[1].lease("worker-1")))
+        thread.start()
+        thread.join(0.3)
+        assert claimed == []
+    thread.join(5)
+    assert claimed[0][0] == "locked"
+
+    with queues[0].locked():
+        thread = threading.Thread(target=lambda: claimed.append(queues[2].heartbeat("locked", "worker-1")))
+        thread.start()
+        thread.join(0.3)
+        assert len(claimed) == 1
+    thread.join(5)
+    assert claimed[1] is True